@@ -0,0 +1,244 @@
+"""
+benchmark.py
+
+Offline benchmarks for the photo-classifier hot paths on a synthetic image corpus.
+Reports images/sec, p50/p99 latency and peak RSS for each stage:
+    decode       PIL decode of one JPEG
+    crop         intelligent_center_crop of one decoded image
+    pipeline     one training batch from data_pipeline.get_datasets (decode, crop, augment, rescale)
+    keras_bN     model.predict_on_batch at batch size N
+    keras_M_bN   the same in mode M from --modes, e.g. mixed_bfloat16+xla (see precision.py), plus the largest
+                 score difference to float32 and the share of labels (thresholded at 0.5) that stay the same
+    tflite_*     batch-of-1 inference with the .tflite models quantize_model.py wrote next to the model
+Results are written as JSON so runs can be compared.
+Usage:
+    python benchmark.py --images 200 --width 1024 --height 768
+    python benchmark.py --model final_model_multilabel.keras --batch-sizes 1 8 32 --output before.json
+    python benchmark.py --modes float32 float32+xla mixed_bfloat16 mixed_bfloat16+xla
+"""
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+from preprocess import intelligent_center_crop, IMG_SIZE
+
+N_IMAGES = 200
+WIDTH = 1024
+HEIGHT = 768
+BATCH_SIZES = [1, 8, 32]
+# <precision>[+xla]
+MODES = ['float32', 'float32+xla', 'mixed_bfloat16', 'mixed_bfloat16+xla']
+PIPELINE_STEPS = 20
+MODEL_PATH = 'final_model_multilabel.keras'
+OUTPUT_PATH = 'benchmark_results.json'
+
+
+def current_rss():
+    """Resident set size in bytes. Falls back to the process peak where /proc is not available (macOS)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PeakRSS:
+    """Samples the RSS in a background thread while the block runs."""
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(0.005):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def make_corpus(corpus_dir, n_images, width, height, seed=0):
+    """Writes n_images JPEGs (smooth gradients plus noise, so they compress like photos) split over both classes."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    paths = []
+    for i in range(n_images):
+        cls_dir = os.path.join(corpus_dir, ['compliant', 'non-compliant'][i % 2])
+        os.makedirs(cls_dir, exist_ok=True)
+        base = rng.uniform(0, 255, 3)
+        gradient = (xx[..., None] * rng.uniform(-0.2, 0.2, 3) + yy[..., None] * rng.uniform(-0.2, 0.2, 3))
+        pixels = base + gradient + rng.normal(0, 8, (height, width, 3))
+        path = os.path.join(cls_dir, f'{i:05d}.jpg')
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def summarize(latencies, images_per_call, peak_rss):
+    latencies = np.asarray(latencies)
+    return {
+        'calls': len(latencies),
+        'images_per_sec': float(images_per_call * len(latencies) / latencies.sum()),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'peak_rss_mb': peak_rss / 2**20
+    }
+
+
+def bench_decode(paths):
+    latencies = []
+    with PeakRSS() as rss:
+        for path in paths:
+            start = time.perf_counter()
+            with Image.open(path) as img:
+                img.convert('RGB')
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies, 1, rss.peak)
+
+
+def bench_crop(paths):
+    latencies = []
+    with PeakRSS() as rss:
+        for path in paths:
+            with Image.open(path) as img:
+                img = img.convert('RGB')
+            start = time.perf_counter()
+            intelligent_center_crop(img, IMG_SIZE)
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies, 1, rss.peak)
+
+
+def bench_pipeline(corpus_dir, steps):
+    from data_pipeline import get_datasets
+    from preprocess import BATCH_SIZE
+    train_ds, _, _ = get_datasets(corpus_dir)
+    batches = iter(train_ds)
+    next(batches)  # builds the pipeline and fills the prefetch buffer
+    latencies = []
+    with PeakRSS() as rss:
+        for _ in range(steps):
+            start = time.perf_counter()
+            next(batches)
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies, BATCH_SIZE, rss.peak)
+
+
+def bench_keras(model_path, images, batch_size, mode='float32', reference=None):
+    from tensorflow.keras.models import load_model
+    from precision import set_precision, with_policy, compiled_predict
+    precision, _, xla = mode.partition('+')
+    precision = set_precision(precision)
+    model = with_policy(load_model(model_path), precision)
+    predict = compiled_predict(model, batch_size) if xla else model.predict_on_batch
+    batches = [images[i:i + batch_size] for i in range(0, len(images) - batch_size + 1, batch_size)]
+    predict(batches[0])  # first call traces (and compiles) the graph
+    latencies = []
+    preds = []
+    with PeakRSS() as rss:
+        for batch in batches:
+            start = time.perf_counter()
+            preds.append(np.asarray(predict(batch), dtype=np.float32))
+            latencies.append(time.perf_counter() - start)
+    set_precision('float32')
+    result = summarize(latencies, batch_size, rss.peak)
+    result['precision'] = precision
+    preds = np.concatenate(preds)
+    if reference is not None:
+        reference = reference[:len(preds)]
+        result['max_abs_diff'] = float(np.abs(preds - reference).max())
+        result['label_agreement'] = float(((preds > 0.5) == (reference > 0.5)).mean())
+    return result, preds
+
+
+def bench_tflite(tflite_path, images):
+    from quantize_model import TFLiteModel
+    model = TFLiteModel(tflite_path)
+    model.predict_one(images[:1])
+    latencies = []
+    with PeakRSS() as rss:
+        for img in images:
+            start = time.perf_counter()
+            model.predict_one(img[None])
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies, 1, rss.peak)
+
+
+def main(n_images, width, height, model_path, batch_sizes, pipeline_steps, output_path, corpus_dir=None, modes=('float32',)):
+    results = {
+        'config': dict(images=n_images, width=width, height=height, model=model_path, batch_sizes=batch_sizes,
+                       pipeline_steps=pipeline_steps, modes=list(modes)),
+        'platform': dict(python=platform.python_version(), machine=platform.machine(), system=platform.system(),
+                         cpus=os.cpu_count()),
+        'stages': {}
+    }
+    stages = results['stages']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = corpus_dir or tmp_dir
+        paths = sorted(glob.glob(os.path.join(corpus_dir, '*', '*.jpg')))[:n_images]
+        if len(paths) < n_images:
+            print(f"Writing {n_images} synthetic {width}x{height} images to {corpus_dir}")
+            paths = make_corpus(corpus_dir, n_images, width, height)
+
+        print("Benchmarking decode...")
+        stages['decode'] = bench_decode(paths)
+        print("Benchmarking crop...")
+        stages['crop'] = bench_crop(paths)
+        print("Benchmarking input pipeline...")
+        stages['pipeline'] = bench_pipeline(corpus_dir, pipeline_steps)
+
+        if os.path.exists(model_path):
+            images = []
+            for path in paths[:max(max(batch_sizes) * 4, 32)]:
+                with Image.open(path) as img:
+                    images.append(intelligent_center_crop(img, IMG_SIZE) / 255.0)
+            images = np.stack(images).astype(np.float32)
+            for batch_size in batch_sizes:
+                print(f"Benchmarking Keras inference at batch size {batch_size}...")
+                stages[f'keras_b{batch_size}'], reference = bench_keras(model_path, images, batch_size)
+                for mode in modes:
+                    if mode != 'float32':
+                        print(f"Benchmarking Keras {mode} inference at batch size {batch_size}...")
+                        stages[f'keras_{mode}_b{batch_size}'], _ = bench_keras(model_path, images, batch_size, mode, reference)
+            for tflite_path in sorted(glob.glob(os.path.splitext(model_path)[0] + '_*.tflite')):
+                name = os.path.splitext(os.path.basename(tflite_path))[0].rsplit('_', 1)[-1]
+                print(f"Benchmarking TFLite {name} inference...")
+                stages[f'tflite_{name}'] = bench_tflite(tflite_path, images)
+        else:
+            print(f"Model {model_path} not found, skipping inference benchmarks.")
+
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n{'stage':<32}{'img/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'RSS MB':>10}{'max diff':>10}{'agree':>8}")
+    for name, r in stages.items():
+        accuracy = f"{r['max_abs_diff']:>10.4f}{r['label_agreement']:>8.1%}" if 'max_abs_diff' in r else ''
+        print(f"{name:<32}{r['images_per_sec']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>10.0f}{accuracy}")
+    print(f"Results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark decoding, cropping, the input pipeline and inference.")
+    parser.add_argument('--images', type=int, default=N_IMAGES, help='Size of the synthetic corpus')
+    parser.add_argument('--width', type=int, default=WIDTH, help='Width of the synthetic images')
+    parser.add_argument('--height', type=int, default=HEIGHT, help='Height of the synthetic images')
+    parser.add_argument('--corpus', help='Keep the synthetic corpus in this directory (reused if it already holds enough images)')
+    parser.add_argument('--model', default=MODEL_PATH, help='Keras model for the inference benchmarks')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=BATCH_SIZES, help='Batch sizes for Keras inference')
+    parser.add_argument('--pipeline-steps', type=int, default=PIPELINE_STEPS, help='Training batches to time')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=['float32'], help='Keras inference modes to compare against float32')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='JSON file for the results')
+    args = parser.parse_args()
+    main(args.images, args.width, args.height, args.model, args.batch_sizes, args.pipeline_steps, args.output, args.corpus, args.modes)
@@ -0,0 +1,106 @@
+"""
+cli.py
+
+Single entry point for the photo-classifier scripts: python cli.py <command> [arguments of the script].
+Only the script of the chosen command is loaded, run as if it had been started directly, so a command imports
+TensorFlow, matplotlib or a model only if its script needs them. bucket and make-csv never load TensorFlow, no
+command loads it for --help, and `python cli.py --help` loads nothing but this file. The scripts keep working on
+their own, and their options and --help are unchanged.
+`python cli.py startup` measures the startup cost of every command: the wall time of `<command> --help` (the
+imports up to argument parsing) in a fresh interpreter, and whether it loaded TensorFlow or matplotlib.
+Usage:
+    python cli.py --help
+    python cli.py train --xla
+    python cli.py infer-multilabel --index scores.sqlite
+    python cli.py bucket --mode hardlink --headless
+    python cli.py startup --runs 5 bucket make-csv infer
+"""
+import os
+import re
+import sys
+import time
+import runpy
+import argparse
+import statistics
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# command: (script, description)
+COMMANDS = {
+    'train': ('train.py', 'Train or resume the compliance classifier'),
+    'train-multilabel': ('train_multilabel.py', 'Train the multi-label classifier'),
+    'launch': ('distributed.py', 'Run a training script as local data-parallel worker processes'),
+    'tune': ('tune_multilabel.py', 'Hyperband search for the multi-label hyperparameters'),
+    'infer': ('infer.py', 'Batch classify images with the compliance classifier'),
+    'infer-multilabel': ('infer_multilabel.py', 'Batch score images with the multi-label classifier'),
+    'evaluate': ('evaluate.py', 'Evaluate the multi-label model from cached predictions and tune thresholds'),
+    'test': ('test_model.py', 'Evaluate the compliance classifier on the test set'),
+    'export': ('export_augmented_images.py', 'Export augmented images per class'),
+    'export-tfjs': ('rebuild_and_export_tfjs.py', 'Rebuild the multi-label model and export it to TensorFlow.js'),
+    'bucket': ('copy_bad_images.py', 'Distribute images into quality buckets by their label scores'),
+    'make-csv': ('create_multilabel_csv.py', 'Create a CSV template for multi-label annotation'),
+    'dedup': ('dedup.py', 'Group near-duplicate photos for leak-free splits'),
+    'pack': ('packed_dataset.py', 'Pack labelled images into TFRecord shards'),
+    'benchmark': ('benchmark.py', 'Benchmark decoding, cropping, the input pipeline and inference'),
+}
+# Top-level modules whose import dominates startup
+HEAVY_MODULES = ['tensorflow', 'keras', 'matplotlib']
+STARTUP_RUNS = 3
+
+
+def run_command(command, argv):
+    """Runs the script of command with argv as its command line."""
+    script = os.path.join(SCRIPT_DIR, COMMANDS[command][0])
+    sys.argv = [script] + argv
+    sys.path.insert(0, SCRIPT_DIR)
+    runpy.run_path(script, run_name='__main__')
+
+
+def startup_time(command, runs=STARTUP_RUNS):
+    """(median seconds of `command --help` in a new interpreter, heavy modules it imported)."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__), command, '--help'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"'{command} --help' failed:\n{result.stderr[-2000:]}")
+    # -X importtime lines end in '|<indentation><module>'; top-level packages are what we look for
+    imported = set(re.findall(r'\|\s*([A-Za-z_][\w]*)(?:\.[\w.]+)?\s*$', result.stderr, re.MULTILINE))
+    return statistics.median(times), [m for m in HEAVY_MODULES if m in imported]
+
+
+def startup(commands, runs=STARTUP_RUNS):
+    print(f"{'command':<20}{'startup s':>10}  heavy imports")
+    for command in commands:
+        seconds, heavy = startup_time(command, runs)
+        print(f"{command:<20}{seconds:>10.2f}  {', '.join(heavy) or '-'}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Photo-classifier command line. `<command> --help` shows the options of a command.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n' + '\n'.join(f"  {name:<18}{desc}" for name, (_, desc) in COMMANDS.items()) +
+               f"\n  {'startup':<18}Measure the startup time of commands")
+    parser.add_argument('command', choices=list(COMMANDS) + ['startup'], metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the command')
+    args = parser.parse_args(argv)
+    if args.command != 'startup':
+        run_command(args.command, args.args)
+        return
+    startup_parser = argparse.ArgumentParser(prog='cli.py startup', description="Measure the startup time of commands.")
+    # Checked below: argparse also checks an empty nargs='*' list against choices and rejects it
+    startup_parser.add_argument('commands', nargs='*', metavar='command',
+                                help=f"Commands to measure (default: all of {', '.join(COMMANDS)})")
+    startup_parser.add_argument('--runs', type=int, default=STARTUP_RUNS, help='Runs per command; the median is reported')
+    startup_args = startup_parser.parse_args(args.args)
+    unknown = [c for c in startup_args.commands if c not in COMMANDS]
+    if unknown:
+        startup_parser.error(f"unknown commands: {', '.join(unknown)}")
+    startup(startup_args.commands or list(COMMANDS), startup_args.runs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
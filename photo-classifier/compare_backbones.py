@@ -0,0 +1,134 @@
+"""
+compare_backbones.py
+
+Latency/accuracy comparison of the backbones in model_factory.py.
+For every backbone and input resolution it reports the parameter count, saved model size, batch-of-1 latency
+(p50/p99), batch throughput and peak RSS on this machine. Latency does not depend on the weights, so these models
+are built untrained. Trained models passed with --models are measured the same way and additionally scored on the
+validation split of train_multilabel.py (per-label and mean accuracy at 0.5); pass the --img-dir, --csv and --groups
+the models were trained with, so no training photo is scored.
+Results are saved as JSON.
+Usage:
+    python compare_backbones.py --img-sizes 160 224
+    python compare_backbones.py --backbones resnet50 mobilenetv3small --models resnet50.keras mobilenetv3small.keras
+    python compare_backbones.py --models student.keras --img-dir datasets/multi-label/photos --csv datasets/multi-label/labels_template.csv
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tensorflow.keras.models import load_model
+from model_factory import BACKBONES, build_model
+from benchmark import PeakRSS, summarize
+from dedup import split_dataframe
+from evaluate import IMG_DIR, CSV_PATH
+from preprocess import intelligent_center_crop
+
+IMG_SIZES = [160, 224]
+LATENCY_RUNS = 50
+THROUGHPUT_BATCH = 32
+OUTPUT_PATH = 'backbone_comparison.json'
+
+
+def saved_size(model):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'model.keras')
+        model.save(path, include_optimizer=False)
+        return os.path.getsize(path)
+
+
+def measure_speed(model, runs=LATENCY_RUNS, throughput_batch=THROUGHPUT_BATCH):
+    size = model.input_shape[1]
+    rng = np.random.default_rng(0)
+    single = rng.random((1, size, size, 3), dtype=np.float32)
+    batch = rng.random((throughput_batch, size, size, 3), dtype=np.float32)
+    model.predict_on_batch(single)  # first calls trace the graph
+    model.predict_on_batch(batch)
+    latencies = []
+    with PeakRSS() as rss:
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.predict_on_batch(single)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(max(runs // 10, 1)):
+            model.predict_on_batch(batch)
+        batch_time = (time.perf_counter() - start) / max(runs // 10, 1)
+    result = summarize(latencies, 1, rss.peak)
+    result['batch_images_per_sec'] = throughput_batch / batch_time
+    return result
+
+
+def validation_split(img_dir, csv_path, groups_path, n_images):
+    """(label names, up to n_images rows of the validation split of train_multilabel.py) or None without labels."""
+    if not os.path.exists(csv_path):
+        return None
+    labels_df = pd.read_csv(csv_path)
+    _, val_df = split_dataframe(labels_df, img_dir, groups_path)
+    return list(labels_df.columns[1:]), val_df.head(n_images)
+
+
+def measure_accuracy(model, img_dir, split):
+    if split is None:
+        return None
+    label_names, val_df = split
+    size = model.input_shape[1]
+    x = np.stack([intelligent_center_crop(Image.open(os.path.join(img_dir, f)), size) / 255.0 for f in val_df['filename']])
+    y = val_df[label_names].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+    preds = np.asarray(model.predict(x.astype(np.float32), verbose=0))
+    if preds.shape[1] != y.shape[1]:
+        return None
+    accuracy = {}
+    for i, name in enumerate(label_names):
+        known = ~np.isnan(y[:, i])
+        if known.any():
+            accuracy[name] = float(np.mean((preds[known, i] > 0.5) == (y[known, i] > 0.5)))
+    accuracy['mean'] = float(np.mean(list(accuracy.values()))) if accuracy else None
+    return accuracy
+
+
+def describe(model):
+    return dict(name=model.name, img_size=model.input_shape[1], params=int(model.count_params()),
+                size_mb=saved_size(model) / 2**20)
+
+
+def main(backbones, img_sizes, model_paths, n_images, output_path, img_dir=IMG_DIR, csv_path=CSV_PATH, groups_path=None):
+    results = []
+    for backbone in backbones:
+        for img_size in img_sizes:
+            print(f"Measuring {backbone} at {img_size}x{img_size}...")
+            model = build_model(5, backbone, img_size, weights=None)
+            results.append(dict(describe(model), **measure_speed(model)))
+    split = validation_split(img_dir, csv_path, groups_path, n_images) if model_paths else None
+    for path in model_paths:
+        print(f"Measuring {path}...")
+        model = load_model(path)
+        results.append(dict(describe(model), path=path, **measure_speed(model),
+                            accuracy=measure_accuracy(model, img_dir, split)))
+
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n{'model':<28}{'params':>12}{'MB':>8}{'p50 ms':>9}{'p99 ms':>9}{'img/s b32':>11}{'RSS MB':>8}{'acc':>7}")
+    for r in results:
+        acc = (r.get('accuracy') or {}).get('mean')
+        print(f"{r.get('path', r['name']):<28}{r['params']:>12,}{r['size_mb']:>8.1f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+              f"{r['batch_images_per_sec']:>11.1f}{r['peak_rss_mb']:>8.0f}{'' if acc is None else f'{acc:.3f}':>7}")
+    print(f"Results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare latency, size and accuracy of the available backbones.")
+    parser.add_argument('--backbones', nargs='*', choices=sorted(BACKBONES), default=sorted(BACKBONES), help='Backbones to build and time')
+    parser.add_argument('--img-sizes', type=int, nargs='+', default=IMG_SIZES, help='Input resolutions to time')
+    parser.add_argument('--models', nargs='*', default=[], help='Trained .keras models to time and score')
+    parser.add_argument('--images', type=int, default=200, help='Number of validation photos to score trained models on')
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the labelled photos the models were trained on')
+    parser.add_argument('--csv', default=CSV_PATH, help='Labels CSV the models were trained on; its validation split is scored')
+    parser.add_argument('--groups', metavar='CSV', help='Split by the near-duplicate groups of dedup.py, like train_multilabel.py --groups')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='JSON file for the results')
+    args = parser.parse_args()
+    main(args.backbones, args.img_sizes, args.models, args.images, args.output, args.img_dir, args.csv, args.groups)
@@ -1,23 +1,29 @@
+"""
+copy_bad_images.py
+
+Distributes the images of inference_results_multilabel.csv into quality buckets by their weighted label score and
+shows 5 random example images per bucket.
+Usage:
+    python copy_bad_images.py
+    python copy_bad_images.py --mode hardlink --headless --contact-sheets
+"""
 import os
+import argparse
 import pandas as pd
 import shutil
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import random
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
 
 INFER_CSV = 'inference_results_multilabel.csv'
 IMG_DIR = 'datasets/multi-label/photos'
 BUCKETS_DIR = 'quality_buckets'
 NUM_BUCKETS = 5
-
-# Delete output dir before starting
-if os.path.exists(BUCKETS_DIR):
-    shutil.rmtree(BUCKETS_DIR)
-os.makedirs(BUCKETS_DIR, exist_ok=True)
-
-# Read inference results
-results_df = pd.read_csv(INFER_CSV)
+THUMBNAIL_SIZE = 160
+SHEET_COLUMNS = 10
+# Thumbnails per contact sheet; large buckets get several sheets, each far below JPEG's 65,500 px limit
+SHEET_THUMBNAILS = 200
 
 # Define weights for each label (must match order in CSV)
 # Example: bright-background, neutral-background, white-shirt, high-quality, business-attire
@@ -30,81 +36,184 @@ def gain(x, k):
 
 GAIN_K = 3.0  # You can adjust this value as needed
 
-score_cols = [col for col in results_df.columns if col != 'filename']
-results_df[score_cols] = gain(results_df[score_cols], GAIN_K)
-
-# Compute a weighted quality score for each image as weighted sum / total weights * 100
-weighted_sum = results_df[score_cols].mul(LABEL_WEIGHTS).sum(axis=1)
-total_weight = sum(LABEL_WEIGHTS)
-results_df['score'] = (weighted_sum / total_weight) * 100
-
-# Dynamically compute bucket edges so buckets always go from 0-100
-bucket_edges = [i * (100 / NUM_BUCKETS) for i in range(NUM_BUCKETS + 1)]
-results_df['bucket'] = pd.cut(
-    results_df['score'],
-    bins=bucket_edges,
-    labels=[f"{int(bucket_edges[i])}-{int(bucket_edges[i+1])}" for i in range(NUM_BUCKETS)],
-    include_lowest=True,
-    right=False
-)
-
-# Create bucket directories
-for label in results_df['bucket'].cat.categories:
-    os.makedirs(os.path.join(BUCKETS_DIR, label), exist_ok=True)
-
-# Copy images to their respective buckets, skipping those starting with 'foo'
-for _, row in results_df.iterrows():
-    fname = row['filename']
-    if fname.startswith('foo'):
-        continue
-    bucket_label = row['bucket']
-    if pd.isna(bucket_label):
-        continue
-    bucket_path = os.path.join(BUCKETS_DIR, bucket_label)
-    src = os.path.join(IMG_DIR, fname)
-    dst = os.path.join(bucket_path, fname)
-    try:
+
+def score_results(results_df):
+    score_cols = [col for col in results_df.columns if col != 'filename']
+    results_df[score_cols] = gain(results_df[score_cols], GAIN_K)
+
+    # Compute a weighted quality score for each image as weighted sum / total weights * 100
+    weighted_sum = results_df[score_cols].mul(LABEL_WEIGHTS).sum(axis=1)
+    total_weight = sum(LABEL_WEIGHTS)
+    results_df['score'] = (weighted_sum / total_weight) * 100
+
+    # Dynamically compute bucket edges so buckets always go from 0-100
+    bucket_edges = [i * (100 / NUM_BUCKETS) for i in range(NUM_BUCKETS + 1)]
+    results_df['bucket'] = pd.cut(
+        results_df['score'],
+        bins=bucket_edges,
+        labels=[f"{int(bucket_edges[i])}-{int(bucket_edges[i+1])}" for i in range(NUM_BUCKETS)],
+        include_lowest=True,
+        right=False
+    )
+    return score_cols
+
+
+def place(src, dst, mode):
+    """Puts src at dst by copying, hardlinking or symlinking (hardlinks fall back to copying across devices)."""
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    else:
         shutil.copy2(src, dst)
-        print(f"Copied {fname} to {bucket_path}")
+
+
+def distribute(results_df, mode, workers):
+    # Skip images starting with 'foo' and images without a bucket
+    rows = results_df[~results_df['filename'].str.startswith('foo') & results_df['bucket'].notna()]
+
+    def place_row(row):
+        fname, bucket_label = row
+        try:
+            place(os.path.join(IMG_DIR, fname), os.path.join(BUCKETS_DIR, bucket_label, fname), mode)
+            return None
+        except Exception as e:
+            return f"Could not place {fname}: {e}"
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for error in pool.map(place_row, zip(rows['filename'], rows['bucket'].astype(str))):
+            if error:
+                print(error)
+    print(f"Placed {len(rows)} images into {BUCKETS_DIR} ({mode})")
+
+
+def load_thumbnail(path, size=THUMBNAIL_SIZE):
+    img = Image.open(path)
+    img.draft('RGB', (size, size))  # lets the JPEG decoder downscale while decoding
+    img = img.convert('RGB')
+    img.thumbnail((size, size))
+    return img
+
+
+def try_thumbnail(path, size=THUMBNAIL_SIZE):
+    """(thumbnail, None), or (gray placeholder, error message) if path cannot be read or decoded."""
+    try:
+        return load_thumbnail(path, size), None
     except Exception as e:
-        print(f"Could not copy {fname}: {e}")
+        return Image.new('RGB', (size, size), 'lightgray'), f"Could not load {path}: {e}"
 
-# Visualization: Show 5 random example images per bucket, label with stars
-star = '\u2605'  # Unicode for yellow star
-fig, axes = plt.subplots(NUM_BUCKETS, 5, figsize=(15, 3 * NUM_BUCKETS))
-fig.suptitle('5 Random Example Images per Quality Bucket', fontsize=16)
 
-for i, label in enumerate(results_df['bucket'].cat.categories):
+def bucket_images(label):
     bucket_path = os.path.join(BUCKETS_DIR, label)
-    images = [f for f in os.listdir(bucket_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    random.shuffle(images)
-    for j in range(5):
-        ax = axes[i, j] if NUM_BUCKETS > 1 else axes[j]
-        if j < len(images):
-            img_path = os.path.join(bucket_path, images[j])
-            try:
-                img = mpimg.imread(img_path)
-                ax.imshow(img)
-                ax.set_title(images[j], fontsize=8)
-                # Overlay label scores
-                img_row = results_df[results_df['filename'] == images[j]]
-                if not img_row.empty:
-                    label_scores = img_row.iloc[0][score_cols].values
-                    label_text = '\n'.join([
-                        f"{col}: {score:.2f}" for col, score in zip(score_cols, label_scores)
-                    ])
-                    ax.text(0.02, 0.98, label_text, transform=ax.transAxes, fontsize=7, color='white',
-                            verticalalignment='top', bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.2'))
-            except Exception as e:
+    return [f for f in os.listdir(bucket_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+
+
+def write_contact_sheets(results_df, scores, workers, size=THUMBNAIL_SIZE, columns=SHEET_COLUMNS, per_sheet=SHEET_THUMBNAILS):
+    """
+    Writes contact sheets of all images per bucket, sorted by score, as BUCKETS_DIR/<bucket>_001.jpg, _002.jpg, ...
+    with per_sheet thumbnails each, so memory and sheet size stay bounded however large a bucket is.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for label in results_df['bucket'].cat.categories:
+            images = sorted(bucket_images(label), key=lambda f: scores.loc[f, 'score'] if f in scores.index else 0)
+            n_sheets = (len(images) + per_sheet - 1) // per_sheet
+            for page, start in enumerate(range(0, len(images), per_sheet), 1):
+                page_images = images[start:start + per_sheet]
+                thumbs = pool.map(lambda f: try_thumbnail(os.path.join(BUCKETS_DIR, label, f), size), page_images)
+                rows = (len(page_images) + columns - 1) // columns
+                sheet = Image.new('RGB', (columns * size, rows * (size + 14)), 'white')
+                draw = ImageDraw.Draw(sheet)
+                for i, (fname, (thumb, error)) in enumerate(zip(page_images, thumbs)):
+                    if error:
+                        print(error)
+                    x, y = (i % columns) * size, (i // columns) * (size + 14)
+                    sheet.paste(thumb, (x + (size - thumb.width) // 2, y + (size - thumb.height) // 2))
+                    score = scores.loc[fname, 'score'] if fname in scores.index else float('nan')
+                    draw.text((x + 2, y + size), f"{score:.0f} {fname}"[:size // 6], fill='black')
+                sheet.save(os.path.join(BUCKETS_DIR, f'{label}_{page:03d}.jpg'), quality=85)
+            if images:
+                print(f"Contact sheets for bucket {label}: {n_sheets} as {os.path.join(BUCKETS_DIR, label)}_*.jpg "
+                      f"({len(images)} images)")
+
+
+def show_examples(results_df, scores, score_cols, headless):
+    import matplotlib
+    if headless:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    # Visualization: Show 5 random example images per bucket, label with stars
+    star = '\u2605'  # Unicode for yellow star
+    fig, axes = plt.subplots(NUM_BUCKETS, 5, figsize=(15, 3 * NUM_BUCKETS))
+    fig.suptitle('5 Random Example Images per Quality Bucket', fontsize=16)
+
+    for i, label in enumerate(results_df['bucket'].cat.categories):
+        images = bucket_images(label)
+        random.shuffle(images)
+        for j in range(5):
+            ax = axes[i, j] if NUM_BUCKETS > 1 else axes[j]
+            if j < len(images):
+                img_path = os.path.join(BUCKETS_DIR, label, images[j])
+                try:
+                    ax.imshow(load_thumbnail(img_path, 2 * THUMBNAIL_SIZE))
+                    ax.set_title(images[j], fontsize=8)
+                    # Overlay label scores
+                    if images[j] in scores.index:
+                        label_scores = scores.loc[images[j], score_cols].values
+                        label_text = '\n'.join([
+                            f"{col}: {score:.2f}" for col, score in zip(score_cols, label_scores)
+                        ])
+                        ax.text(0.02, 0.98, label_text, transform=ax.transAxes, fontsize=7, color='white',
+                                verticalalignment='top', bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.2'))
+                except Exception as e:
+                    ax.axis('off')
+                    ax.set_title('Error', fontsize=8)
+            else:
                 ax.axis('off')
-                ax.set_title('Error', fontsize=8)
-        else:
-            ax.axis('off')
-        ax.set_xticks([])
-        ax.set_yticks([])
-    # Set stars as ylabel for each bucket row
-    axes[i, 0].set_ylabel(star * (i + 1), rotation=0, size=24, labelpad=40, color='#FFD700')
-plt.tight_layout(rect=[0, 0, 1, 0.97])
-plt.show()
-
-print("Done. Images distributed into quality buckets.")
+            ax.set_xticks([])
+            ax.set_yticks([])
+        # Set stars as ylabel for each bucket row
+        axes[i, 0].set_ylabel(star * (i + 1), rotation=0, size=24, labelpad=40, color='#FFD700')
+    plt.tight_layout(rect=[0, 0, 1, 0.97])
+    if headless:
+        fig.savefig(os.path.join(BUCKETS_DIR, 'examples.png'))
+        print(f"Example overview saved to {os.path.join(BUCKETS_DIR, 'examples.png')}")
+    else:
+        plt.show()
+
+
+def main(mode='copy', workers=None, headless=False, contact_sheets=False):
+    # Delete output dir before starting
+    if os.path.exists(BUCKETS_DIR):
+        shutil.rmtree(BUCKETS_DIR)
+    os.makedirs(BUCKETS_DIR, exist_ok=True)
+
+    # Read inference results
+    results_df = pd.read_csv(INFER_CSV)
+    score_cols = score_results(results_df)
+    # Filename -> scores lookup for the visualizations
+    scores = results_df.drop_duplicates('filename').set_index('filename')
+
+    # Create bucket directories
+    for label in results_df['bucket'].cat.categories:
+        os.makedirs(os.path.join(BUCKETS_DIR, label), exist_ok=True)
+
+    distribute(results_df, mode, workers)
+    if contact_sheets:
+        write_contact_sheets(results_df, scores, workers)
+    show_examples(results_df, scores, score_cols, headless)
+
+    print("Done. Images distributed into quality buckets.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distribute images into quality buckets.")
+    parser.add_argument('--mode', choices=['copy', 'hardlink', 'symlink'], default='copy', help='How images are placed into the bucket directories')
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads for placing files and loading thumbnails')
+    parser.add_argument('--headless', action='store_true', help=f'Save the example overview to {BUCKETS_DIR}/examples.png instead of showing it')
+    parser.add_argument('--contact-sheets', action='store_true', help=f'Write contact sheets of all images per bucket to {BUCKETS_DIR}/<bucket>_001.jpg, ...')
+    args = parser.parse_args()
+    main(args.mode, args.workers, args.headless, args.contact_sheets)
@@ -6,6 +6,7 @@ Edit the LABELS list to match your use case.
 """
 import os
 import csv
+import argparse
 
 # Directory containing your images
 IMG_DIR = 'datasets/multi-label/photos'
@@ -14,14 +15,25 @@ CSV_PATH = os.path.join(IMG_DIR, '..', 'labels_template.csv')
 # List your multi-labels here
 LABELS = ['dark-background', 'white-shirt', 'glasses']
 
-# Find all image files
-image_files = [f for f in os.listdir(IMG_DIR) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
 
-# Write CSV
-with open(CSV_PATH, 'w', newline='') as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(['filename'] + LABELS)
-    for fname in sorted(image_files):
-        writer.writerow(['photos/' + fname] + [''] * len(LABELS))
+def main(img_dir=IMG_DIR, csv_path=CSV_PATH, labels=LABELS):
+    # Find all image files
+    image_files = [f for f in os.listdir(img_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
 
-print(f"CSV template created: {CSV_PATH} ({len(image_files)} images)")
+    # Write CSV
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['filename'] + labels)
+        for fname in sorted(image_files):
+            writer.writerow(['photos/' + fname] + [''] * len(labels))
+
+    print(f"CSV template created: {csv_path} ({len(image_files)} images)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a CSV template for multi-label annotation.")
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the photos to label')
+    parser.add_argument('--output', default=CSV_PATH, help='CSV template to write')
+    parser.add_argument('--labels', nargs='+', default=LABELS, help='Label columns of the template')
+    args = parser.parse_args()
+    main(args.img_dir, args.output, args.labels)
@@ -0,0 +1,111 @@
+"""
+crop_cache.py
+
+Inference cache of images after intelligent_center_crop, stored as uint8 arrays in memory-mapped .npy shards.
+Entries are keyed by the SHA-256 of the source file and the crop parameters, so a changed image is re-cropped
+automatically on its next lookup. Cached arrays are returned as read-only views into the shards without copying.
+infer.py and infer_multilabel.py use it with --crop-cache. Training does not: the training scripts' --crop-cache keeps
+the cropped images of their tf.data pipelines in tf.data cache files (data_pipeline.cache_path), which tf.data reads
+sequentially and which every worker process writes on its own, so this cache's shared index is not involved.
+Importing it loads no TensorFlow.
+Usage:
+    cache = CropCache('.crop_cache')
+    arr = cache.get('datasets/multi-label/photos/foo.jpg')  # (224, 224, 3) uint8
+    cache.flush()
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from preprocess import intelligent_center_crop, IMG_SIZE
+
+CACHE_DIR = '.crop_cache'
+# Number of images per shard file
+SHARD_SIZE = 1024
+INDEX_FILE = 'index.json'
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CropCache:
+    def __init__(self, cache_dir=CACHE_DIR, target_size=IMG_SIZE, shard_size=SHARD_SIZE):
+        self.cache_dir = cache_dir
+        self.target_size = target_size
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        else:
+            index = {'shards': [], 'entries': {}, 'files': {}}
+        self.shards = index['shards']  # shard file names
+        self.entries = index['entries']  # key -> [shard number, row]
+        self.files = index['files']  # path -> [mtime_ns, size, sha256], avoids re-hashing unchanged files
+        self.mmaps = {}
+        self.pending = {}  # key -> array not yet written to a shard
+
+    def key(self, path):
+        st = os.stat(path)
+        stamp = self.files.get(os.path.abspath(path))
+        if stamp and stamp[0] == st.st_mtime_ns and stamp[1] == st.st_size:
+            digest = stamp[2]
+        else:
+            digest = file_hash(path)
+            with self.lock:
+                self.files[os.path.abspath(path)] = [st.st_mtime_ns, st.st_size, digest]
+        return f'{digest}-{self.target_size}-lanczos'
+
+    def shard(self, number):
+        if number not in self.mmaps:
+            self.mmaps[number] = np.load(os.path.join(self.cache_dir, self.shards[number]), mmap_mode='r')
+        return self.mmaps[number]
+
+    def get(self, path):
+        """Returns the cropped image for path as a (target_size, target_size, 3) uint8 array."""
+        key = self.key(path)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if key in self.entries:
+                number, row = self.entries[key]
+                return self.shard(number)[row]
+        arr = intelligent_center_crop(Image.open(path), self.target_size).astype(np.uint8)
+        with self.lock:
+            self.pending[key] = arr
+            if len(self.pending) >= self.shard_size:
+                self._write_shard()
+        return arr
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self._write_shard()
+            else:
+                self._write_index()
+
+    def _write_shard(self):
+        number = len(self.shards)
+        name = f'shard_{number:05d}.npy'
+        keys = list(self.pending)
+        np.save(os.path.join(self.cache_dir, name), np.stack([self.pending[k] for k in keys]))
+        self.shards.append(name)
+        for row, key in enumerate(keys):
+            self.entries[key] = [number, row]
+        self.pending = {}
+        self._write_index()
+
+    def _write_index(self):
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'shards': self.shards, 'entries': self.entries, 'files': self.files}, f)
+        os.replace(index_path + '.tmp', index_path)
@@ -0,0 +1,317 @@
+"""
+data_pipeline.py
+
+tf.data input pipelines for train.py and train_multilabel.py.
+Images are decoded, center cropped and resized in parallel map calls, augmented per batch inside TensorFlow and
+prefetched with AUTOTUNE. Decoding and cropping run preprocess.intelligent_center_crop on the PIL image (PIL releases
+the GIL while it decodes and resizes), so the model trains on exactly the pixels infer*.py and scoring_server.py score.
+Uses the augmentation policies of preprocess.py (ImageDataGenerator settings) and the batch samplers from sampler.py.
+The multi-label pipeline can also read the TFRecord shards of packed_dataset.py.
+Augmentation is seeded per batch with stateless random ops and the shuffles and samplers use the same seed, so a
+pipeline yields the same batches with the same transforms on every run. Each class has its own policy: the binary
+pipeline augments compliant and non-compliant images differently, and the multi-label pipeline can treat photos with
+every label present as compliant and all others as non-compliant.
+"""
+import io
+import os
+import math
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from preprocess import IMG_SIZE, BATCH_SIZE, DATASET_DIR, COMPLIANT_AUGMENTATION, NONCOMPLIANT_AUGMENTATION, intelligent_center_crop
+from embedding_cache import fingerprint, array_hash
+from packed_dataset import MANIFEST_FILE, read_manifest, record_features
+from sampler import list_class_files, split_files, BalancedSampler, WeightedSampler, label_balancing_weights
+
+AUTOTUNE = tf.data.AUTOTUNE
+# Shuffle buffer (in images) used when decoded images are cached, so the cache is not re-read in file order
+SHUFFLE_BUFFER = 1024
+AUGMENT_SEED = 42
+# Part of every cache key, so tf.data caches of an earlier crop implementation are not reused
+CROP_METHOD = 'pil-lanczos'
+
+
+def load_and_crop(path, img_size=IMG_SIZE):
+    """Decodes an image and applies intelligent_center_crop (center square, LANCZOS resize), returning uint8."""
+    return decode_and_crop(tf.io.read_file(path), img_size)
+
+
+def crop_bytes(contents, img_size=IMG_SIZE):
+    """intelligent_center_crop of encoded image bytes, as uint8."""
+    return intelligent_center_crop(Image.open(io.BytesIO(contents)), int(img_size)).astype(np.uint8)
+
+
+def decode_and_crop(contents, img_size=IMG_SIZE):
+    """load_and_crop for encoded image bytes, e.g. from a packed dataset."""
+    img = tf.numpy_function(crop_bytes, [contents, img_size], tf.uint8, stateful=False)
+    return tf.ensure_shape(img, [img_size, img_size, 3])
+
+
+def _matrices(rows):
+    """Stacks nested lists of [batch] tensors into a [batch, 3, 3] tensor."""
+    return tf.stack([tf.stack(row, axis=-1) for row in rows], axis=-2)
+
+
+def random_uniform(seed=None):
+    """tf.random.uniform, or for a [2] seed a stateless version that folds a call counter into the seed."""
+    if seed is None:
+        return tf.random.uniform
+    seed = tf.cast(seed, tf.int64)
+    calls = iter(range(1 << 30))
+    return lambda shape, minval=0, maxval=1: tf.random.stateless_uniform(
+        shape, tf.random.experimental.stateless_fold_in(seed, next(calls)), minval, maxval)
+
+
+def batch_seed(seed, step):
+    """Seed of the step-th batch of a pipeline seeded with seed."""
+    return tf.stack([tf.constant(seed, tf.int64), tf.cast(step, tf.int64)])
+
+
+def random_affine_transforms(batch_size, height, width, policy, draw=tf.random.uniform):
+    """Random transforms as in ImageDataGenerator.get_random_transform, in ImageProjectiveTransformV3 layout."""
+    def uniform(limit):
+        return draw([batch_size], -limit, limit)
+    zeros = tf.zeros([batch_size])
+    ones = tf.ones([batch_size])
+    theta = uniform(policy.get('rotation_range', 0)) * (math.pi / 180)
+    tx = uniform(policy.get('height_shift_range', 0)) * height
+    ty = uniform(policy.get('width_shift_range', 0)) * width
+    shear = uniform(policy.get('shear_range', 0)) * (math.pi / 180)
+    zoom = policy.get('zoom_range', 0)
+    zx = draw([batch_size], 1 - zoom, 1 + zoom)
+    zy = draw([batch_size], 1 - zoom, 1 + zoom)
+    # Same matrix chain as keras' apply_affine_transform. Keras swaps rows and columns of the final matrix before
+    # applying it to (row, col) indices, i.e. it acts on (col, row) = (x, y), the layout the projective transform expects.
+    rotation_matrix = _matrices([[tf.cos(theta), -tf.sin(theta), zeros], [tf.sin(theta), tf.cos(theta), zeros], [zeros, zeros, ones]])
+    shift_matrix = _matrices([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    shear_matrix = _matrices([[ones, -tf.sin(shear), zeros], [zeros, tf.cos(shear), zeros], [zeros, zeros, ones]])
+    zoom_matrix = _matrices([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+    o_x, o_y = height / 2 + 0.5, width / 2 + 0.5
+    offset = tf.convert_to_tensor([[1.0, 0.0, o_x], [0.0, 1.0, o_y], [0.0, 0.0, 1.0]])
+    reset = tf.convert_to_tensor([[1.0, 0.0, -o_x], [0.0, 1.0, -o_y], [0.0, 0.0, 1.0]])
+    matrix = offset @ rotation_matrix @ shift_matrix @ shear_matrix @ zoom_matrix @ reset
+    return tf.concat([tf.reshape(matrix[:, :2, :], [batch_size, 6]), tf.zeros([batch_size, 2])], axis=1)
+
+
+def policy_for_labels(policies, labels):
+    """Per-sample augmentation settings: policies[label] for every label of the batch."""
+    def gather(key, default):
+        return tf.gather(tf.constant([float(p.get(key, default)) for p in policies]), labels)
+    return {
+        'rotation_range': gather('rotation_range', 0),
+        'height_shift_range': gather('height_shift_range', 0),
+        'width_shift_range': gather('width_shift_range', 0),
+        'shear_range': gather('shear_range', 0),
+        'zoom_range': gather('zoom_range', 0),
+        'horizontal_flip': tf.gather(tf.constant([bool(p.get('horizontal_flip', False)) for p in policies]), labels),
+        'brightness_range': (
+            tf.gather(tf.constant([float(p.get('brightness_range', (1, 1))[0]) for p in policies]), labels)[:, None, None, None],
+            tf.gather(tf.constant([float(p.get('brightness_range', (1, 1))[1]) for p in policies]), labels)[:, None, None, None]
+        )
+    }
+
+
+def augment_batch(images, policy, seed=None):
+    """
+    Applies an ImageDataGenerator augmentation policy to a uint8 batch, returning float32 in [0, 255].
+    The policy values are either scalars or per-sample tensors (see policy_for_labels). With a [2] seed the
+    transforms only depend on the seed.
+    """
+    draw = random_uniform(seed)
+    images = tf.cast(images, tf.float32)
+    batch_size, height, width = tf.shape(images)[0], tf.shape(images)[1], tf.shape(images)[2]
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=random_affine_transforms(batch_size, tf.cast(height, tf.float32), tf.cast(width, tf.float32), policy, draw),
+        output_shape=tf.shape(images)[1:3],
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST'
+    )
+    if 'horizontal_flip' in policy:
+        flip = tf.logical_and(draw([batch_size]) < 0.5, policy['horizontal_flip'])
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, axis=[2]), images)
+    if 'brightness_range' in policy:
+        low, high = policy['brightness_range']
+        images = images * (low + draw([batch_size, 1, 1, 1]) * (high - low))
+    return tf.round(tf.clip_by_value(images, 0, 255))
+
+
+def cache_path(cache_dir, name, paths, img_size=IMG_SIZE, labels=None, extra=()):
+    """
+    tf.data cache file for paths; the name changes whenever one of the files, the crop size or method, the labels
+    cached with the images or extra changes.
+    """
+    if cache_dir is None:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    if labels is not None:
+        extra = (*extra, array_hash(labels))
+    return os.path.join(cache_dir, f'{name}_{img_size}_{fingerprint(paths, CROP_METHOD, *extra)[:16]}')
+
+
+def image_dataset(paths, labels=None, shuffle=False, cache=None, img_size=IMG_SIZE, seed=None):
+    """Unbatched dataset of cropped uint8 images (and labels), optionally cached after cropping and shuffled with seed."""
+    if labels is None:
+        ds = tf.data.Dataset.from_tensor_slices(paths)
+        load = lambda path: load_and_crop(path, img_size)
+    else:
+        ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+        load = lambda path, y: (load_and_crop(path, img_size), y)
+    if cache is None:
+        if shuffle:
+            ds = ds.shuffle(len(paths), seed=seed)
+        return ds.map(load, num_parallel_calls=AUTOTUNE)
+    ds = ds.map(load, num_parallel_calls=AUTOTUNE).cache(cache)
+    return ds.shuffle(SHUFFLE_BUFFER, seed=seed) if shuffle else ds
+
+
+def packed_image_dataset(pack_dir, filenames, labels, shuffle=False, cache=None, img_size=IMG_SIZE, seed=None):
+    """
+    Unbatched dataset of cropped uint8 images and label vectors for filenames, read from a packed dataset.
+    Records replaced by a later append and records of other filenames are skipped.
+    """
+    manifest = read_manifest(pack_dir)
+    if list(labels) != manifest['labels']:
+        raise ValueError(f"{pack_dir} holds labels {manifest['labels']}, not {list(labels)}")
+    records = manifest['records']
+    missing = [f for f in filenames if f not in records]
+    if missing:
+        raise ValueError(f"{len(missing)} images (e.g. {missing[0]}) are not in {pack_dir}, run packed_dataset.py first")
+    current = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(list(filenames), [records[f][0] for f in filenames]), default_value='')
+    features = record_features(len(labels))
+    shards = [os.path.join(pack_dir, shard['file']) for shard in manifest['shards']]
+    ds = tf.data.Dataset.from_tensor_slices(shards)
+    if shuffle:
+        ds = ds.shuffle(len(shards), seed=seed)
+    # Unseeded shuffles may also interleave the shards in whatever order they are read
+    ds = ds.interleave(tf.data.TFRecordDataset, num_parallel_calls=AUTOTUNE, deterministic=not shuffle or seed is not None)
+    ds = ds.map(lambda record: tf.io.parse_single_example(record, features), num_parallel_calls=AUTOTUNE)
+    ds = ds.filter(lambda r: tf.equal(current.lookup(r['filename']), r['key']))
+    # Exactly one current record per filename passes the filter
+    ds = ds.apply(tf.data.experimental.assert_cardinality(len(filenames)))
+    ds = ds.map(lambda r: (decode_and_crop(r['image'], img_size), r['labels']), num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        ds = ds.cache(cache)
+    return ds.shuffle(SHUFFLE_BUFFER, seed=seed) if shuffle else ds
+
+
+def shard_rows(rows, shard):
+    """Every count-th row starting at index for shard=(index, count), all rows for shard=None."""
+    if shard is None:
+        return rows
+    index, count = shard
+    return rows.iloc[index::count] if hasattr(rows, 'iloc') else rows[index::count]
+
+
+def get_datasets(dataset_dir=DATASET_DIR, cache_dir=None, class_ratios=(0.5, 0.5), img_size=IMG_SIZE,
+                 seed=AUGMENT_SEED, batch_size=BATCH_SIZE, shard=None):
+    """
+    Input pipeline of train.py: (balanced train dataset, val dataset, steps_per_epoch).
+    A single stream picks images from the per-class datasets in the order given by a BalancedSampler, so every
+    batch holds the configured share of each class and is augmented with each image's class policy.
+    With shard=(index, count) only every count-th image of each class and split is read, for one of count
+    data-parallel workers; its augmentation is seeded differently from the other workers'.
+    """
+    worker = '' if shard is None else f'_worker{shard[0]}of{shard[1]}'
+    if shard is not None:
+        seed += shard[0]
+    policies = [COMPLIANT_AUGMENTATION, NONCOMPLIANT_AUGMENTATION]
+    class_datasets = []
+    train_sizes = []
+    val_files, val_labels = [], []
+    for label, cls in enumerate(['compliant', 'non-compliant']):
+        train_files, cls_val_files = split_files(list_class_files(dataset_dir, cls))
+        train_files, cls_val_files = shard_rows(train_files, shard), shard_rows(cls_val_files, shard)
+        train_labels = np.full(len(train_files), label, dtype=np.int32)
+        ds = image_dataset(train_files, train_labels, shuffle=True, img_size=img_size, seed=seed,
+                           cache=cache_path(cache_dir, f'train_{cls}{worker}', train_files, img_size, train_labels))
+        class_datasets.append(ds.repeat())
+        train_sizes.append(len(train_files))
+        val_files += cls_val_files
+        val_labels += [float(label)] * len(cls_val_files)
+    groups = np.split(np.arange(sum(train_sizes)), np.cumsum(train_sizes)[:-1])
+    sampler = BalancedSampler(groups, class_ratios, batch_size, seed=seed)
+    choices = tf.data.Dataset.from_generator(sampler.batch_groups, output_signature=tf.TensorSpec([None], tf.int64)).unbatch()
+
+    def augment(step, batch):
+        x, y = batch
+        x = augment_batch(x, policy_for_labels(policies, y), batch_seed(seed, step))
+        return x / 255.0, tf.cast(y, tf.float32)
+
+    train_ds = tf.data.Dataset.choose_from_datasets(class_datasets, choices).batch(batch_size).enumerate()
+    train_ds = train_ds.map(augment, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    val_labels = np.array(val_labels, dtype=np.float32)
+    val_ds = image_dataset(val_files, val_labels, cache=cache_path(cache_dir, f'val{worker}', val_files, img_size, val_labels),
+                           img_size=img_size)
+    val_ds = val_ds.batch(batch_size).map(lambda x, y: (tf.cast(x, tf.float32) / 255.0, y), num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    return train_ds, val_ds, sampler.steps_per_epoch
+
+
+def get_multilabel_datasets(train_df, val_df, img_dir, labels, batch_size, cache_dir=None, rebalance=False,
+                            img_size=IMG_SIZE, packed_dir=None, augment=None, seed=AUGMENT_SEED, shard=None):
+    """
+    (train dataset, val dataset, steps_per_epoch) of rescaled images and label vectors for the multi-label classifier.
+    With rebalance=True the training batches are drawn endlessly with label_balancing_weights (not cached) and
+    steps_per_epoch is set; otherwise the training dataset is finite and steps_per_epoch is None.
+    With packed_dir the images and labels are read from the shards of packed_dataset.py instead of img_dir.
+    With an augmentation policy (e.g. COMPLIANT_AUGMENTATION) every training batch is augmented in-graph, seeded by seed.
+    With a list of two policies (compliant, non-compliant) photos with every label present get the first, all others
+    the second. The training shuffles and the rebalancing sampler are seeded by seed as well.
+    With shard=(index, count) only every count-th row of train_df and val_df is read, like get_datasets.
+    """
+    train_df, val_df = shard_rows(train_df, shard), shard_rows(val_df, shard)
+    # Workers of a distributed run each cache their own shard
+    worker = '' if shard is None else f'_worker{shard[0]}of{shard[1]}'
+    if shard is not None:
+        seed += shard[0]
+
+    def rescale(x, y):
+        return tf.cast(x, tf.float32) / 255.0, y
+
+    def augment_rescale(step, batch):
+        x, y = batch
+        policy = augment
+        if isinstance(augment, (list, tuple)):
+            policy = policy_for_labels(augment, tf.cast(tf.reduce_any(y < 0.5, axis=1), tf.int32))
+        return augment_batch(x, policy, batch_seed(seed, step)) / 255.0, y
+
+    def finish(ds, train):
+        ds = ds.batch(batch_size)
+        if train and augment is not None:
+            ds = ds.enumerate().map(augment_rescale, num_parallel_calls=AUTOTUNE)
+        else:
+            ds = ds.map(rescale, num_parallel_calls=AUTOTUNE)
+        return ds.prefetch(AUTOTUNE)
+
+    def dataset(df, name, shuffle):
+        name += worker
+        if packed_dir is not None:
+            # The manifest covers the packed images and labels, the filenames the split
+            cache = cache_path(cache_dir, name, [os.path.join(packed_dir, MANIFEST_FILE)], img_size,
+                               extra=(sorted(df['filename']),))
+            return finish(packed_image_dataset(packed_dir, list(df['filename']), labels, shuffle=shuffle, cache=cache,
+                                               img_size=img_size, seed=seed), shuffle)
+        paths = [os.path.join(img_dir, f) for f in df['filename']]
+        y = df[list(labels)].to_numpy(dtype=np.float32)
+        ds = image_dataset(paths, y, shuffle=shuffle, cache=cache_path(cache_dir, name, paths, img_size, y), img_size=img_size,
+                           seed=seed)
+        return finish(ds, shuffle)
+
+    def rebalanced_dataset(df):
+        paths = tf.constant([os.path.join(img_dir, f) for f in df['filename']])
+        y = df[list(labels)].to_numpy(dtype=np.float32)
+        sampler = WeightedSampler(label_balancing_weights(y), batch_size, seed=seed)
+        y = tf.constant(y)
+        ds = tf.data.Dataset.from_generator(lambda: iter(sampler), output_signature=tf.TensorSpec([None], tf.int64)).unbatch()
+        ds = ds.map(lambda i: (load_and_crop(tf.gather(paths, i), img_size), tf.gather(y, i)), num_parallel_calls=AUTOTUNE)
+        return finish(ds, True), sampler.steps_per_epoch
+
+    if rebalance and packed_dir is not None:
+        raise ValueError('rebalance needs random access to the images and cannot read a packed dataset')
+    if rebalance:
+        train_ds, steps_per_epoch = rebalanced_dataset(train_df)
+    else:
+        train_ds, steps_per_epoch = dataset(train_df, 'multilabel_train', True), None
+    return train_ds, dataset(val_df, 'multilabel_val', False), steps_per_epoch
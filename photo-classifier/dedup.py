@@ -0,0 +1,355 @@
+"""
+dedup.py
+
+Finds near-duplicate photos and groups them, so train/validation splits never put two versions of the same photo
+on different sides. Two signals are available:
+    phash      64-bit difference hash (dHash) of the grayscale photo, near-duplicates differ in few bits
+    embedding  pooled backbone features (embedding_cache.feature_model), near-duplicates have a high cosine
+               similarity; this also catches the crops, flips and color changes of the augmented export
+Both are stored per content hash in a SQLite index (like score_index.py), so a rerun only processes new or changed
+files. Near neighbours are found without comparing all pairs: codes are split into bands and only photos sharing
+a band value are compared (multi-index hashing for the dHash, random-hyperplane LSH for the embeddings).
+The dHash is split into m substrings and every pair within max_distance bits matches in one of them within
+max_distance // m bits, so probing each substring table with those bit flips finds all pairs; see phash_pairs for
+the cost. Embedding buckets are only compared within a
+window of MAX_BUCKET photos, so recall drops when buckets grow larger; the number of such buckets is reported.
+Pairs are verified exactly and merged into groups (connected components); groups are written to a CSV. Photos that
+cannot be read are reported and left out of the CSV, so split_dataframe treats them as a group of their own.
+split_dataframe then splits a labels CSV by group instead of by row; train_multilabel.py, tune_multilabel.py and
+evaluate.py use it with --groups.
+Usage:
+    python dedup.py
+    python dedup.py --dirs datasets/multi-label/photos datasets/multi-label/augmented --method phash embedding
+    python train_multilabel.py --groups duplicate_groups.csv
+"""
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from math import comb
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.model_selection import GroupShuffleSplit, train_test_split
+from sampler import IMAGE_EXTENSIONS
+from score_index import ScoreIndex, model_version
+
+IMG_DIRS = ['datasets/multi-label/photos']
+INDEX_PATH = 'dedup.sqlite'
+GROUPS_PATH = 'duplicate_groups.csv'
+# dHash bits two photos may differ in to count as duplicates
+MAX_DISTANCE = 6
+# Cosine similarity of the embeddings from which two photos count as duplicates
+MIN_SIMILARITY = 0.95
+EMBEDDING_BACKBONE = 'efficientnetb0'
+# LSH bands of the embeddings, each BAND_BITS random hyperplanes; more bands find more pairs at a lower similarity
+LSH_BANDS = 20
+BAND_BITS = 16
+# Within an embedding band bucket every photo is compared with its next MAX_BUCKET - 1 neighbours, so a bucket of
+# thousands of photos does not turn into an all-pairs comparison of float vectors
+MAX_BUCKET = 64
+# dHash substring probes and candidate pairs handled at once
+PHASH_BLOCK = 1 << 22
+# dHash substrings up to this many bits are looked up in a table of 2 ** DIRECT_BITS run starts
+DIRECT_BITS = 24
+BATCH_SIZE = 64
+# Threads decoding photos for the dHash
+WORKERS = 16
+
+
+def list_images(img_dirs):
+    paths = []
+    for img_dir in img_dirs:
+        for subdir, _, fnames in sorted(os.walk(img_dir), key=lambda w: w[0]):
+            paths += [os.path.normpath(os.path.join(subdir, f)) for f in sorted(fnames)
+                      if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return paths
+
+
+def dhash(path):
+    """64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour."""
+    with Image.open(path) as img:
+        img.draft('L', (64, 64))  # decodes JPEGs at reduced scale
+        pixels = np.asarray(img.convert('L').resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big', signed=True)  # signed: fits an SQLite INTEGER
+
+
+def try_dhash(path):
+    """dhash, or None (reported) for a photo that cannot be decoded."""
+    try:
+        return dhash(path)
+    except Exception as e:
+        print(f"Could not hash {path}: {e}")
+        return None
+
+
+class DedupIndex(ScoreIndex):
+    """ScoreIndex file table plus dHashes and embeddings per content hash."""
+
+    def __init__(self, db_path=INDEX_PATH):
+        super().__init__(db_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS phashes (content_hash TEXT PRIMARY KEY, phash INTEGER);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                content_hash TEXT, model_version TEXT, vector BLOB, PRIMARY KEY (content_hash, model_version));
+        """)
+
+    def phashes(self, paths, workers=WORKERS):
+        """
+        (uint64 dHash of every path, whether it could be read), computing only the ones not in the index.
+        Unreadable photos are reported and get a dHash of 0.
+        """
+        hashes = [self.try_content_hash(p) for p in paths]
+        known = dict(self.db.execute('SELECT content_hash, phash FROM phashes'))
+        todo = {h: p for h, p in zip(hashes, paths) if h is not None and h not in known}
+        print(f"dHash: {len(paths) - len(todo)} of {len(paths)} photos indexed, {len(todo)} to hash")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for h, value in zip(todo, executor.map(try_dhash, todo.values())):
+                if value is not None:
+                    known[h] = value
+                    self.db.execute('INSERT OR REPLACE INTO phashes VALUES (?, ?)', (h, value))
+        self.db.commit()
+        readable = np.array([h in known for h in hashes], dtype=bool)
+        return np.array([known.get(h, 0) for h in hashes], dtype=np.int64).view(np.uint64), readable
+
+    def embeddings(self, paths, model_path=None, backbone=EMBEDDING_BACKBONE):
+        """
+        (L2-normalized float32 features of every path, whether it could be read), computing only the ones not in
+        the index. Unreadable photos get zero features.
+        """
+        version = model_version(model_path) if model_path else f'{backbone}-imagenet'
+        hashes = [self.try_content_hash(p) for p in paths]
+        known = {h: v for h, v in self.db.execute(
+            'SELECT content_hash, vector FROM embeddings WHERE model_version = ?', (version,))}
+        todo = {h: p for h, p in zip(hashes, paths) if h is not None and h not in known}
+        print(f"Embeddings ({version}): {len(paths) - len(todo)} of {len(paths)} photos indexed, {len(todo)} to compute")
+        if todo:
+            todo_hashes = list(todo)
+            for i, (k, vector) in enumerate(compute_features(list(todo.values()), model_path, backbone)):
+                h = todo_hashes[k]
+                known[h] = vector.astype(np.float16).tobytes()  # half the size; plenty for cosine similarity
+                self.db.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)', (h, version, known[h]))
+                if i % 1024 == 1023:
+                    self.db.commit()  # an interrupted run keeps what it computed
+            self.db.commit()
+            for h, p in todo.items():
+                if h not in known:
+                    print(f"Could not compute the embedding of {p}")
+        readable = np.array([h in known for h in hashes], dtype=bool)
+        dims = len(next(iter(known.values()))) // 2 if known else 0
+        zeros = np.zeros(dims, dtype=np.float16)
+        features = np.stack([np.frombuffer(known[h], dtype=np.float16) if h in known else zeros for h in hashes]
+                            ).reshape(len(hashes), dims).astype(np.float32)
+        return features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12), readable
+
+
+def compute_features(paths, model_path=None, backbone=EMBEDDING_BACKBONE):
+    """Yields (position in paths, pooled backbone features) of the photos that can be decoded, batch by batch."""
+    import tensorflow as tf
+    from data_pipeline import image_dataset, AUTOTUNE
+    from embedding_cache import feature_model
+    if model_path:
+        from tensorflow.keras.models import load_model
+        model = load_model(model_path)
+    else:
+        from model_factory import build_model
+        model = build_model(1, backbone)
+    extractor = feature_model(model)
+    # The position rides along as the label; photos that fail to decode are dropped instead of ending the run
+    ds = image_dataset(paths, np.arange(len(paths)), img_size=model.input_shape[1]).ignore_errors().batch(BATCH_SIZE)
+    ds = ds.map(lambda x, k: (tf.cast(x, tf.float32) / 255.0, k), num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    done = 0
+    for x, k in ds:
+        features = np.asarray(extractor.predict_on_batch(x), dtype=np.float32)
+        yield from zip(k.numpy(), features)
+        done += len(features)
+        print(f"\rComputing embeddings {done}/{len(paths)}", end='', flush=True)
+    print()
+
+
+def bit_keys(bits, n_bands):
+    """(n_bands, N) integer keys of consecutive bit ranges of bits (N, n_bits)."""
+    bounds = np.linspace(0, bits.shape[1], n_bands + 1).astype(int)
+    return np.stack([bits[:, a:b].astype(np.int64) @ (1 << np.arange(b - a, dtype=np.int64))
+                     for a, b in zip(bounds[:-1], bounds[1:])])
+
+
+def lsh_keys(features, n_bands=LSH_BANDS, band_bits=BAND_BITS, seed=0, chunk=65536):
+    """Random-hyperplane LSH bands of the features; the higher the cosine similarity the more bands match."""
+    planes = np.random.default_rng(seed).standard_normal((features.shape[1], n_bands * band_bits)).astype(np.float32)
+    return np.concatenate([bit_keys(features[start:start + chunk] @ planes > 0, n_bands)
+                           for start in range(0, len(features), chunk)], axis=1)
+
+
+def candidate_pairs(keys, max_bucket=MAX_BUCKET):
+    """
+    Unique (i, j) pairs, i < j, of items sharing a key in any band. Items of a bucket are paired with their next
+    max_bucket - 1 neighbours only; the buckets that were larger are counted and reported.
+    """
+    pairs = []
+    truncated = 0
+    for band in keys:
+        order = np.argsort(band, kind='stable')
+        sorted_keys = band[order]
+        truncated += int(np.sum(np.unique(sorted_keys, return_counts=True)[1] > max_bucket))
+        # Pair every item with the one offset places later in the same bucket
+        for offset in range(1, min(max_bucket, len(band))):
+            same = np.nonzero(sorted_keys[:-offset] == sorted_keys[offset:])[0]
+            if not len(same):
+                break  # no bucket holds more than offset items
+            pairs.append(np.stack([order[same], order[same + offset]], axis=1))
+    if truncated:
+        print(f"{truncated} band buckets held more than {max_bucket} items and were only compared within a window")
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.sort(np.concatenate(pairs), axis=1), axis=0)
+
+
+def flip_masks(n_bits, radius):
+    """All n_bits-bit masks with at most radius bits set."""
+    return np.array([sum(1 << k for k in bits) for r in range(radius + 1) for bits in combinations(range(n_bits), r)],
+                    dtype=np.uint64)
+
+
+def phash_bands(n, max_distance=MAX_DISTANCE):
+    """
+    Number of dHash substrings for n photos. Split into m substrings, codes within max_distance bits match one of
+    them within max_distance // m bits (pigeonhole). More substrings mean fewer flip masks to probe but shorter keys,
+    so more photos sharing a key; m minimizes the expected probes plus candidates per photo for uniform codes.
+    """
+    def cost(m):
+        bits = 64 // m
+        return m * sum(comb(bits, k) for k in range(max_distance // m + 1)) * (1 + n / 2 ** bits)
+    return min(range(1, max_distance + 2), key=cost)
+
+
+def bucket_ranges(sorted_keys, probes, starts=None):
+    """(first position, count) of each probe's run in sorted_keys, looked up in starts if given."""
+    if starts is not None:
+        probes = probes.astype(np.int64)
+        return starts[probes], starts[probes + 1] - starts[probes]
+    lo = np.searchsorted(sorted_keys, probes, side='left')
+    return lo, np.searchsorted(sorted_keys, probes, side='right') - lo
+
+
+def phash_pairs(phashes, max_distance=MAX_DISTANCE, block=PHASH_BLOCK):
+    """
+    All unique (i, j) pairs, i < j, within max_distance bits (multi-index hashing). The codes are split into
+    phash_bands substrings; every photo probes each sorted substring table with its own substring XOR each flip mask,
+    and the photos found are verified on the full code, block by block. For N photos with spread-out codes this costs
+    about N * probes, e.g. some 1100 probes and candidates per photo for a million photos at 6 bits instead of
+    a million comparisons; photos sharing the same code (exact copies) are still compared with each other, which
+    costs the square of the number of copies.
+    """
+    n = len(phashes)
+    n_bands = phash_bands(n, max_distance)
+    radius = max_distance // n_bands
+    bounds = np.linspace(0, 64, n_bands + 1).astype(int)
+    pairs = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        keys = (phashes >> np.uint64(64 - b)) & np.uint64((1 << (b - a)) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # Start of every key's run of photos; a direct lookup for short keys instead of two binary searches per probe
+        starts = np.searchsorted(sorted_keys, np.arange(2 ** (b - a) + 1)) if b - a <= DIRECT_BITS else None
+        masks = flip_masks(b - a, radius)
+        rows = max(1, block // len(masks))
+        for start in range(0, n, rows):
+            probes = keys[start:start + rows, None] ^ masks[None, :]
+            lo, counts = bucket_ranges(sorted_keys, probes.ravel(), starts)
+            queries = np.repeat(np.arange(start, start + len(probes)), len(masks))
+            # Expand the matches in slices of about block candidates, so a large bucket does not exhaust memory
+            ends = np.cumsum(counts)
+            cuts = np.r_[0, np.searchsorted(ends, np.arange(block, ends[-1], block)), len(counts)]
+            for c0, c1 in zip(cuts[:-1], cuts[1:]):
+                c = counts[c0:c1]
+                i = np.repeat(queries[c0:c1], c)
+                first = np.repeat(lo[c0:c1] - (np.cumsum(c) - c), c)
+                j = order[first + np.arange(len(i))]
+                keep = (i < j) & (np.bitwise_count(phashes[i] ^ phashes[j]) <= max_distance)
+                pairs.append(np.stack([i[keep], j[keep]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def verify_embedding(features, pairs, min_similarity=MIN_SIMILARITY, chunk=1 << 20):
+    keep = [np.einsum('ij,ij->i', features[p[:, 0]], features[p[:, 1]]) >= min_similarity
+            for p in (pairs[start:start + chunk] for start in range(0, len(pairs), chunk))]
+    return pairs[np.concatenate(keep)] if keep else pairs
+
+
+def connected_groups(n, pairs):
+    """Group id per item; items linked directly or through other items by pairs share a group."""
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def find_groups(paths, index, methods=('phash',), max_distance=MAX_DISTANCE, min_similarity=MIN_SIMILARITY,
+                model_path=None, workers=WORKERS):
+    """(paths that could be read, group id per such path); unreadable photos are reported and left out."""
+    readable = np.ones(len(paths), dtype=bool)
+    if 'phash' in methods:
+        phashes, ok = index.phashes(paths, workers)
+        readable &= ok
+    if 'embedding' in methods:
+        features, ok = index.embeddings(paths, model_path)
+        readable &= ok
+    if not readable.all():
+        print(f"Skipped {int(np.sum(~readable))} unreadable photos")
+    keep = np.nonzero(readable)[0]
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    if 'phash' in methods:
+        found = phash_pairs(phashes[keep], max_distance)
+        print(f"dHash: {len(found)} near-duplicate pairs within {max_distance} bits")
+        pairs.append(found)
+    if 'embedding' in methods:
+        features = features[keep]
+        found = verify_embedding(features, candidate_pairs(lsh_keys(features)), min_similarity)
+        print(f"Embeddings: {len(found)} near-duplicate pairs with cosine similarity >= {min_similarity}")
+        pairs.append(found)
+    return [paths[i] for i in keep], connected_groups(len(keep), np.concatenate(pairs))
+
+
+def split_dataframe(labels_df, img_dir, groups_path=None, test_size=0.2, random_state=42):
+    """
+    (train_df, val_df) of a labels CSV. Without groups_path a random split by row as before; with it all photos of a
+    duplicate group end up on the same side. Photos missing from the groups file form a group of their own.
+    """
+    if groups_path is None:
+        return train_test_split(labels_df, test_size=test_size, random_state=random_state)
+    groups = pd.read_csv(groups_path)
+    group_of = dict(zip(groups['path'], groups['group']))
+    keys = [os.path.normpath(os.path.join(img_dir, f)) for f in labels_df['filename']]
+    row_groups = [group_of.get(k, k) for k in keys]
+    splitter = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=random_state)
+    train_idx, val_idx = next(splitter.split(labels_df, groups=row_groups))
+    return labels_df.iloc[train_idx], labels_df.iloc[val_idx]
+
+
+def main(args):
+    paths, groups = find_groups(list_images(args.dirs), DedupIndex(args.index), args.method, args.max_distance,
+                                args.min_similarity, args.model, args.workers)
+    df = pd.DataFrame({'path': paths, 'group': groups})
+    df['size'] = df.groupby('group')['path'].transform('size')
+    df.to_csv(args.output, index=False)
+    duplicates = df[df['size'] > 1]
+    print(f"{len(paths)} photos, {df['group'].nunique()} groups; {duplicates['group'].nunique()} groups hold "
+          f"{len(duplicates)} near-duplicate photos. Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group near-duplicate photos for leak-free train/validation splits.")
+    parser.add_argument('--dirs', nargs='+', default=IMG_DIRS, help='Directories scanned recursively for photos')
+    parser.add_argument('--method', nargs='+', choices=['phash', 'embedding'], default=['phash'],
+                        help='Signals linking duplicates; pairs found by any of them are merged')
+    parser.add_argument('--max-distance', type=int, default=MAX_DISTANCE, help='dHash bits duplicates may differ in')
+    parser.add_argument('--min-similarity', type=float, default=MIN_SIMILARITY, help='Embedding cosine similarity of duplicates')
+    parser.add_argument('--model', help=f'Keras model whose backbone features to use (default: ImageNet {EMBEDDING_BACKBONE})')
+    parser.add_argument('--index', default=INDEX_PATH, help='SQLite file caching hashes and embeddings')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Threads decoding photos for the dHash')
+    parser.add_argument('--output', default=GROUPS_PATH, help='CSV of path, group and group size per photo')
+    main(parser.parse_args())
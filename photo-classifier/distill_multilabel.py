@@ -0,0 +1,152 @@
+"""
+distill_multilabel.py
+
+Trains a small student network (MobileNetV3-Small by default, see model_factory.py) on the soft sigmoid outputs of
+the trained multi-label teacher final_model_multilabel.keras. Photos without labels (--unlabeled) are learned from the
+teacher alone; for labelled photos the target blends label and teacher output with --alpha. The binary cross-entropy
+is linear in its target, so this equals alpha * hard loss + (1 - alpha) * distillation loss.
+The student keeps the teacher's contract: [0, 1] crops in, 5 float32 sigmoid outputs in labels CSV order out. With
+the default --img-size 224 it can be exported with
+rebuild_and_export_tfjs.py --weights student_multilabel.keras --backbone <backbone> and used by ai.ts unchanged.
+The held-out photos are the validation split of train_multilabel.py (dedup.split_dataframe, with the same --groups),
+so the teacher has not trained on them either; unlabeled photos are only trained on. The augmented images are
+derivatives of a few source photos, so pass the --groups of dedup.py to keep all derivatives of a photo on one side,
+as for train_multilabel.py.
+The teacher outputs are computed once and cached in embeddings/. distillation_report.json compares per-label
+agreement with the teacher on the held-out photos, and size and latency of both models.
+Usage:
+    python distill_multilabel.py --groups duplicate_groups.csv
+    python distill_multilabel.py --backbone mobilenetv3large --unlabeled datasets/unlabeled --alpha 0.3
+"""
+import os
+import json
+import math
+import argparse
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
+from data_pipeline import image_dataset, cache_path, AUTOTUNE
+from embedding_cache import fingerprint, array_hash, load_or_compute, EMBEDDING_DIR
+from model_factory import BACKBONES, build_model, unfreeze_top
+from compare_backbones import saved_size, measure_speed
+from dedup import list_images, split_dataframe
+from preprocess import IMG_SIZE
+
+TEACHER_PATH = 'final_model_multilabel.keras'
+IMG_DIR = 'datasets/multi-label/augmented'
+CSV_PATH = 'datasets/multi-label/labels_augmented.csv'
+STUDENT_BACKBONE = 'mobilenetv3small'
+STUDENT_PATH = 'student_multilabel.keras'
+REPORT_PATH = 'distillation_report.json'
+BATCH_SIZE = 64
+EPOCHS = 60
+ALPHA = 0.5
+
+
+def batched(paths, targets, img_size, shuffle=False, cache=None):
+    ds = image_dataset(paths, targets, shuffle=shuffle, cache=cache, img_size=img_size)
+    return ds.batch(BATCH_SIZE).map(lambda x, y: (tf.cast(x, tf.float32) / 255.0, y), num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+
+
+def teacher_outputs(teacher, paths, y, cache_dir):
+    """(teacher predictions, labels) for paths, cached in cache_dir."""
+    # The cached rows are in the order of paths, which changes with the split
+    key = fingerprint(paths + [TEACHER_PATH], teacher.name, array_hash(y), paths)
+    return load_or_compute('distill_teacher', key, teacher, batched(paths, y, teacher.input_shape[1]),
+                           math.ceil(len(paths) / BATCH_SIZE), cache_dir)
+
+
+def agreement_report(student_preds, teacher_preds, y, label_names):
+    report = {}
+    for i, name in enumerate(label_names):
+        entry = {
+            'agreement_with_teacher': float(np.mean((student_preds[:, i] > 0.5) == (teacher_preds[:, i] > 0.5))),
+            'mean_abs_diff_to_teacher': float(np.mean(np.abs(student_preds[:, i] - teacher_preds[:, i])))
+        }
+        known = ~np.isnan(y[:, i])
+        if known.any():
+            entry['student_accuracy'] = float(np.mean((student_preds[known, i] > 0.5) == (y[known, i] > 0.5)))
+            entry['teacher_accuracy'] = float(np.mean((teacher_preds[known, i] > 0.5) == (y[known, i] > 0.5)))
+        report[name] = entry
+    return report
+
+
+def main(backbone, img_size, alpha, unlabeled_dirs, img_dir, csv_path, cache_dir, groups_path=None):
+    teacher = load_model(TEACHER_PATH)
+    labels_df = pd.read_csv(csv_path)
+    label_names = list(labels_df.columns[1:])
+    train_df, val_df = split_dataframe(labels_df, img_dir, groups_path)
+
+    def rows(df):
+        return ([os.path.join(img_dir, f) for f in df['filename']],
+                df[label_names].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32))
+    (train_paths, train_y), (val_paths, val_y) = rows(train_df), rows(val_df)
+    for d in unlabeled_dirs:
+        extra = list_images([d])
+        print(f"Adding {len(extra)} unlabeled images from {d}")
+        train_paths += extra
+        train_y = np.concatenate([train_y, np.full((len(extra), len(label_names)), np.nan, dtype=np.float32)])
+    paths, y = train_paths + val_paths, np.concatenate([train_y, val_y])
+    train_idx, val_idx = np.arange(len(train_paths)), np.arange(len(train_paths), len(paths))
+
+    print(f"Computing teacher outputs for {len(paths)} images...")
+    soft, y = teacher_outputs(teacher, paths, y, cache_dir)
+    targets = np.where(np.isnan(y), soft, alpha * y + (1 - alpha) * soft).astype(np.float32)
+
+    train_ds = batched(train_paths, targets[train_idx], img_size, shuffle=True,
+                       cache=cache_path(cache_dir, 'distill_train', train_paths, img_size, targets[train_idx]))
+    val_ds = batched(val_paths, targets[val_idx], img_size, cache=cache_path(cache_dir, 'distill_val', val_paths, img_size, targets[val_idx]))
+
+    student = build_model(len(label_names), backbone, img_size)
+    callbacks = [
+        EarlyStopping(monitor='val_loss', patience=10, restore_best_weights=True),
+        ModelCheckpoint(f'best_{STUDENT_PATH}', save_best_only=True)
+    ]
+    student.compile(optimizer=Adam(learning_rate=1e-3), loss='binary_crossentropy')
+    student.fit(train_ds, validation_data=val_ds, epochs=EPOCHS, callbacks=callbacks)
+    # Fine-tune the top of the student backbone
+    unfreeze_top(student)
+    student.compile(optimizer=Adam(learning_rate=1e-5), loss='binary_crossentropy')
+    student.fit(train_ds, validation_data=val_ds, epochs=int(EPOCHS / 3), callbacks=callbacks)
+    student.save(STUDENT_PATH, include_optimizer=False)
+    print(f"Student saved as {STUDENT_PATH}")
+
+    student_preds = np.asarray(student.predict(batched(val_paths, targets[val_idx], img_size), verbose=0))
+    labels = agreement_report(student_preds, soft[val_idx], y[val_idx], label_names)
+    report = {
+        'teacher': dict(path=TEACHER_PATH, name=teacher.name, params=int(teacher.count_params()),
+                        size_mb=saved_size(teacher) / 2**20, **measure_speed(teacher)),
+        'student': dict(path=STUDENT_PATH, name=student.name, params=int(student.count_params()),
+                        size_mb=saved_size(student) / 2**20, **measure_speed(student)),
+        'alpha': alpha,
+        'validation_images': len(val_paths),
+        'labels': labels,
+        'mean_agreement_with_teacher': float(np.mean([r['agreement_with_teacher'] for r in labels.values()]))
+    }
+    with open(REPORT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'label':<22}{'agreement':>10}{'abs diff':>10}")
+    for name, r in labels.items():
+        print(f"{name:<22}{r['agreement_with_teacher']:>10.3f}{r['mean_abs_diff_to_teacher']:>10.3f}")
+    for role in ['teacher', 'student']:
+        r = report[role]
+        print(f"{role}: {r['params']:,} params, {r['size_mb']:.1f} MB, p50 {r['p50_ms']:.2f} ms")
+    print(f"Report saved to {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill the multi-label model into a smaller student.")
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default=STUDENT_BACKBONE, help='Student backbone')
+    parser.add_argument('--img-size', type=int, default=IMG_SIZE, help='Student input resolution')
+    parser.add_argument('--alpha', type=float, default=ALPHA, help='Weight of the hard labels (0 = teacher outputs only)')
+    parser.add_argument('--unlabeled', nargs='*', default=[], metavar='DIR', help='Directories of unlabeled images to distill on as well')
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the labelled photos')
+    parser.add_argument('--csv', default=CSV_PATH, help='Labels CSV')
+    parser.add_argument('--groups', metavar='CSV', help='Split by the near-duplicate groups of dedup.py, like train_multilabel.py --groups')
+    parser.add_argument('--cache', default=EMBEDDING_DIR, metavar='DIR', help='Where to cache teacher outputs and cropped images')
+    args = parser.parse_args()
+    main(args.backbone, args.img_size, args.alpha, args.unlabeled, args.img_dir, args.csv, args.cache, args.groups)
@@ -0,0 +1,171 @@
+"""
+distributed.py
+
+Opt-in data-parallel training over several processes with tf.distribute.MultiWorkerMirroredStrategy, for
+train.py --distributed and train_multilabel.py --distributed. Every worker process is one replica: it reads only
+its own shard of the images (data_pipeline shard=(index, count)), batched with the global batch size divided by the
+number of replicas, and the gradients are all-reduced every step. Workers find each other through TF_CONFIG.
+Worker 0 is the chief: it writes the checkpoints and models under their usual names and evaluates the final model.
+The other workers write theirs to a temporary directory, which the strategy needs but nobody reads. --resume loads
+the chief's checkpoint on every worker, so the checkpoint path has to be on storage all workers can read.
+Running this file launches the workers as local processes on one Linux machine, with TF_CONFIG set, the cores
+split between them (each pinned to its own block of cores) and the logs of workers 1..N-1 in --log-dir. When a
+worker fails the others are stopped, since they would wait for it forever, and the launcher exits with status 1.
+Across machines, start the script with --distributed on every node with the same cluster in TF_CONFIG and its own index.
+Usage:
+    python distributed.py --workers 4 train_multilabel.py --xla
+    python distributed.py --workers 2 train.py --resume
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+WORKERS = 2
+LOG_DIR = 'worker_logs'
+# Seconds between checks of the worker processes, and given to a terminated worker before it is killed
+POLL_INTERVAL = 1.0
+TERMINATE_TIMEOUT = 30
+
+
+def setup(enabled):
+    """(strategy, worker index, number of workers); the default strategy, 0 and 1 unless enabled.
+    Must run before any other TensorFlow call of the process."""
+    import tensorflow as tf
+    if not enabled:
+        return tf.distribute.get_strategy(), 0, 1
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    resolver = strategy.cluster_resolver
+    n_workers = len(resolver.cluster_spec().as_dict().get('worker', [])) or 1
+    print(f"Worker {resolver.task_id} of {n_workers}, {strategy.num_replicas_in_sync} replicas in sync")
+    return strategy, resolver.task_id or 0, n_workers
+
+
+def replica_batch_size(strategy, global_batch_size):
+    """Batch size each replica reads so all replicas together process global_batch_size images per step."""
+    replicas = strategy.num_replicas_in_sync
+    if global_batch_size % replicas:
+        print(f"Batch size {global_batch_size} is not divisible by {replicas} replicas, "
+              f"using {global_batch_size // replicas * replicas}")
+    return max(1, global_batch_size // replicas)
+
+
+def agree_steps(strategy, steps):
+    """The smallest steps of all workers. Shards differ by up to one image, but every worker has to run the same
+    number of steps or the all-reduce of the extra steps waits forever."""
+    import tensorflow as tf
+    if strategy.num_replicas_in_sync == 1:
+        return steps
+    gathered = tf.function(lambda: strategy.gather(strategy.run(lambda: tf.constant([steps], tf.int64)), axis=0))()
+    return int(tf.reduce_min(gathered))
+
+
+def distribute(strategy, dataset):
+    """dataset (this worker's shard, batched per replica) as input of model.fit under strategy, not re-sharded."""
+    import tensorflow as tf
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return strategy.distribute_datasets_from_function(lambda input_context: dataset.with_options(options))
+
+
+def worker_path(path, worker):
+    """path on the chief; on other workers the same file name in a temporary directory of their own."""
+    if worker == 0:
+        return path
+    return os.path.join(tempfile.gettempdir(), f'photo-classifier-worker{worker}', os.path.basename(path))
+
+
+def cleanup(worker):
+    """Removes the temporary directory of a non-chief worker."""
+    if worker != 0:
+        shutil.rmtree(os.path.dirname(worker_path('model', worker)), ignore_errors=True)
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch(script_args, workers=WORKERS, log_dir=LOG_DIR):
+    """
+    Runs script_args (a training script and its arguments) as workers local processes; returns 0 if all of them
+    succeeded, 1 otherwise.
+    """
+    if '--distributed' not in script_args:
+        script_args = script_args + ['--distributed']
+    cluster = {'worker': [f'localhost:{port}' for port in free_ports(workers)]}
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // workers)
+    os.makedirs(log_dir, exist_ok=True)
+    processes, logs = [], []
+    for index in range(workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}),
+                   TF_NUM_INTRAOP_THREADS=str(per_worker), TF_NUM_INTEROP_THREADS='2', OMP_NUM_THREADS=str(per_worker))
+        worker_cores = cores[index * per_worker:(index + 1) * per_worker] or cores
+        log = None if index == 0 else open(os.path.join(log_dir, f'worker{index}.log'), 'w')
+        if log:
+            logs.append(log)
+        processes.append(subprocess.Popen([sys.executable] + script_args, env=env, stdout=log,
+                                          stderr=subprocess.STDOUT if log else None,
+                                          preexec_fn=lambda c=worker_cores: os.sched_setaffinity(0, c)))
+    print(f"Started {workers} workers with {per_worker} cores each; logs of workers 1-{workers - 1} in {log_dir}")
+    try:
+        codes = wait_all(processes)
+    except KeyboardInterrupt:
+        stop(processes)
+        raise
+    finally:
+        for log in logs:
+            log.close()
+    return 1 if any(codes) else 0
+
+
+def stop(processes, timeout=TERMINATE_TIMEOUT):
+    """Terminates the processes still running, killing those that do not exit within timeout seconds."""
+    for p in processes:
+        if p.poll() is None:
+            p.terminate()
+    for p in processes:
+        try:
+            p.wait(timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+def wait_all(processes, poll_interval=POLL_INTERVAL):
+    """
+    Exit codes of the worker processes. As soon as one fails the others are terminated: they would otherwise wait
+    for it in the next all-reduce forever.
+    """
+    while True:
+        codes = [p.poll() for p in processes]
+        failed = [index for index, code in enumerate(codes) if code]
+        if failed:
+            print(f"Worker {failed[0]} exited with code {codes[failed[0]]}, stopping the other workers")
+            stop(processes)
+            return [p.returncode for p in processes]
+        if all(code is not None for code in codes):
+            return codes
+        time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launch a training script as local data-parallel worker processes.")
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Number of worker processes')
+    parser.add_argument('--log-dir', default=LOG_DIR, help='Directory for the output of workers 1..N-1')
+    parser.add_argument('script', nargs=argparse.REMAINDER, help='Training script and its arguments, e.g. train_multilabel.py --xla')
+    args = parser.parse_args()
+    if not args.script:
+        parser.error('a training script is required, e.g. train_multilabel.py')
+    sys.exit(launch(args.script, args.workers, args.log_dir))
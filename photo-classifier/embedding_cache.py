@@ -0,0 +1,112 @@
+"""
+embedding_cache.py
+
+Caches the GlobalAveragePooling2D features of the frozen backbone on disk, so the Dense/Dropout head can be
+trained on them directly instead of running the full backbone forward pass every epoch.
+The head model shares its layers (and weights) with the full model, so the full model is ready for fine-tuning
+as soon as the head has been trained.
+"""
+import os
+import hashlib
+import numpy as np
+
+EMBEDDING_DIR = 'embeddings'
+
+
+def gap_index(model):
+    from tensorflow.keras.layers import GlobalAveragePooling2D
+    # The last one: EfficientNet and MobileNetV3 also pool inside their squeeze-and-excite blocks
+    return max(i for i, layer in enumerate(model.layers) if isinstance(layer, GlobalAveragePooling2D))
+
+
+def feature_model(model):
+    """Model mapping images to the pooled backbone features of model."""
+    from tensorflow.keras.models import Model
+    return Model(inputs=model.input, outputs=model.layers[gap_index(model)].output)
+
+
+def head_model(model):
+    """Model mapping pooled features to the outputs of model, sharing the head layers with model."""
+    from tensorflow.keras.layers import Input
+    from tensorflow.keras.models import Model
+    layers = model.layers[gap_index(model):]
+    inputs = Input(shape=layers[0].output.shape[1:], name='features')
+    x = inputs
+    for layer in layers[1:]:
+        x = layer(x)
+    return Model(inputs=inputs, outputs=x)
+
+
+def fingerprint(paths, *extra):
+    """Hash of the given files (path, size, mtime) and extra settings, used to detect stale caches."""
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(f'{path}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    h.update(repr(extra).encode())
+    return h.hexdigest()
+
+
+def array_hash(values):
+    """Hash of the float32 values of an array, e.g. labels a cache stores along with the images."""
+    return hashlib.sha256(np.ascontiguousarray(values, dtype=np.float32).tobytes()).hexdigest()
+
+
+def weights_hash(model):
+    """Hash of all weights of model, so features of a fine-tuned or resumed backbone are not mistaken for the old ones."""
+    h = hashlib.sha256()
+    for weights in model.get_weights():
+        h.update(np.ascontiguousarray(weights).tobytes())
+    return h.hexdigest()
+
+
+def compute_embeddings(extractor, batches, steps):
+    features = []
+    labels = []
+    iterator = None if hasattr(batches, '__getitem__') else iter(batches)
+    for step in range(steps):
+        x, y = batches[step] if iterator is None else next(iterator)
+        features.append(np.asarray(extractor.predict_on_batch(x), dtype=np.float32))
+        labels.append(np.asarray(y, dtype=np.float32))
+        print(f"\rComputing embeddings {step + 1}/{steps}", end='', flush=True)
+    print()
+    return np.concatenate(features), np.concatenate(labels)
+
+
+def load_cached(name, key, cache_dir=EMBEDDING_DIR):
+    """(features, labels) for name from cache_dir if they were computed for key, otherwise None."""
+    path = os.path.join(cache_dir, f'{name}.npz')
+    if os.path.exists(path):
+        cached = np.load(path)
+        if str(cached['key']) == key:
+            print(f"Using cached embeddings from {path}")
+            return cached['features'], cached['labels']
+    return None
+
+
+def load_or_compute(name, key, extractor, batches, steps, cache_dir=EMBEDDING_DIR):
+    """Returns (features, labels) for name from cache_dir, recomputing them when key has changed."""
+    cached = load_cached(name, key, cache_dir)
+    if cached is not None:
+        return cached
+    path = os.path.join(cache_dir, f'{name}.npz')
+    features, labels = compute_embeddings(extractor, batches, steps)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, key=key, features=features, labels=labels)
+    print(f"Saved {len(features)} embeddings to {path}")
+    return features, labels
+
+
+def fit_head(model, train, val, optimizer, epochs, batch_size, callbacks=None, jit_compile='auto', verbose='auto'):
+    """Trains the head of model on cached (features, labels) tuples; the backbone is not run at all."""
+    head = head_model(model)
+    head.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['accuracy'], jit_compile=jit_compile)
+    return head.fit(
+        train[0], train[1],
+        validation_data=val,
+        epochs=epochs,
+        batch_size=batch_size,
+        shuffle=True,
+        callbacks=callbacks,
+        verbose=verbose
+    )
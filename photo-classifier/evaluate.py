@@ -0,0 +1,228 @@
+"""
+evaluate.py
+
+Evaluates the multi-label model from cached predictions. The model runs once over the validation split of
+train_multilabel.py (same split, same intelligent_center_crop path). Its predictions are cached in embeddings/,
+keyed by model, images and labels. Every later evaluation reuses them, so changing the threshold criterion or the
+thresholds needs no forward pass.
+From the predictions it computes, vectorized over all thresholds of a label:
+    ROC and PR curves, ROC AUC and average precision
+    the threshold per label maximizing F1 (or Youden's J), a label counts as present when score >= threshold
+    confusion matrices and F1/precision/recall/accuracy at 0.5 and at the tuned thresholds
+    bootstrap confidence intervals, with the resamples split over a process pool
+The tuned thresholds are written as JSON keyed by the label names of ai.ts (PhotoLabels), for the validator to load
+next to model.json. The report goes to evaluation_report.json and the curves to evaluation_curves.npz.
+Usage:
+    python evaluate.py
+    python evaluate.py --criterion youden --bootstrap 2000 --workers 8
+    python evaluate.py --thresholds label_thresholds.json  # evaluate fixed thresholds
+"""
+import os
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+MODEL_PATH = 'final_model_multilabel.keras'
+IMG_DIR = 'datasets/multi-label/augmented'
+CSV_PATH = 'datasets/multi-label/labels_augmented.csv'
+CACHE_DIR = 'embeddings'
+REPORT_PATH = 'evaluation_report.json'
+CURVES_PATH = 'evaluation_curves.npz'
+THRESHOLDS_PATH = 'label_thresholds.json'
+# Same order as PhotoLabels in azure-functions/src/functions/validator/rules/ai.ts
+VALIDATOR_LABELS = ['brightBackground', 'neutralBackground', 'whiteShirt', 'highQuality', 'businessAttire']
+BATCH_SIZE = 64
+N_BOOTSTRAP = 1000
+# Bootstrap resamples per worker task
+BOOTSTRAP_CHUNK = 50
+CONFIDENCE = 0.95
+WORKERS = os.cpu_count() or 1
+
+
+def prediction_key(model_path, paths, y):
+    """Cache key of the predictions and labels y of paths; relabeling the images invalidates it like a new model."""
+    from embedding_cache import fingerprint, array_hash
+    return fingerprint(paths + [model_path], array_hash(y))
+
+
+def cached_predictions(model_path, paths, y, name='evaluation', cache_dir=CACHE_DIR):
+    """(predictions, labels) of the model for paths, computed in batches once and then read from cache_dir."""
+    from embedding_cache import load_cached, load_or_compute
+    key = prediction_key(model_path, paths, y)
+    cached = load_cached(name, key, cache_dir)
+    if cached is not None:
+        return cached
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+    from data_pipeline import image_dataset, AUTOTUNE
+    model = load_model(model_path)
+    ds = image_dataset(paths, y, img_size=model.input_shape[1]).batch(BATCH_SIZE)
+    ds = ds.map(lambda x, t: (tf.cast(x, tf.float32) / 255.0, t), num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    return load_or_compute(name, key, model, ds, len(ds), cache_dir)
+
+
+def label_curve(y_true, scores):
+    """Counts and rates at every distinct score of one label, highest threshold first."""
+    order = np.argsort(-scores, kind='mergesort')
+    scores, y_true = scores[order], y_true[order]
+    last = np.r_[np.nonzero(np.diff(scores))[0], len(scores) - 1]  # last index of every distinct score
+    tp = np.cumsum(y_true)[last].astype(np.float64)
+    fp = last + 1 - tp
+    positives, negatives = y_true.sum(), len(y_true) - y_true.sum()
+    return {
+        'thresholds': scores[last],
+        'tp': tp, 'fp': fp, 'fn': positives - tp, 'tn': negatives - fp,
+        'tpr': tp / max(positives, 1), 'fpr': fp / max(negatives, 1),
+        'precision': tp / (tp + fp)
+    }
+
+
+def curve_summary(curve):
+    """ROC AUC (trapezoidal) and average precision of a label_curve."""
+    fpr, tpr = np.r_[0.0, curve['fpr']], np.r_[0.0, curve['tpr']]
+    return {
+        'roc_auc': float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)),
+        'average_precision': float(np.sum(np.diff(np.r_[0.0, curve['tpr']]) * curve['precision']))
+    }
+
+
+def best_threshold(curve, criterion='f1'):
+    if criterion == 'youden':
+        objective = curve['tpr'] - curve['fpr']
+    else:
+        objective = 2 * curve['tp'] / np.maximum(2 * curve['tp'] + curve['fp'] + curve['fn'], 1)
+    return float(curve['thresholds'][np.argmax(objective)])
+
+
+def confusion_counts(y_true, scores, thresholds):
+    """(tn, fp, fn, tp) per label, each of shape scores.shape[:-2] + (labels,)."""
+    pred = scores >= thresholds
+    y_true = y_true.astype(bool)
+    return ((~pred & ~y_true).sum(-2), (pred & ~y_true).sum(-2), (~pred & y_true).sum(-2), (pred & y_true).sum(-2))
+
+
+def threshold_metrics(tn, fp, fn, tp):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'accuracy': (tp + tn) / (tn + fp + fn + tp),
+            'precision': tp / (tp + fp),
+            'recall': tp / (tp + fn),
+            'f1': 2 * tp / (2 * tp + fp + fn)
+        }
+
+
+def rank_auc(y_true, scores):
+    """ROC AUC per label from ranks (Mann-Whitney U), vectorized over leading resample axes."""
+    ranks = rankdata(scores, axis=-2)
+    positives = y_true.sum(-2)
+    negatives = y_true.shape[-2] - positives
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ((ranks * y_true).sum(-2) - positives * (positives + 1) / 2) / (positives * negatives)
+
+
+def bootstrap_chunk(y_true, scores, thresholds, n_resamples, seed):
+    """Metrics of n_resamples bootstrap resamples, each of shape (n_resamples, labels)."""
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(y_true), size=(n_resamples, len(y_true)))
+    y_sample, s_sample = y_true[idx], scores[idx]
+    metrics = threshold_metrics(*confusion_counts(y_sample, s_sample, thresholds))
+    metrics['roc_auc'] = rank_auc(y_sample, s_sample)
+    return metrics
+
+
+def bootstrap(y_true, scores, thresholds, n_bootstrap=N_BOOTSTRAP, workers=WORKERS, seed=42, confidence=CONFIDENCE):
+    """(low, high) confidence bounds per metric and label."""
+    chunks = [min(BOOTSTRAP_CHUNK, n_bootstrap - start) for start in range(0, n_bootstrap, BOOTSTRAP_CHUNK)]
+    args = [(y_true, scores, thresholds, n, seed + i) for i, n in enumerate(chunks)]
+    if workers > 1 and len(chunks) > 1:
+        # spawn instead of fork: TensorFlow may already be loaded and is not fork-safe
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(bootstrap_chunk, *zip(*args)))
+    else:
+        results = [bootstrap_chunk(*a) for a in args]
+    alpha = (1 - confidence) / 2 * 100
+    bounds = {}
+    for metric in results[0]:
+        values = np.concatenate([r[metric] for r in results])
+        bounds[metric] = (np.nanpercentile(values, alpha, axis=0), np.nanpercentile(values, 100 - alpha, axis=0))
+    return bounds
+
+
+def evaluate(y_true, scores, label_names, criterion='f1', thresholds=None, n_bootstrap=N_BOOTSTRAP, workers=WORKERS):
+    """Report dict and curves for (samples, labels) arrays; thresholds are tuned per label unless given."""
+    y_true = np.asarray(y_true) > 0.5
+    scores = np.asarray(scores, dtype=np.float64)
+    curves = [label_curve(y_true[:, i], scores[:, i]) for i in range(len(label_names))]
+    if thresholds is None:
+        thresholds = np.array([best_threshold(c, criterion) for c in curves])
+    at_default = threshold_metrics(*confusion_counts(y_true, scores, np.full(len(label_names), 0.5)))
+    counts = confusion_counts(y_true, scores, thresholds)
+    at_tuned = threshold_metrics(*counts)
+    bounds = bootstrap(y_true, scores, thresholds, n_bootstrap, workers) if n_bootstrap else {}
+    report = {}
+    for i, name in enumerate(label_names):
+        tn, fp, fn, tp = (int(c[i]) for c in counts)
+        entry = dict(curve_summary(curves[i]), threshold=float(thresholds[i]), positives=int(y_true[:, i].sum()),
+                     confusion_matrix=[[tn, fp], [fn, tp]])
+        entry['at_threshold'] = {k: float(v[i]) for k, v in at_tuned.items()}
+        entry['at_0.5'] = {k: float(v[i]) for k, v in at_default.items()}
+        entry['confidence_intervals'] = {k: [float(low[i]), float(high[i])] for k, (low, high) in bounds.items()}
+        report[name] = entry
+    return report, curves
+
+
+def print_report(report):
+    print(f"\n{'label':<22}{'AUC':>7}{'AP':>7}{'thresh':>8}{'F1':>7}{'F1@0.5':>8}{'AUC CI':>16}")
+    for name, r in report.items():
+        ci = r['confidence_intervals'].get('roc_auc')
+        ci = f"{ci[0]:.3f}-{ci[1]:.3f}" if ci else ''
+        print(f"{name:<22}{r['roc_auc']:>7.3f}{r['average_precision']:>7.3f}{r['threshold']:>8.3f}"
+              f"{r['at_threshold']['f1']:>7.3f}{r['at_0.5']['f1']:>8.3f}{ci:>16}")
+
+
+def main(args):
+    labels_df = pd.read_csv(args.csv)
+    label_names = list(labels_df.columns[1:])
+    from dedup import split_dataframe
+    _, val_df = split_dataframe(labels_df, args.img_dir, args.groups)
+    paths = [os.path.join(args.img_dir, f) for f in val_df['filename']]
+    scores, y_true = cached_predictions(args.model, paths, val_df[label_names].to_numpy(dtype=np.float32),
+                                        cache_dir=args.cache)
+    thresholds = None
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            fixed = json.load(f)
+        thresholds = np.array([fixed[v] for v in VALIDATOR_LABELS[:len(label_names)]])
+    report, curves = evaluate(y_true, scores, label_names, args.criterion, thresholds, args.bootstrap, args.workers)
+
+    with open(args.output, 'w') as f:
+        json.dump({'model': args.model, 'images': len(paths), 'criterion': args.criterion, 'labels': report}, f, indent=2)
+    np.savez(CURVES_PATH, **{f'{name}_{key}': value for name, c in zip(label_names, curves) for key, value in c.items()})
+    if not args.thresholds:
+        # Keyed like PhotoLabels, in CSV column order
+        with open(args.export, 'w') as f:
+            json.dump({v: report[name]['threshold'] for v, name in zip(VALIDATOR_LABELS, label_names)}, f, indent=2)
+        print(f"Thresholds for the validator saved to {args.export}")
+
+    print_report(report)
+    print(f"Report saved to {args.output}, curves to {CURVES_PATH}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the multi-label model from cached predictions.")
+    parser.add_argument('--model', default=MODEL_PATH, help='Keras model to evaluate')
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the labelled photos')
+    parser.add_argument('--csv', default=CSV_PATH, help='Labels CSV; its validation split is evaluated')
+    parser.add_argument('--groups', metavar='CSV', help='Split by the near-duplicate groups of dedup.py, like train_multilabel.py --groups')
+    parser.add_argument('--cache', default=CACHE_DIR, metavar='DIR', help='Where predictions are cached')
+    parser.add_argument('--criterion', choices=['f1', 'youden'], default='f1', help='What the tuned thresholds maximize')
+    parser.add_argument('--thresholds', metavar='JSON', help='Evaluate these thresholds instead of tuning them')
+    parser.add_argument('--bootstrap', type=int, default=N_BOOTSTRAP, help='Bootstrap resamples (0 to skip)')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Processes computing bootstrap resamples')
+    parser.add_argument('--output', default=REPORT_PATH, help='JSON report')
+    parser.add_argument('--export', default=THRESHOLDS_PATH, help='JSON file for the tuned thresholds')
+    main(parser.parse_args())
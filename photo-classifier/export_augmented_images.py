@@ -2,69 +2,100 @@
 export_augmented_images.py
 
 Generates and saves 2000 augmented images per category using the same preprocessing and augmentation as in preprocess.py.
+The output indices of each class are split into chunks that are generated in parallel worker processes. Every chunk
+has its own fixed seed, so the result does not depend on the number of workers, and chunks whose output already
+exists are skipped on a rerun.
+Training does not need this export: data_pipeline.py applies the same per-class policies in-graph (augment_batch),
+seeded per batch, and train_multilabel.py --augment trains on the original photos that way.
+Usage:
+    python export_augmented_images.py
+    python export_augmented_images.py --workers 8 --format shard
 """
 import os
+import argparse
+import multiprocessing
 import numpy as np
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from PIL import Image
-from preprocess import intelligent_center_crop, IMG_SIZE
 
 # Parameters
 SRC_DIR = 'dataset'
 DST_DIR = 'augmented_dataset'
 N_IMAGES_PER_CLASS = 2000
 BATCH_SIZE = 32
+# Number of output images generated (and seeded) together
+CHUNK_SIZE = 250
+SEED = 42
+CLASSES = ['compliant', 'non-compliant']
 
-# Augmentation configs (same as preprocess.py)
-compliant_datagen = ImageDataGenerator(
-    rescale=1./255,
-    rotation_range=10,
-    width_shift_range=0.1,
-    height_shift_range=0.1,
-    brightness_range=(0.8, 1.2),
-    zoom_range=0.1,
-    horizontal_flip=True,
-    preprocessing_function=lambda img: intelligent_center_crop(img, IMG_SIZE)
-)
-noncompliant_datagen = ImageDataGenerator(
-    rescale=1./255,
-    rotation_range=20,
-    width_shift_range=0.2,
-    height_shift_range=0.2,
-    brightness_range=(0.6, 1.4),
-    zoom_range=0.3,
-    shear_range=20,
-    horizontal_flip=True,
-    fill_mode='nearest',
-    preprocessing_function=lambda img: intelligent_center_crop(img, IMG_SIZE)
-)
 
-os.makedirs(DST_DIR, exist_ok=True)
-for cls, datagen in zip(['compliant', 'non-compliant'], [compliant_datagen, noncompliant_datagen]):
-    src_path = os.path.join(SRC_DIR, cls)
-    dst_path = os.path.join(DST_DIR, cls)
-    os.makedirs(dst_path, exist_ok=True)
-    generator = datagen.flow_from_directory(
+def chunk_outputs(dst_path, cls, start, end, fmt):
+    """Files written for output indices [start, end) of cls."""
+    if fmt == 'shard':
+        return [os.path.join(dst_path, f'{cls}_{start:05d}-{end:05d}.npy')]
+    return [os.path.join(dst_path, f'{cls}_{idx:05d}.jpg') for idx in range(start, end)]
+
+
+def export_chunk(cls, start, end, seed, fmt):
+    # Imported in the worker, so the parent process does not need to load TensorFlow
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from preprocess import batch_center_crop, IMG_SIZE, COMPLIANT_AUGMENTATION, NONCOMPLIANT_AUGMENTATION
+
+    # Augmentation configs (same as preprocess.py); cropping is applied per batch
+    policy = COMPLIANT_AUGMENTATION if cls == 'compliant' else NONCOMPLIANT_AUGMENTATION
+    np.random.seed(seed)  # ImageDataGenerator draws its random transforms from the global NumPy generator
+    generator = ImageDataGenerator(**policy).flow_from_directory(
         SRC_DIR,
         classes=[cls],
         target_size=(IMG_SIZE, IMG_SIZE),
         batch_size=BATCH_SIZE,
         class_mode=None,
         shuffle=True,
-        seed=42
+        seed=seed
     )
-    saved = 0
-    img_idx = 0
-    while saved < N_IMAGES_PER_CLASS:
-        batch = next(generator)
-        for img in batch:
-            # Undo rescale for saving
-            img_uint8 = np.clip(img * 255, 0, 255).astype(np.uint8)
-            im = Image.fromarray(img_uint8)
-            im.save(os.path.join(dst_path, f'{cls}_{img_idx:05d}.jpg'))
-            saved += 1
-            img_idx += 1
-            if saved >= N_IMAGES_PER_CLASS:
-                break
-    print(f"Saved {saved} images for class '{cls}' to {dst_path}")
-print("Done.")
+    images = []
+    while len(images) < end - start:
+        images.extend(batch_center_crop(next(generator), IMG_SIZE, dtype=np.uint8))
+    images = images[:end - start]
+    dst_path = os.path.join(DST_DIR, cls)
+    outputs = chunk_outputs(dst_path, cls, start, end, fmt)
+    # Write to a temporary name first, so an interrupted run never leaves a partial file under the final name
+    if fmt == 'shard':
+        with open(outputs[0] + '.tmp', 'wb') as f:
+            np.save(f, np.stack(images))
+        os.replace(outputs[0] + '.tmp', outputs[0])
+    else:
+        for img_uint8, path in zip(images, outputs):
+            Image.fromarray(img_uint8).save(path + '.tmp', format='JPEG')
+            os.replace(path + '.tmp', path)
+    return cls, end - start
+
+
+def main(n_images=N_IMAGES_PER_CLASS, workers=None, fmt='jpg', chunk_size=CHUNK_SIZE):
+    tasks = []
+    for class_idx, cls in enumerate(CLASSES):
+        dst_path = os.path.join(DST_DIR, cls)
+        os.makedirs(dst_path, exist_ok=True)
+        for chunk_idx, start in enumerate(range(0, n_images, chunk_size)):
+            end = min(start + chunk_size, n_images)
+            if all(os.path.exists(p) for p in chunk_outputs(dst_path, cls, start, end, fmt)):
+                continue
+            tasks.append((cls, start, end, SEED + class_idx * 100003 + chunk_idx, fmt))
+    if not tasks:
+        print(f"All {n_images} images per class already exist in {DST_DIR}, nothing to do.")
+        return
+    print(f"Generating {sum(t[2] - t[1] for t in tasks)} images in {len(tasks)} chunks ...")
+    # spawn instead of fork: TensorFlow is not fork-safe
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for cls, count in pool.starmap(export_chunk, tasks):
+            print(f"Saved {count} images for class '{cls}' to {os.path.join(DST_DIR, cls)}")
+    print("Done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export augmented images per class.")
+    parser.add_argument('--count', type=int, default=N_IMAGES_PER_CLASS, help='Number of images per class')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('--format', choices=['jpg', 'shard'], default='jpg', help='Loose JPEG files or one uint8 .npy shard per chunk')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Images per chunk; changing it changes the generated images')
+    args = parser.parse_args()
+    main(args.count, args.workers, args.format, args.chunk_size)
@@ -3,18 +3,32 @@ infer.py
 
 Batch classify all images in dataset/ and testset/ using the trained model.
 Saves results to a CSV and prints images where the model is uncertain.
+
+Images are decoded and cropped on a thread pool while the model predicts the previous batch.
+The model always sees batches of exactly --batch-size images (a partial last batch is zero-padded), and
+predict_image pads a single image to the same shape, so batched scores are identical to per-image scores.
+--xla runs an XLA-compiled forward pass and --precision mixed_bfloat16 scores in bfloat16 on CPUs that support it
+(see precision.py); bfloat16 scores differ from float32 in the second or third decimal.
+Usage:
+    python infer.py
+    python infer.py --batch-size 64 --workers 8 dataset testset
+    python infer.py --crop-cache .crop_cache
+    python infer.py --index scores.sqlite  # only score new or changed images
+    python infer.py --xla --precision mixed_bfloat16
 """
 
-import sys
 import os
 import numpy as np
 import csv
-from tensorflow.keras.models import load_model
-from preprocess import intelligent_center_crop, IMG_SIZE
+import argparse
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from preprocess import intelligent_center_crop
+from precision import PRECISIONS, DEFAULT_PRECISION
 from PIL import Image
 
-# Load the trained model
-model = load_model('final_model_40+20.keras')
+MODEL_PATH = 'final_model_40+20.keras'
 
 # Class labels (adjust if your class indices are different)
 class_labels = {0: 'compliant', 1: 'non-compliant'}
@@ -23,29 +37,126 @@ class_labels = {0: 'compliant', 1: 'non-compliant'}
 UNCERTAIN_LOW = 0.4
 UNCERTAIN_HIGH = 0.6
 
+BATCH_SIZE = 32
+WORKERS = os.cpu_count() or 1
+# Number of decoded batches kept ready ahead of the one being predicted
+PREFETCH_BATCHES = 2
+
+
+@functools.lru_cache(maxsize=None)
+def get_model():
+    """The trained model, loaded on first use so importing this module stays cheap."""
+    from tensorflow.keras.models import load_model
+    return load_model(MODEL_PATH)
+
+
+def img_size():
+    return get_model().input_shape[1]  # Crop size the model was trained with
 
-def predict_image(img_path):
+
+def load_image(img_path, cache=None):
+    if cache is not None:
+        return cache.get(img_path).astype(np.float32) / 255.0
     img = Image.open(img_path)
-    img = intelligent_center_crop(img, IMG_SIZE)
-    img = img / 255.0  # Rescale
-    img = np.expand_dims(img, axis=0)  # Add batch dimension
-    pred = model.predict(img, verbose=0)[0][0]
+    img = intelligent_center_crop(img, img_size())
+    return img / 255.0  # Rescale
+
+
+def pad_batch(images, batch_size):
+    """images zero-padded to batch_size rows; the float kernels depend on the batch shape, so every predict call
+    uses the same one."""
+    images = np.asarray(images, dtype=np.float32)
+    if len(images) < batch_size:
+        images = np.concatenate([images, np.zeros((batch_size - len(images),) + images.shape[1:], np.float32)])
+    return images
+
+
+def predict_image(img_path, batch_size=BATCH_SIZE):
+    img = load_image(img_path)
+    pred = np.asarray(get_model().predict_on_batch(pad_batch([img], batch_size)))[0][0]
     label = class_labels[1] if pred > 0.5 else class_labels[0]
     return label, pred
 
 
-def batch_infer(image_dirs, output_csv='inference_results.csv'):
-    results = []
+def find_images(image_dirs):
+    paths = []
     for root_dir in image_dirs:
         for subdir, _, files in os.walk(root_dir):
             for fname in files:
                 if fname.lower().endswith(('.jpg', '.jpeg', '.png')):
-                    fpath = os.path.join(subdir, fname)
-                    try:
-                        label, score = predict_image(fpath)
-                        results.append({'file': fpath, 'label': label, 'score': score})
-                    except Exception as e:
-                        print(f"Error processing {fpath}: {e}")
+                    paths.append(os.path.join(subdir, fname))
+    return paths
+
+
+def decoded_batches(paths, batch_size, executor, cache=None):
+    """Yields lists of (path, image or exception), keeping PREFETCH_BATCHES batches decoding in the background."""
+    def collect(chunk, futures):
+        decoded = []
+        for fpath, future in zip(chunk, futures):
+            try:
+                decoded.append((fpath, future.result()))
+            except Exception as e:
+                decoded.append((fpath, e))
+        return decoded
+
+    pending = deque()
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        pending.append((chunk, [executor.submit(load_image, p, cache) for p in chunk]))
+        if len(pending) > PREFETCH_BATCHES:
+            yield collect(*pending.popleft())
+    while pending:
+        yield collect(*pending.popleft())
+
+
+def batch_infer(image_dirs, output_csv='inference_results.csv', batch_size=BATCH_SIZE, workers=WORKERS, crop_cache_dir=None, index_path=None, predict=None):
+    from crop_cache import CropCache
+    from score_index import ScoreIndex, model_version
+    predict = predict or get_model().predict_on_batch
+    paths = find_images(image_dirs)
+    cache = CropCache(crop_cache_dir, img_size()) if crop_cache_dir else None
+    index = ScoreIndex(index_path) if index_path else None
+    to_score = paths
+    if index is not None:
+        version = model_version(MODEL_PATH)
+        to_score = index.missing(paths, version, ['score'])
+        print(f"{len(paths) - len(to_score)} of {len(paths)} images already scored in {index_path}")
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for batch in decoded_batches(to_score, batch_size, executor, cache):
+            images = []
+            for fpath, img in batch:
+                if isinstance(img, Exception):
+                    print(f"Error processing {fpath}: {img}")
+                else:
+                    images.append((fpath, img))
+            if not images:
+                continue
+            try:
+                preds = predict(pad_batch([img for _, img in images], batch_size))
+            except Exception as e:
+                for fpath, _ in images:
+                    print(f"Error processing {fpath}: {e}")
+                continue
+            for (fpath, _), pred in zip(images, np.asarray(preds)[:, 0]):
+                label = class_labels[1] if pred > 0.5 else class_labels[0]
+                results.append({'file': fpath, 'label': label, 'score': pred})
+                if index is not None:
+                    index.store(fpath, version, ['score'], [pred])
+            if index is not None:
+                index.commit()
+            print(f"\rScored {len(results)}/{len(to_score)} images", end='', flush=True)
+    print()
+    if cache is not None:
+        cache.flush()
+    if index is not None:
+        # Export all current files from the index, in walk order
+        scores = index.scores(paths, version, ['score'])
+        results = []
+        for fpath in paths:
+            if fpath in scores:
+                score = np.float32(scores[fpath][0])
+                results.append({'file': fpath, 'label': class_labels[1] if score > 0.5 else class_labels[0], 'score': score})
     # Save to CSV
     with open(output_csv, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=['file', 'label', 'score'])
@@ -60,5 +171,17 @@ def batch_infer(image_dirs, output_csv='inference_results.csv'):
             print(f"{row['file']}: {row['label']} (score: {row['score']:.3f})")
 
 if __name__ == "__main__":
-    # By default, process both dataset/ and testset/
-    batch_infer(['dataset', 'testset'])
+    parser = argparse.ArgumentParser(description="Batch classify images with the trained model.")
+    parser.add_argument('image_dirs', nargs='*', default=['dataset', 'testset'], help='Directories to scan for images (default: dataset testset)')
+    parser.add_argument('--output', default='inference_results.csv', help='Output CSV path')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Number of images per predict call')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Number of threads decoding and cropping images')
+    parser.add_argument('--crop-cache', metavar='DIR', help='Read/write cropped images from this on-disk cache')
+    parser.add_argument('--index', metavar='DB', help='SQLite score index; only new or changed images are scored')
+    parser.add_argument('--xla', action='store_true', help='Run an XLA-compiled forward pass')
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION, help='Dtype policy for inference')
+    args = parser.parse_args()
+    from precision import set_precision, with_policy, compiled_predict
+    fast_model = with_policy(get_model(), set_precision(args.precision))
+    predict = compiled_predict(fast_model, args.batch_size) if args.xla else fast_model.predict_on_batch
+    batch_infer(args.image_dirs, args.output, batch_size=args.batch_size, workers=args.workers, crop_cache_dir=args.crop_cache, index_path=args.index, predict=predict)
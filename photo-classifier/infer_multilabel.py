@@ -1,45 +1,144 @@
+"""
+infer_multilabel.py
+
+Runs the multi-label model on all images listed in labels_template.csv.
+Results are appended to the output CSV in chunks, so an interrupted run can be continued with --resume.
+With --index, scores are kept in a SQLite index and only new or changed images are scored; the CSV is then exported
+from the index. --xla runs an XLA-compiled forward pass and --precision mixed_bfloat16 scores in bfloat16 on CPUs
+that support it (see precision.py).
+Usage:
+    python infer_multilabel.py
+    python infer_multilabel.py --resume
+    python infer_multilabel.py --crop-cache .crop_cache
+    python infer_multilabel.py --index scores.sqlite  # only score new or changed images
+    python infer_multilabel.py --xla --precision mixed_bfloat16
+"""
 import os
+import csv
+import argparse
 import pandas as pd
 import numpy as np
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.image import img_to_array, load_img
 from preprocess import intelligent_center_crop
+from crop_cache import CropCache
+from score_index import ScoreIndex, model_version
+from precision import PRECISIONS, DEFAULT_PRECISION, set_precision, with_policy, compiled_predict
 
 IMG_DIR = 'datasets/multi-label/photos'
 MODEL_PATH = 'final_model_multilabel.keras'
 CSV_PATH = 'datasets/multi-label/labels_template.csv'
 OUT_CSV = 'inference_results_multilabel.csv'
-IMG_SIZE = 224
-
-# Load model and labels
-model = load_model(MODEL_PATH)
-labels_df = pd.read_csv(CSV_PATH)
-labels = labels_df.columns[1:]
-
-results = []
-
-for idx, row in labels_df.iterrows():
-    fname = row['filename']
-    img_path = os.path.join(IMG_DIR, fname)
-    # Bash-style progress bar
-    if idx % 10 == 0 or idx == len(labels_df) - 1:
-        pct = int((idx + 1) / len(labels_df) * 100)
-        bar = '=' * (pct // 2) + ' ' * (50 - pct // 2)
-        print(f"\r[{bar}] {pct}% ({idx+1}/{len(labels_df)})", end='', flush=True)
-    try:
-        img = load_img(img_path)
-        img = intelligent_center_crop(img, IMG_SIZE)
-        x = img_to_array(img) / 255.0
-        x = np.expand_dims(x, 0)
-        preds = model.predict(x, verbose=0)[0]
-        # Round to 3 decimals for CSV
-        preds = [float(f'{p:.3f}') for p in preds]
-        results.append([fname] + preds)
-    except Exception as e:
-        print(f"\nCould not process {img_path}: {e}")
-        continue
-print()  # Newline after progress bar
-
-out_df = pd.DataFrame(results, columns=['filename'] + list(labels))
-out_df.to_csv(OUT_CSV, index=False)
-print(f"Inference complete. Results written to {OUT_CSV}")
+# Number of result rows written (and flushed to disk) at once
+CHUNK_SIZE = 100
+
+
+def read_done_filenames(out_csv):
+    """Returns the filenames already in out_csv, dropping a trailing row that was cut off by a crash."""
+    with open(out_csv, 'rb+') as f:
+        content = f.read()
+        complete = content[:content.rfind(b'\n') + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+    rows = list(csv.reader(complete.decode('utf-8').splitlines()))
+    return {row[0] for row in rows[1:] if row}
+
+
+def write_chunk(f, writer, rows, index=None):
+    writer.writerows(rows)
+    f.flush()
+    os.fsync(f.fileno())
+    if index is not None:
+        index.commit()
+
+
+def export_from_index(index, version, labels_df, labels):
+    paths = [os.path.join(IMG_DIR, fname) for fname in labels_df['filename']]
+    scores = index.scores(paths, version, labels)
+    with open(OUT_CSV, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename'] + list(labels))
+        for fname, path in zip(labels_df['filename'], paths):
+            if path in scores:
+                writer.writerow([fname] + [float(f'{p:.3f}') for p in scores[path]])
+
+
+def main(resume=False, chunk_size=CHUNK_SIZE, crop_cache_dir=None, index_path=None, xla=False, precision=DEFAULT_PRECISION):
+    # Imported here so --help does not load TensorFlow
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.preprocessing.image import img_to_array, load_img
+    # Load model and labels
+    model = with_policy(load_model(MODEL_PATH), set_precision(precision))
+    predict = compiled_predict(model, 1) if xla else lambda x: model.predict(x, verbose=0)
+    img_size = model.input_shape[1]  # Crop size the model was trained with
+    cache = CropCache(crop_cache_dir, img_size) if crop_cache_dir else None
+    labels_df = pd.read_csv(CSV_PATH)
+    labels = labels_df.columns[1:]
+    index = ScoreIndex(index_path) if index_path else None
+
+    done = set()
+    if index is not None:
+        version = model_version(MODEL_PATH)
+        paths = [os.path.join(IMG_DIR, fname) for fname in labels_df['filename']]
+        missing = set(index.missing(paths, version, labels))
+        done = {fname for fname, path in zip(labels_df['filename'], paths) if path not in missing}
+        print(f"{len(done)} of {len(labels_df)} images already scored in {index_path}")
+    elif resume and os.path.exists(OUT_CSV):
+        done = read_done_filenames(OUT_CSV)
+        print(f"Resuming: {len(done)} images already in {OUT_CSV}")
+    if index is not None or not resume or not os.path.exists(OUT_CSV) or os.path.getsize(OUT_CSV) == 0:
+        with open(OUT_CSV, 'w', newline='') as f:
+            csv.writer(f).writerow(['filename'] + list(labels))
+
+    with open(OUT_CSV, 'a', newline='') as f:
+        writer = csv.writer(f)
+        chunk = []
+        for idx, row in enumerate(labels_df.itertuples(index=False)):
+            fname = row.filename
+            img_path = os.path.join(IMG_DIR, fname)
+            # Bash-style progress bar
+            if idx % 10 == 0 or idx == len(labels_df) - 1:
+                pct = int((idx + 1) / len(labels_df) * 100)
+                bar = '=' * (pct // 2) + ' ' * (50 - pct // 2)
+                print(f"\r[{bar}] {pct}% ({idx+1}/{len(labels_df)})", end='', flush=True)
+            if fname in done:
+                continue
+            try:
+                if cache is not None:
+                    x = cache.get(img_path).astype(np.float32) / 255.0
+                else:
+                    img = load_img(img_path)
+                    img = intelligent_center_crop(img, img_size)
+                    x = img_to_array(img) / 255.0
+                x = np.expand_dims(x, 0)
+                preds = predict(x)[0]
+                if index is not None:
+                    index.store(img_path, version, labels, preds)
+                # Round to 3 decimals for CSV
+                preds = [float(f'{p:.3f}') for p in preds]
+                chunk.append([fname] + preds)
+            except Exception as e:
+                print(f"\nCould not process {img_path}: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                write_chunk(f, writer, chunk, index)
+                chunk = []
+        if chunk:
+            write_chunk(f, writer, chunk, index)
+    if cache is not None:
+        cache.flush()
+    print()  # Newline after progress bar
+    if index is not None:
+        export_from_index(index, version, labels_df, labels)
+    print(f"Inference complete. Results written to {OUT_CSV}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the multi-label model on all labeled photos.")
+    parser.add_argument('--resume', action='store_true', help=f'Skip filenames already present in {OUT_CSV} and append to it')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Number of rows written to disk at once')
+    parser.add_argument('--crop-cache', metavar='DIR', help='Read/write cropped images from this on-disk cache')
+    parser.add_argument('--index', metavar='DB', help='SQLite score index; only new or changed images are scored')
+    parser.add_argument('--xla', action='store_true', help='Run an XLA-compiled forward pass')
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION, help='Dtype policy for inference')
+    args = parser.parse_args()
+    main(resume=args.resume, chunk_size=args.chunk_size, crop_cache_dir=args.crop_cache, index_path=args.index,
+         xla=args.xla, precision=args.precision)
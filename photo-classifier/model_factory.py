@@ -0,0 +1,92 @@
+"""
+model_factory.py
+
+Builds the classifier used by train.py, train_multilabel.py and rebuild_and_export_tfjs.py: a frozen ImageNet
+backbone followed by GlobalAveragePooling2D, Dropout(0.3), Dense(128), Dropout(0.2) and a float32 sigmoid output.
+All models take the same input, a crop rescaled to [0, 1]. Backbones that expect a different range get a
+Rescaling layer in front, so infer.py, scoring_server.py and ai.ts work with any of them unchanged.
+None of the weights depend on the input size, so train_progressive can train the head on smaller crops first
+(progressive resizing) and continue at full resolution with the same weights.
+Usage:
+    model = build_model(num_outputs=5, backbone='mobilenetv3small', img_size=160)
+    epochs_done = train_progressive(model, [(128, 10), (160, 10)], compile_model, datasets)
+"""
+from preprocess import IMG_SIZE
+
+# name: (tensorflow.keras.applications constructor, its extra arguments,
+#        (scale, offset) mapping [0, 1] inputs to what the backbone expects, or None)
+# Names only, so scripts can offer them as --backbone choices without importing TensorFlow
+BACKBONES = {
+    # The existing ResNet50 models were trained on [0, 1] inputs without ImageNet preprocessing, keep it that way
+    'resnet50': ('ResNet50', {}, None),
+    # EfficientNet normalizes [0, 255] inputs itself
+    'efficientnetb0': ('EfficientNetB0', {}, (255.0, 0.0)),
+    'mobilenetv3small': ('MobileNetV3Small', {'include_preprocessing': False}, (2.0, -1.0)),
+    'mobilenetv3large': ('MobileNetV3Large', {'include_preprocessing': False}, (2.0, -1.0)),
+}
+DEFAULT_BACKBONE = 'resnet50'
+FINE_TUNE_LAYERS = 30
+
+
+def build_model(num_outputs, backbone=DEFAULT_BACKBONE, img_size=IMG_SIZE, weights='imagenet', dropout=0.3,
+                dense_units=128, dense_dropout=0.2):
+    """Frozen backbone plus classification head, named '<backbone>_<img_size>'."""
+    from tensorflow.keras import applications
+    from tensorflow.keras.layers import Input, Rescaling, GlobalAveragePooling2D, Dropout, Dense
+    from tensorflow.keras.models import Model
+    name, kwargs, scale = BACKBONES[backbone]
+    constructor = getattr(applications, name)
+    inputs = Input(shape=(img_size, img_size, 3), name='input_layer')
+    x = inputs if scale is None else Rescaling(*scale, name='backbone_rescaling')(inputs)
+    base_model = constructor(weights=weights, include_top=False, input_shape=(img_size, img_size, 3), input_tensor=x,
+                             **kwargs)
+    base_model.trainable = False  # Freeze base for transfer learning
+
+    x = GlobalAveragePooling2D()(base_model.output)
+    x = Dropout(dropout)(x)
+    x = Dense(dense_units, activation='relu')(x)
+    x = Dropout(dense_dropout)(x)
+    output = Dense(num_outputs, activation='sigmoid', dtype='float32')(x)
+    return Model(inputs=inputs, outputs=output, name=f'{backbone}_{img_size}')
+
+
+def unfreeze_top(model, n_layers=FINE_TUNE_LAYERS):
+    """Makes the last n_layers backbone layers trainable for fine-tuning and keeps the rest frozen."""
+    from embedding_cache import gap_index
+    backbone_layers = model.layers[1:gap_index(model)]
+    for i, layer in enumerate(backbone_layers):
+        layer.trainable = i >= len(backbone_layers) - n_layers
+
+
+def resize_model(model, img_size):
+    """Copy of model (same layers and weights) taking img_size x img_size inputs."""
+    from tensorflow.keras.layers import Input
+    from tensorflow.keras.models import clone_model
+    resized = clone_model(model, input_tensors=Input(shape=(img_size, img_size, 3), name='input_layer'))
+    resized.set_weights(model.get_weights())
+    return resized
+
+
+def resolution_stage(spec):
+    """argparse type for 'IMG_SIZE:EPOCHS' progressive-resizing stages."""
+    img_size, epochs = spec.split(':')
+    return int(img_size), int(epochs)
+
+
+def train_progressive(model, schedule, compile_model, datasets, **fit_kwargs):
+    """
+    Trains model for each (img_size, epochs) stage of schedule on a resized copy, copying the weights back into
+    model after every stage. datasets(img_size) returns (train, val, steps_per_epoch) cropped to img_size.
+    Returns the number of epochs run, to be passed as initial_epoch to the full-resolution fit.
+    """
+    epochs_done = 0
+    for img_size, epochs in schedule:
+        print(f"Training {epochs} epochs at {img_size}x{img_size}...")
+        stage_model = resize_model(model, img_size)
+        compile_model(stage_model)
+        train_ds, val_ds, steps_per_epoch = datasets(img_size)
+        stage_model.fit(train_ds, validation_data=val_ds, steps_per_epoch=steps_per_epoch,
+                        initial_epoch=epochs_done, epochs=epochs_done + epochs, **fit_kwargs)
+        model.set_weights(stage_model.get_weights())
+        epochs_done += epochs
+    return epochs_done
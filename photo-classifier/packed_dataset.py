@@ -0,0 +1,165 @@
+"""
+packed_dataset.py
+
+Packs a labelled image directory and its labels CSV into TFRecord shards, so training reads a few large files
+instead of thousands of small JPEGs. Every record holds the encoded image bytes as they are on disk, the filename,
+the label vector and a record key (SHA-256 of image bytes and labels).
+manifest.json lists the label names, every shard with its SHA-256 and record count, and for every filename the key of
+its current record. Packing again only appends shards for new or changed images (or changed labels); the records they
+replace stay in the old shards and are skipped when reading. A file whose mtime or size changed but whose bytes and
+labels did not (a touch, a storage re-sync) keeps its record, so every key occurs in exactly one record. data_pipeline.get_multilabel_datasets(packed_dir=...)
+reads the shards directly.
+Usage:
+    python packed_dataset.py
+    python packed_dataset.py --img-dir datasets/multi-label/augmented --csv datasets/multi-label/labels_augmented.csv
+    python packed_dataset.py --verify
+"""
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from crop_cache import file_hash
+
+IMG_DIR = 'datasets/multi-label/augmented'
+CSV_PATH = 'datasets/multi-label/labels_augmented.csv'
+PACK_DIR = 'datasets/multi-label/packed'
+MANIFEST_FILE = 'manifest.json'
+# Number of records per shard file
+SHARD_SIZE = 2048
+# Threads reading source images, mostly waiting on (network) storage
+WORKERS = 16
+
+
+def record_features(n_labels):
+    import tensorflow as tf  # only for reading and writing shards; --help and --verify do without it
+    return {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'filename': tf.io.FixedLenFeature([], tf.string),
+        'key': tf.io.FixedLenFeature([], tf.string),
+        'labels': tf.io.FixedLenFeature([n_labels], tf.float32)
+    }
+
+
+def read_manifest(pack_dir):
+    path = os.path.join(pack_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'labels': None, 'shards': [], 'records': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(pack_dir, manifest):
+    path = os.path.join(pack_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def record_key(contents, labels):
+    h = hashlib.sha256(contents)
+    h.update(np.asarray(labels, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def write_shard(pack_dir, manifest, records):
+    """Writes records (filename, contents, labels, key) to a new shard and adds them to the manifest."""
+    import tensorflow as tf
+    name = f'shard_{len(manifest["shards"]):05d}.tfrecord'
+    path = os.path.join(pack_dir, name)
+    # Write to a temporary name first, so an interrupted run never leaves a partial shard under the final name
+    with tf.io.TFRecordWriter(path + '.tmp') as writer:
+        for fname, contents, labels, key in records:
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[contents])),
+                'filename': tf.train.Feature(bytes_list=tf.train.BytesList(value=[fname.encode()])),
+                'key': tf.train.Feature(bytes_list=tf.train.BytesList(value=[key.encode()])),
+                'labels': tf.train.Feature(float_list=tf.train.FloatList(value=labels))
+            }))
+            writer.write(example.SerializeToString())
+    os.replace(path + '.tmp', path)
+    manifest['shards'].append({'file': name, 'sha256': file_hash(path), 'records': len(records)})
+    write_manifest(pack_dir, manifest)
+
+
+def pack(img_dir=IMG_DIR, csv_path=CSV_PATH, pack_dir=PACK_DIR, shard_size=SHARD_SIZE, workers=WORKERS):
+    labels_df = pd.read_csv(csv_path)
+    labels = list(labels_df.columns[1:])
+    manifest = read_manifest(pack_dir)
+    if manifest['labels'] not in (None, labels):
+        raise ValueError(f"{pack_dir} holds labels {manifest['labels']}, not {labels} from {csv_path}")
+    manifest['labels'] = labels
+    os.makedirs(pack_dir, exist_ok=True)
+    records = manifest['records']  # filename -> [key, mtime_ns, size, labels], avoids re-reading unchanged files
+    y = labels_df[labels].to_numpy(dtype=np.float32)
+    filenames = list(labels_df['filename'])
+
+    todo = []
+    for fname, label_row in zip(filenames, y.tolist()):
+        st = os.stat(os.path.join(img_dir, fname))
+        entry = records.get(fname)
+        if not entry or entry[1:] != [st.st_mtime_ns, st.st_size, label_row]:
+            todo.append((fname, label_row, st))
+    removed = set(records) - set(filenames)
+    for fname in removed:
+        del records[fname]
+    print(f"{len(filenames) - len(todo)} of {len(filenames)} images already packed in {pack_dir}, "
+          f"{len(todo)} to add, {len(removed)} removed")
+
+    def read(item):
+        fname, label_row, st = item
+        with open(os.path.join(img_dir, fname), 'rb') as f:
+            contents = f.read()
+        return fname, contents, label_row, record_key(contents, label_row)
+
+    pending = []  # changed records not yet written, with their stat
+    touched = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(todo), shard_size):
+            chunk = todo[start:start + shard_size]
+            for record, (_, _, st) in zip(executor.map(read, chunk), chunk):
+                fname, _, label_row, key = record
+                if fname in records and records[fname][0] == key:
+                    # Same bytes and labels (e.g. touched or re-synced): the packed record is still current
+                    records[fname] = [key, st.st_mtime_ns, st.st_size, label_row]
+                    touched += 1
+                else:
+                    pending.append((record, st))
+            while len(pending) >= shard_size or (pending and start + shard_size >= len(todo)):
+                shard, pending = pending[:shard_size], pending[shard_size:]
+                for (fname, _, label_row, key), st in shard:
+                    records[fname] = [key, st.st_mtime_ns, st.st_size, label_row]
+                write_shard(pack_dir, manifest, [record for record, _ in shard])
+            print(f"\rRead {start + len(chunk)}/{len(todo)} images", end='', flush=True)
+    print()
+    write_manifest(pack_dir, manifest)
+    stale = sum(s['records'] for s in manifest['shards']) - len(records)
+    print(f"{touched} images changed on disk but not in content, {len(manifest['shards'])} shards, "
+          f"{len(records)} current and {stale} replaced records")
+
+
+def verify(pack_dir=PACK_DIR):
+    """Checks every shard against the SHA-256 in the manifest."""
+    ok = True
+    for shard in read_manifest(pack_dir)['shards']:
+        if file_hash(os.path.join(pack_dir, shard['file'])) != shard['sha256']:
+            print(f"{shard['file']}: hash mismatch")
+            ok = False
+    print("All shards match the manifest." if ok else "Some shards do not match the manifest.")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack labelled images into TFRecord shards with a manifest.")
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the images named in the CSV')
+    parser.add_argument('--csv', default=CSV_PATH, help='Labels CSV (filename column, then one column per label)')
+    parser.add_argument('--out', default=PACK_DIR, help='Directory of the shards and manifest')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='Records per shard')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Threads reading source images')
+    parser.add_argument('--verify', action='store_true', help='Only check the shard hashes against the manifest')
+    args = parser.parse_args()
+    if args.verify:
+        raise SystemExit(0 if verify(args.out) else 1)
+    pack(args.img_dir, args.csv, args.out, args.shard_size, args.workers)
@@ -0,0 +1,78 @@
+"""
+precision.py
+
+Opt-in high-performance execution for training and inference: XLA-compiled (jit_compile) steps and
+mixed-precision dtype policies. Under a mixed policy layers compute in bfloat16/float16 while the weights stay
+float32, and the sigmoid output declared with dtype='float32' in model_factory.py keeps producing float32 scores.
+bfloat16 is only fast on CPUs with native support (AVX512-BF16 or AMX); elsewhere it is emulated and slower than
+float32, so set_precision falls back to float32 there. TensorFlow is imported by the functions that need it, so the
+scripts can offer PRECISIONS as options without loading it at startup.
+Usage:
+    precision = set_precision('mixed_bfloat16')  # before building a model
+    model = with_policy(load_model(path), precision)  # for a saved model
+    model.compile(..., jit_compile=True)
+    predict = compiled_predict(model, batch_size=32)
+"""
+import numpy as np
+
+PRECISIONS = ['float32', 'mixed_bfloat16', 'mixed_float16']
+DEFAULT_PRECISION = 'float32'
+# /proc/cpuinfo flags of CPUs with native bfloat16 matrix instructions
+BF16_CPU_FLAGS = {'avx512_bf16', 'amx_bf16'}
+
+
+def cpu_supports_bfloat16():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return bool(BF16_CPU_FLAGS & set(line.split(':', 1)[1].split()))
+    except OSError:
+        pass
+    return False
+
+
+def set_precision(precision=DEFAULT_PRECISION):
+    """Sets the global dtype policy for new models and returns the precision actually used."""
+    import tensorflow as tf
+    from tensorflow.keras import mixed_precision
+    if precision != 'float32' and not tf.config.list_physical_devices('GPU'):
+        if precision != 'mixed_bfloat16' or not cpu_supports_bfloat16():
+            print(f"{precision} is not supported natively by this CPU, using float32")
+            precision = 'float32'
+    mixed_precision.set_global_policy(precision)
+    return precision
+
+
+def with_policy(model, precision):
+    """model with its layers computing in precision and the same weights; the output layer stays float32."""
+    from tensorflow.keras.models import clone_model
+    output_layer = model.layers[-1]
+    if all(layer.dtype_policy.name == precision for layer in model.layers[1:-1]):
+        return model
+
+    def clone(layer):
+        config = layer.get_config()
+        if layer is not output_layer:
+            config['dtype'] = precision
+        return layer.__class__.from_config(config)
+
+    converted = clone_model(model, clone_function=clone, recursive=True)
+    converted.set_weights(model.get_weights())
+    return converted
+
+
+def compiled_predict(model, batch_size, jit_compile=True):
+    """predict_on_batch replacement running an XLA-compiled forward pass.
+    Smaller batches are zero-padded to batch_size, so a partial last batch does not trigger a recompile."""
+    import tensorflow as tf
+    forward = tf.function(lambda x: model(x, training=False), jit_compile=jit_compile)
+
+    def predict(images):
+        images = np.asarray(images, dtype=np.float32)
+        n = len(images)
+        if n < batch_size:
+            images = np.concatenate([images, np.zeros((batch_size - n,) + images.shape[1:], np.float32)])
+        return np.asarray(forward(images), dtype=np.float32)[:n]
+
+    return predict
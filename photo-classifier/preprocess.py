@@ -1,13 +1,13 @@
 """
 preprocess.py
 
-This script uses Keras to load images from the dataset, applies data augmentation, and resizes/crops images to 224x224 for ResNet50.
-It uses intelligent center cropping to preserve the face region as much as possible.
+Image preprocessing shared by the training and inference scripts: the augmentation policies per class, and resizing/
+cropping images to 224x224 for ResNet50 with intelligent center cropping to preserve the face region as much as
+possible. Training reads images through data_pipeline.py; running this script shows its augmented training batches.
 """
 
-import os
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.preprocessing import image
+import argparse
+import functools
 from PIL import Image
 import numpy as np
 import random
@@ -17,6 +17,27 @@ IMG_SIZE = 224
 BATCH_SIZE = 32
 DATASET_DIR = 'dataset'
 
+# Standard augmentation for 'compliant'
+COMPLIANT_AUGMENTATION = dict(
+    rotation_range=10,
+    width_shift_range=0.1,
+    height_shift_range=0.1,
+    brightness_range=(0.8, 1.2),
+    zoom_range=0.1,
+    horizontal_flip=True
+)
+# More aggressive augmentation for 'non-compliant'
+NONCOMPLIANT_AUGMENTATION = dict(
+    rotation_range=20,
+    width_shift_range=0.2,
+    height_shift_range=0.2,
+    brightness_range=(0.6, 1.4),
+    zoom_range=0.3,
+    shear_range=20,
+    horizontal_flip=True,
+    fill_mode='nearest'
+)
+
 def intelligent_center_crop(img, target_size):
     # Convert NumPy array to PIL Image if needed
     if isinstance(img, np.ndarray):
@@ -33,93 +54,87 @@ def intelligent_center_crop(img, target_size):
     arr = np.array(img).astype(np.float32)
     return arr
 
-def get_data_generators():
-    # Standard augmentation for 'compliant'
-    compliant_datagen = ImageDataGenerator(
-        rescale=1./255,
-        rotation_range=10,
-        width_shift_range=0.1,
-        height_shift_range=0.1,
-        brightness_range=(0.8, 1.2),
-        zoom_range=0.1,
-        horizontal_flip=True,
-        validation_split=0.2,
-        preprocessing_function=lambda img: intelligent_center_crop(img, IMG_SIZE)
-    )
-    # More aggressive augmentation for 'non-compliant'
-    noncompliant_datagen = ImageDataGenerator(
-        rescale=1./255,
-        rotation_range=20,
-        width_shift_range=0.2,
-        height_shift_range=0.2,
-        brightness_range=(0.6, 1.4),
-        zoom_range=0.3,
-        shear_range=20,
-        horizontal_flip=True,
-        fill_mode='nearest',
-        validation_split=0.2,
-        preprocessing_function=lambda img: intelligent_center_crop(img, IMG_SIZE)
-    )
-    # Generators for each class
-    compliant_train_gen = compliant_datagen.flow_from_directory(
-        os.path.join(DATASET_DIR),
-        target_size=(IMG_SIZE, IMG_SIZE),
-        batch_size=BATCH_SIZE // 2,
-        classes=['compliant'],
-        class_mode='binary',
-        subset='training',
-        interpolation='lanczos',
-        shuffle=True,
-        seed=42
-    )
-    noncompliant_train_gen = noncompliant_datagen.flow_from_directory(
-        os.path.join(DATASET_DIR),
-        target_size=(IMG_SIZE, IMG_SIZE),
-        batch_size=BATCH_SIZE // 2,
-        classes=['non-compliant'],
-        class_mode='binary',
-        subset='training',
-        interpolation='lanczos',
-        shuffle=True,
-        seed=42
-    )
-    # Validation generator (standard, both classes)
-    val_datagen = ImageDataGenerator(
-        rescale=1./255,
-        validation_split=0.2,
-        preprocessing_function=lambda img: intelligent_center_crop(img, IMG_SIZE)
-    )
-    val_generator = val_datagen.flow_from_directory(
-        os.path.join(DATASET_DIR),
-        target_size=(IMG_SIZE, IMG_SIZE),
-        batch_size=BATCH_SIZE,
-        class_mode='binary',
-        subset='validation',
-        interpolation='lanczos',
-        shuffle=False
-    )
-    # Custom generator to yield balanced batches
-    def balanced_train_generator():
-        while True:
-            x_c, _ = next(compliant_train_gen)
-            x_nc, _ = next(noncompliant_train_gen)
-            y_c = np.zeros(len(x_c), dtype=np.float32)  # compliant = 0
-            y_nc = np.ones(len(x_nc), dtype=np.float32) # non-compliant = 1
-            x = np.concatenate([x_c, x_nc], axis=0)
-            y = np.concatenate([y_c, y_nc], axis=0)
-            # Shuffle batch
-            idx = np.arange(len(x))
-            np.random.shuffle(idx)
-            yield x[idx], y[idx]
-    steps_per_epoch = min(len(compliant_train_gen), len(noncompliant_train_gen))
-    return balanced_train_generator(), val_generator, steps_per_epoch
+# Fixed-point precision of Pillow's 8-bit resampling (see libImaging/Resample.c)
+PRECISION_BITS = 32 - 8 - 2
+
+def _lanczos(x):
+    # Pillow's lanczos_filter: sinc(x) * sinc(x / 3) truncated to [-3, 3)
+    return np.where((x >= -3.0) & (x < 3.0), np.sinc(x) * np.sinc(x / 3.0), 0.0)
+
+@functools.lru_cache(maxsize=None)
+def _resample_matrix(in_size, out_size):
+    """Dense (in_size, out_size) LANCZOS weights in Pillow's fixed-point format, computed like precompute_coeffs."""
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+    matrix = np.zeros((in_size, out_size), dtype=np.float64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        weights = _lanczos((np.arange(xmin, xmax) - center + 0.5) * (1.0 / filterscale))
+        total = 0.0
+        for w in weights.tolist():  # sequential sum, as in C
+            total += w
+        if total != 0.0:
+            weights = weights / total
+        weights = weights * (1 << PRECISION_BITS)
+        matrix[xmin:xmax, xx] = np.trunc(np.where(weights < 0, weights - 0.5, weights + 0.5))
+    return matrix
+
+def _resample_axis(batch, matrix, axis):
+    # Products and sums of uint8 pixels and fixed-point weights are exact in float64, so BLAS gives Pillow's integer result
+    moved = np.moveaxis(batch, axis, -1)
+    acc = moved.astype(np.float64).reshape(-1, moved.shape[-1]) @ matrix
+    acc += 1 << (PRECISION_BITS - 1)
+    out = np.clip(np.floor(acc / (1 << PRECISION_BITS)), 0, 255).astype(np.uint8)
+    return np.moveaxis(out.reshape(moved.shape[:-1] + (matrix.shape[1],)), -1, axis)
+
+def batch_center_crop(batch, target_size, dtype=np.float32):
+    """
+    Vectorized intelligent_center_crop for a (N, H, W, C) batch without per-image PIL round-trips.
+    Gives exactly the same values as intelligent_center_crop. Pass dtype=np.uint8 to keep the result in uint8
+    until the final rescale.
+    """
+    batch = np.asarray(batch)
+    if batch.ndim == 3:
+        batch = batch[..., None]
+    # Same range detection as intelligent_center_crop, per image
+    needs_scale = batch.reshape(len(batch), -1).max(axis=1) <= 1.0
+    if needs_scale.any():
+        batch = batch * np.where(needs_scale, 255, 1).astype(batch.dtype)[:, None, None, None]
+    batch = batch.astype(np.uint8, copy=False)
+    # convert("RGB")
+    if batch.shape[-1] in (1, 2):
+        batch = np.repeat(batch[..., :1], 3, axis=-1)
+    elif batch.shape[-1] == 4:
+        batch = batch[..., :3]
+    height, width = batch.shape[1:3]
+    min_dim = min(height, width)
+    top = (height - min_dim) // 2
+    left = (width - min_dim) // 2
+    batch = batch[:, top:top + min_dim, left:left + min_dim]
+    if min_dim != target_size:
+        # Two passes like Pillow: horizontal first, then vertical, each rounded to uint8
+        matrix = _resample_matrix(min_dim, target_size)
+        batch = _resample_axis(batch, matrix, axis=2)
+        batch = _resample_axis(batch, matrix, axis=1)
+    return batch.astype(dtype)
+
+def crop_and_rescale(batch):
+    """Crops a generator batch and rescales it to [0, 1] like ImageDataGenerator(rescale=1./255)."""
+    return batch_center_crop(batch, IMG_SIZE, dtype=np.uint8).astype(np.float32) * np.float32(1. / 255)
 
 if __name__ == "__main__":
-    # Show random batches repeatedly
-    train_generator, _, _ = get_data_generators()
+    parser = argparse.ArgumentParser(description="Show random augmented training batches.")
+    parser.parse_args()
+    # Show random batches of the training pipeline (data_pipeline.get_datasets) repeatedly
+    from data_pipeline import get_datasets
+    train_ds, _, _ = get_datasets()
+    train_batches = iter(train_ds)
     import matplotlib.pyplot as plt
     while True:
-        x_batch, y_batch = next(train_generator)
+        x_batch, y_batch = (np.asarray(t) for t in next(train_batches))
         plt.figure(figsize=(12, 6))
         indices = random.sample(range(len(x_batch)), min(8, len(x_batch)))
         for i, idx in enumerate(indices):
@@ -1,33 +1,117 @@
 """
 quantize_model.py
 
-Quantizes a Keras model to TensorFlow Lite format with post-training quantization.
+Quantizes a Keras model with post-training quantization and reports what it costs and gains.
+Writes, next to the model:
+    <model>/                       TF.js model (float32 weights)
+    <model>_tfjs_float16/          TF.js model with float16 weights
+    <model>_tfjs_uint8/            TF.js model with uint8 weights
+    <model>_float16.tflite         TFLite model with float16 weights
+    <model>_int8.tflite            Full-integer TFLite model, calibrated on datasets/multi-label/photos
+    <model>_quantization_report.json
+The report compares model size, load time, per-image latency and per-label accuracy drift against the float32
+Keras model. The int8 model is calibrated on the first --calibration-images photos and all measurements use the
+next --images photos, so the calibration photos never flatter the int8 drift. TF.js models can only be run in
+JavaScript, so only their size is reported. Exits with status 1 if a conversion or measurement fails.
 Usage:
-    python quantize_model.py --model final_model.keras
-    # Output will be final_model.tflite
-    python quantize_model.py --model best_model.keras
-    # Output will be best_model.tflite
-    python quantize_model.py --model my_model.h5
-    # Output will be my_model.tflite
+    python quantize_model.py --model final_model_multilabel.keras
+    python quantize_model.py --model final_model_multilabel.keras --images 500 --calibration-images 200 --skip-tfjs
 """
 
 import os
 os.environ['TF_ENABLE_MLIR_GRAPH_DUMP'] = '0'
-import tensorflow as tf
+import json
+import time
 import argparse
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from PIL import Image
+from preprocess import intelligent_center_crop, IMG_SIZE
+
+IMG_DIR = 'datasets/multi-label/photos'
+LABELS_CSV = 'datasets/multi-label/labels_template.csv'
+N_IMAGES = 200
+N_CALIBRATION_IMAGES = 100
+
+
+def load_images(img_dir, labels_csv, n_images, img_size=IMG_SIZE, skip=0):
+    """(filenames, rescaled images, label matrix or None) for up to n_images photos after the first skip."""
+    if os.path.exists(labels_csv):
+        labels_df = pd.read_csv(labels_csv).iloc[skip:skip + n_images]
+        fnames = list(labels_df['filename'])
+        y = labels_df.iloc[:, 1:].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+    else:
+        fnames = sorted(f for f in os.listdir(img_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))[skip:skip + n_images]
+        y = None
+    x = np.stack([intelligent_center_crop(Image.open(os.path.join(img_dir, f)), img_size) / 255.0 for f in fnames])
+    return fnames, x.astype(np.float32), y
+
+
+def convert_tflite(model, mode, calibration_images):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        # Full integer: every op runs in int8; inputs and outputs stay float32 so callers need no changes
+        def representative_dataset():
+            for img in calibration_images:
+                yield [img[None]]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+class TFLiteModel:
+    def __init__(self, path):
+        self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]['index']
+        self.output = self.interpreter.get_output_details()[0]['index']
 
-import tensorflowjs as tfjs
+    def predict_one(self, x):
+        self.interpreter.set_tensor(self.input, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)
 
-parser = argparse.ArgumentParser(description="Quantize a Keras model to TFLite format.")
-parser.add_argument('--model', type=str, required=True, help='Path to the Keras model file (.keras or .h5)')
-args = parser.parse_args()
 
-model_path = args.model
-output_path = os.path.splitext(model_path)[0]
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
 
-print(f"TensorFlow version: {tf.__version__}, Keras version: {tf.keras.__version__}")
 
-try:
+def measure(load, predict_one, images):
+    """Load time, per-image latencies (batch of 1) and predictions."""
+    start = time.perf_counter()
+    model = load()
+    load_time = time.perf_counter() - start
+    latencies, preds = [], []
+    for img in images:
+        start = time.perf_counter()
+        preds.append(np.asarray(predict_one(model, img[None]))[0])
+        latencies.append(time.perf_counter() - start)
+    return load_time, np.array(latencies[1:] or latencies), np.stack(preds)
+
+
+def label_report(preds, reference, y, label_names):
+    report = {}
+    for i, name in enumerate(label_names):
+        entry = {
+            'mean_abs_diff_to_float32': float(np.mean(np.abs(preds[:, i] - reference[:, i]))),
+            'agreement_with_float32': float(np.mean((preds[:, i] > 0.5) == (reference[:, i] > 0.5)))
+        }
+        if y is not None and not np.isnan(y[:, i]).all():
+            known = ~np.isnan(y[:, i])
+            entry['accuracy'] = float(np.mean((preds[known, i] > 0.5) == (y[known, i] > 0.5)))
+        report[name] = entry
+    return report
+
+
+def main(model_path, n_images=N_IMAGES, skip_tfjs=False, n_calibration=N_CALIBRATION_IMAGES):
+    output_path = os.path.splitext(model_path)[0]
+    print(f"TensorFlow version: {tf.__version__}, Keras version: {tf.keras.__version__}")
     print(f"Loading model from {model_path} ...", flush=True)
     model = tf.keras.models.load_model(model_path)
     # Convert all layers to float32 for TFLite compatibility
@@ -37,12 +121,71 @@ try:
                 layer._dtype = 'float32'
             except Exception:
                 pass
-    print("Converting to quantized TFLite format ...", flush=True)
 
-    tfjs.converters.save_keras_model(model, output_path)
+    print(f"Loading up to {n_calibration} calibration and {n_images} evaluation images from {IMG_DIR} ...", flush=True)
+    _, calibration_images, _ = load_images(IMG_DIR, LABELS_CSV, n_calibration, model.input_shape[1])
+    fnames, images, y = load_images(IMG_DIR, LABELS_CSV, n_images, model.input_shape[1], skip=n_calibration)
+    if not len(fnames):
+        raise ValueError(f"No evaluation images left after the {n_calibration} calibration images")
+    label_names = list(pd.read_csv(LABELS_CSV, nrows=0).columns[1:]) if os.path.exists(LABELS_CSV) else None
+
+    outputs = {}
+    for mode in ['float16', 'int8']:
+        print(f"Converting to {mode} TFLite ...", flush=True)
+        path = f'{output_path}_{mode}.tflite'
+        with open(path, 'wb') as f:
+            f.write(convert_tflite(model, mode, calibration_images))
+        outputs[f'tflite_{mode}'] = path
+    if not skip_tfjs:
+        import tensorflowjs as tfjs
+        for name, dtype_map in [('', None), ('_tfjs_float16', {'float16': '*'}), ('_tfjs_uint8', {'uint8': '*'})]:
+            print(f"Saving TF.js model{name or ''} ...", flush=True)
+            tfjs.converters.save_keras_model(model, output_path + name, quantization_dtype_map=dtype_map)
+            outputs['tfjs' + (name.replace('_tfjs', '') or '_float32')] = output_path + name
+
+    print("Measuring ...", flush=True)
+    results = {}
+    load_time, latencies, reference = measure(lambda: tf.keras.models.load_model(model_path),
+                                              lambda m, x: m(x, training=False), images)
+    results['keras_float32'] = {'path': model_path, 'size_bytes': dir_size(model_path), 'load_time_s': load_time,
+                                'latency_ms_p50': float(np.median(latencies) * 1000), 'latency_ms_mean': float(np.mean(latencies) * 1000)}
+    label_names = label_names or [f'label_{i}' for i in range(reference.shape[1])]
+    results['keras_float32']['labels'] = label_report(reference, reference, y, label_names)
+    for name, path in outputs.items():
+        results[name] = {'path': path, 'size_bytes': dir_size(path)}
+        if name.startswith('tflite'):
+            load_time, latencies, preds = measure(lambda: TFLiteModel(path), lambda m, x: m.predict_one(x), images)
+            results[name].update({'load_time_s': load_time,
+                                  'latency_ms_p50': float(np.median(latencies) * 1000),
+                                  'latency_ms_mean': float(np.mean(latencies) * 1000),
+                                  'labels': label_report(preds, reference, y, label_names)})
+
+    report_path = f'{output_path}_quantization_report.json'
+    with open(report_path, 'w') as f:
+        json.dump({'model': model_path, 'calibration_images': len(calibration_images), 'images': len(fnames),
+                   'results': results}, f, indent=2)
+    print(f"\n{'format':<18}{'size MB':>10}{'load s':>9}{'p50 ms':>9}  max label drift")
+    for name, r in results.items():
+        drift = max((v['mean_abs_diff_to_float32'] for v in r.get('labels', {}).values()), default=None)
+        print(f"{name:<18}{r['size_bytes'] / 1e6:>10.2f}"
+              f"{r['load_time_s'] if 'load_time_s' in r else float('nan'):>9.2f}"
+              f"{r['latency_ms_p50'] if 'latency_ms_p50' in r else float('nan'):>9.1f}"
+              f"  {'-' if drift is None else f'{drift:.4f}'}")
+    print(f"Report saved to {report_path}", flush=True)
+
 
-    print(f"Quantized model saved to {output_path}", flush=True)
-except Exception as e:
-    print(f"Error during quantization: {e}", flush=True)
-    import traceback
-    traceback.print_exc()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize a Keras model to float16/int8 TFLite and TF.js formats.")
+    parser.add_argument('--model', type=str, required=True, help='Path to the Keras model file (.keras or .h5)')
+    parser.add_argument('--images', type=int, default=N_IMAGES, help='Number of photos used for the measurements')
+    parser.add_argument('--calibration-images', type=int, default=N_CALIBRATION_IMAGES,
+                        help='Number of photos (before the measured ones) used for int8 calibration')
+    parser.add_argument('--skip-tfjs', action='store_true', help='Only produce the TFLite models')
+    args = parser.parse_args()
+    try:
+        main(args.model, args.images, args.skip_tfjs, args.calibration_images)
+    except Exception as e:
+        print(f"Error during quantization: {e}", flush=True)
+        import traceback
+        traceback.print_exc()
+        raise SystemExit(1)
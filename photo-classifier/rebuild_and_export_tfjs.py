@@ -2,36 +2,37 @@
 rebuild_and_export_tfjs.py
 
 Rebuilds the model architecture with explicit Input layer, loads trained weights, and exports to TensorFlow.js format.
+Pass the weights file and the backbone and input resolution the model was trained with (see model_factory.py).
+Usage:
+    python rebuild_and_export_tfjs.py
+    python rebuild_and_export_tfjs.py --weights mobilenetv3small.keras --backbone mobilenetv3small --img-size 160 --output models/tfjs_small/
 """
 import os
-os.environ['TF_USE_LEGACY_KERAS'] = '1' 
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.layers import Input, GlobalAveragePooling2D, Dropout, Dense
-from tensorflow.keras.models import Model
-import tensorflowjs as tfjs
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+import argparse
+from model_factory import BACKBONES, DEFAULT_BACKBONE, build_model
 
 IMG_SIZE = 224
 NUM_LABELS = 5  # Set this to your number of output labels
 KERAS_WEIGHTS_PATH = 'models/final_model_multilabel.keras'  # Path to your trained weights
 TFJS_EXPORT_PATH = 'models/tfjs/'  # Output directory for TFJS model
 
+parser = argparse.ArgumentParser(description="Rebuild the multi-label model and export it to TensorFlow.js.")
+parser.add_argument('--backbone', choices=sorted(BACKBONES), default=DEFAULT_BACKBONE, help='Backbone the model was trained with')
+parser.add_argument('--img-size', type=int, default=IMG_SIZE, help='Input resolution the model was trained with')
+parser.add_argument('--weights', default=KERAS_WEIGHTS_PATH, help='Trained .keras model to load the weights from')
+parser.add_argument('--output', default=TFJS_EXPORT_PATH, help='Output directory for the TFJS model')
+args = parser.parse_args()
+import tensorflowjs as tfjs  # loads TensorFlow, so only after --help
+
 # 1. Build the model architecture with explicit Input layer
-input_tensor = Input(shape=(224, 224, 3), name='input_layer')
-base_model = ResNet50(weights='imagenet', include_top=False, input_shape=(224, 224, 3), input_tensor=input_tensor)
-base_model.trainable = False
-x = base_model.output
-x = GlobalAveragePooling2D()(x)
-x = Dropout(0.3)(x)
-x = Dense(128, activation='relu')(x)
-x = Dropout(0.2)(x)
-output = Dense(NUM_LABELS, activation='sigmoid', dtype='float32')(x)
-model = Model(inputs=base_model.input, outputs=output)
+model = build_model(NUM_LABELS, args.backbone, args.img_size)
 
 # 2. Load your trained weights
-model.load_weights(KERAS_WEIGHTS_PATH)
-print(f"Loaded weights from {KERAS_WEIGHTS_PATH}")
+model.load_weights(args.weights)
+print(f"Loaded weights from {args.weights}")
 
 # 3. Export to TFJS
-os.makedirs(TFJS_EXPORT_PATH, exist_ok=True)
-tfjs.converters.save_keras_model(model, TFJS_EXPORT_PATH)
-print(f"Model exported to TFJS format at {TFJS_EXPORT_PATH}")
+os.makedirs(args.output, exist_ok=True)
+tfjs.converters.save_keras_model(model, args.output)
+print(f"Model exported to TFJS format at {args.output}")
@@ -0,0 +1,81 @@
+"""
+sampler.py
+
+File index and batch samplers of the tf.data pipelines in data_pipeline.py. BalancedSampler decides which class fills
+each slot of a batch, so every batch holds a fixed share of each class; data_pipeline.get_datasets draws the images
+from per-class datasets that repeat in reshuffled passes independently. An epoch keeps its old length (one pass over
+the smaller class), so the larger class is not seen completely within one epoch, but over consecutive epochs instead
+of being cut off at the length of the smaller one.
+"""
+import os
+import math
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+VALIDATION_SPLIT = 0.2
+
+
+def list_class_files(dataset_dir, cls):
+    """Files of one class in the order flow_from_directory lists them."""
+    files = []
+    for subdir, _, fnames in sorted(os.walk(os.path.join(dataset_dir, cls)), key=lambda w: w[0]):
+        files += [os.path.join(subdir, f) for f in sorted(fnames) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return files
+
+
+def split_files(files, validation_split=VALIDATION_SPLIT):
+    """(training, validation) split matching ImageDataGenerator(validation_split=...)."""
+    n_val = int(validation_split * len(files))
+    return files[n_val:], files[:n_val]
+
+
+def batch_counts(ratios, batch_size):
+    """Splits batch_size into per-group counts proportional to ratios (largest remainder)."""
+    ratios = np.asarray(ratios, dtype=np.float64) / np.sum(ratios)
+    exact = ratios * batch_size
+    counts = np.floor(exact).astype(int)
+    for i in np.argsort(counts - exact)[:batch_size - counts.sum()]:
+        counts[i] += 1
+    return counts
+
+
+class BalancedSampler:
+    """Endless batch layouts with a fixed number of slots for each group per batch."""
+
+    def __init__(self, groups, ratios, batch_size, seed=42):
+        self.groups = [np.asarray(g) for g in groups]
+        self.counts = batch_counts(ratios, batch_size)
+        self.rng = np.random.default_rng(seed)
+        # Epoch length as before: one pass over the group that runs out first
+        self.steps_per_epoch = min(math.ceil(len(g) / c) for g, c in zip(self.groups, self.counts) if c > 0)
+
+    def batch_groups(self):
+        """Endless arrays of group ids, one per batch slot, shuffled within the batch."""
+        slots = np.repeat(np.arange(len(self.groups)), self.counts)
+        while True:
+            yield self.rng.permutation(slots)
+
+
+def label_balancing_weights(y, target=0.5):
+    """
+    Per-sample weights for a multi-label matrix y that move each label's positive rate towards target:
+    the mean over labels of target / positive rate for positives and (1 - target) / negative rate for negatives.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    pos = np.clip(y.mean(axis=0), 1e-6, 1 - 1e-6)
+    weights = (y * (target / pos) + (1 - y) * ((1 - target) / (1 - pos))).mean(axis=1)
+    return weights / weights.sum()
+
+
+class WeightedSampler:
+    """Endless batches of indices drawn with the given per-sample probabilities (no repeats within a batch)."""
+
+    def __init__(self, weights, batch_size, seed=42):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.steps_per_epoch = math.ceil(len(self.weights) / batch_size)
+
+    def __iter__(self):
+        while True:
+            yield self.rng.choice(len(self.weights), self.batch_size, replace=False, p=self.weights)
@@ -0,0 +1,78 @@
+"""
+score_index.py
+
+Persistent SQLite index of model scores. Files are mapped to the SHA-256 of their content, and scores are stored per
+content hash, model version and label, so a rerun only has to score images that are new or have changed (or all
+images once the model changes). infer.py and infer_multilabel.py use it with --index and export their CSVs from it.
+"""
+import os
+import sqlite3
+from crop_cache import file_hash
+
+INDEX_PATH = 'scores.sqlite'
+
+
+def model_version(model_path):
+    """Identifies a model by the hash of its file."""
+    return file_hash(model_path)[:16]
+
+
+class ScoreIndex:
+    def __init__(self, db_path=INDEX_PATH):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, content_hash TEXT);
+            CREATE TABLE IF NOT EXISTS scores (
+                content_hash TEXT, model_version TEXT, label TEXT, score REAL,
+                PRIMARY KEY (content_hash, model_version, label));
+        """)
+
+    def content_hash(self, path):
+        """Content hash of path; only re-reads the file when its size or modification time changed."""
+        st = os.stat(path)
+        row = self.db.execute('SELECT mtime_ns, size, content_hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            return row[2]
+        digest = file_hash(path)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, st.st_mtime_ns, st.st_size, digest))
+        return digest
+
+    def try_content_hash(self, path):
+        """content_hash, or None for a file that is missing or unreadable."""
+        try:
+            return self.content_hash(path)
+        except OSError:
+            return None
+
+    def missing(self, paths, version, labels):
+        """
+        Paths whose current content has no complete set of scores for version. Unreadable paths are included, so
+        the caller tries to score them and reports the error like for any other image.
+        """
+        complete = {row[0] for row in self.db.execute(
+            'SELECT content_hash FROM scores WHERE model_version = ? GROUP BY content_hash HAVING COUNT(*) = ?',
+            (version, len(labels)))}
+        result = [p for p in paths if self.try_content_hash(p) not in complete]
+        self.db.commit()
+        return result
+
+    def store(self, path, version, labels, scores):
+        self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                            [(self.content_hash(path), version, label, float(s)) for label, s in zip(labels, scores)])
+
+    def commit(self):
+        self.db.commit()
+
+    def scores(self, paths, version, labels):
+        """{path: [score per label]} for all readable paths with a complete set of scores for version."""
+        by_hash = {}
+        for content_hash, label, score in self.db.execute(
+                'SELECT content_hash, label, score FROM scores WHERE model_version = ?', (version,)):
+            by_hash.setdefault(content_hash, {})[label] = score
+        result = {}
+        for path in paths:
+            label_scores = by_hash.get(self.try_content_hash(path), {})
+            if all(label in label_scores for label in labels):
+                result[path] = [label_scores[label] for label in labels]
+        return result
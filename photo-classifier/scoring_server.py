@@ -0,0 +1,129 @@
+"""
+scoring_server.py
+
+Local HTTP scoring service for the multi-label photo-quality model. The model is loaded once; concurrent requests
+are combined into one predict call (dynamic micro-batching) as soon as MAX_BATCH images are waiting or the oldest
+one has waited MAX_WAIT_MS.
+Usage:
+    python scoring_server.py --port 8080
+    curl --data-binary @photo.jpg http://localhost:8080/score
+    # {"brightBackground": 0.91, "neutralBackground": 0.12, "whiteShirt": 0.05, "highQuality": 0.88, "businessAttire": 0.97}
+"""
+import io
+import json
+import queue
+import threading
+import time
+import argparse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+from tensorflow.keras.models import load_model
+from preprocess import intelligent_center_crop
+
+MODEL_PATH = 'final_model_multilabel.keras'
+# Same order as PhotoLabels in azure-functions/src/functions/validator/rules/ai.ts
+LABELS = ['brightBackground', 'neutralBackground', 'whiteShirt', 'highQuality', 'businessAttire']
+MAX_BATCH = 32
+MAX_WAIT_MS = 10
+
+
+class MicroBatcher:
+    """Collects single images from many threads and scores them together in one predict call."""
+
+    def __init__(self, model, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, image):
+        future = Future()
+        self.requests.put((image, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                preds = np.asarray(self.model.predict_on_batch(np.stack([image for image, _ in batch])))
+                for (_, future), pred in zip(batch, preds):
+                    future.set_result(pred)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def preprocess_bytes(data, img_size):
+    img = intelligent_center_crop(Image.open(io.BytesIO(data)), img_size)
+    return img / 255.0
+
+
+def make_handler(batcher):
+    img_size = batcher.model.input_shape[1]
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                image = preprocess_bytes(self.rfile.read(int(self.headers.get('Content-Length', 0))), img_size)
+            except Exception as e:
+                self.send_json(400, {'error': f'Could not read image: {e}'})
+                return
+            try:
+                pred = batcher.submit(image).result()
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+            if len(pred) != len(LABELS):
+                self.send_json(500, {'error': f'Unexpected prediction length: {len(pred)}. Expected {len(LABELS)}.'})
+                return
+            self.send_json(200, {label: float(p) for label, p in zip(LABELS, pred)})
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the output under load
+
+    return ScoringHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the multi-label photo model over HTTP with micro-batching.")
+    parser.add_argument('--model', default=MODEL_PATH, help='Path to the Keras model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='Maximum number of images per predict call')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS, help='Maximum time a request waits for others to join its batch')
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    batcher = MicroBatcher(model, args.max_batch, args.max_wait_ms)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    print(f"Scoring {args.model} on http://{args.host}:{args.port}/score")
+    server.serve_forever()
@@ -0,0 +1,159 @@
+"""
+telemetry.py
+
+Headless replacement for LivePlotCallback for training on remote nodes. TelemetryCallback writes every training
+step and epoch to <log_dir>/steps.jsonl and <log_dir>/epochs.jsonl and the same values to TensorBoard summaries
+in <log_dir>. Steps are split into the time spent waiting for the input pipeline and the time spent computing. The
+epoch summary says which share of the step time went to waiting. The logs also hold images/sec, peak RSS and, with
+validation_data and label_names, per-label validation metrics. Those take an extra prediction pass over the
+validation set every epoch on top of Keras' own validation, so the training scripts only pass validation_data with
+--label-metrics. The log files are open from the start to the end of each fit.
+Input wait can only be measured on datasets passed through timed(): its last stage is a sequential map after the
+prefetch buffer, so it runs when the training step asks for a batch and records when the batch arrived.
+Usage:
+    telemetry = TelemetryCallback('logs/run1', profile_steps=(100, 110))
+    model.fit(telemetry.timed(train_ds), validation_data=val_ds, callbacks=[telemetry])
+    tensorboard --logdir logs/run1
+"""
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+from benchmark import current_rss
+
+
+class TelemetryCallback(Callback):
+    def __init__(self, log_dir, validation_data=None, label_names=None, profile_steps=None):
+        """profile_steps=(start, stop) captures a TF profiler trace of these global steps into log_dir."""
+        super().__init__()
+        self.log_dir = log_dir
+        self.validation_data = validation_data
+        self.label_names = label_names
+        self.profile_steps = profile_steps
+        self.profiling = False
+        self.global_step = 0
+        self.fit_index = -1
+        self.arrivals = []
+        os.makedirs(log_dir, exist_ok=True)
+        self.writer = tf.summary.create_file_writer(log_dir)
+
+    def timed(self, dataset):
+        """dataset with the arrival time and size of every batch recorded for the input-wait breakdown."""
+        def arrived(n):
+            self.arrivals.append((time.perf_counter(), int(n)))
+            return np.int64(0)
+
+        def record(*batch):
+            token = tf.py_function(arrived, [tf.shape(tf.nest.flatten(batch)[0])[0]], tf.int64)
+            with tf.control_dependencies([token]):
+                batch = tf.nest.map_structure(tf.identity, batch)
+            return batch if len(batch) > 1 else batch[0]
+        return dataset.map(record)
+
+    def on_train_begin(self, logs=None):
+        self.fit_index += 1
+        # The same callback may log several fits (head training, fine-tuning)
+        self.step_log = open(os.path.join(self.log_dir, 'steps.jsonl'), 'a')
+        self.epoch_log = open(os.path.join(self.log_dir, 'epochs.jsonl'), 'a')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = time.perf_counter()
+        self.epoch_steps = []
+        self.peak_rss = current_rss()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.log_dir)
+            self.profiling = True
+        self.arrivals.clear()
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        logs = {k: float(v) for k, v in (logs or {}).items()}  # waits for the step to finish
+        end = time.perf_counter()
+        if self.profiling and self.global_step == self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        step = {'fit': self.fit_index, 'epoch': self.epoch, 'step': self.global_step, 'step_s': end - self.step_start,
+                'rss_mb': rss / 2**20}
+        if self.arrivals:
+            arrival, n_images = self.arrivals[-1]
+            step['input_wait_s'] = max(0.0, arrival - self.step_start)
+            step['compute_s'] = end - max(arrival, self.step_start)
+            step['images_per_sec'] = n_images / step['step_s']
+        step.update(logs)
+        self.epoch_steps.append(step)
+        self.step_log.write(json.dumps(step) + '\n')
+        with self.writer.as_default(step=self.global_step):
+            for key in ['step_s', 'input_wait_s', 'compute_s', 'images_per_sec', 'rss_mb']:
+                if key in step:
+                    tf.summary.scalar(f'step/{key}', step[key])
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps = self.epoch_steps
+        step_time = sum(s['step_s'] for s in steps)
+        summary = {'fit': self.fit_index, 'epoch': epoch, 'wall_s': time.perf_counter() - self.epoch_start,
+                   'steps': len(steps), 'mean_step_s': step_time / max(1, len(steps)),
+                   'p99_step_s': float(np.percentile([s['step_s'] for s in steps], 99)) if steps else None,
+                   'peak_rss_mb': self.peak_rss / 2**20}
+        timed_steps = [s for s in steps if 'input_wait_s' in s]
+        if timed_steps:
+            timed_time = sum(s['step_s'] for s in timed_steps)
+            summary['input_wait_fraction'] = sum(s['input_wait_s'] for s in timed_steps) / timed_time
+            summary['images_per_sec'] = sum(s['images_per_sec'] * s['step_s'] for s in timed_steps) / timed_time
+        summary.update({k: float(v) for k, v in (logs or {}).items()})
+        if self.label_names is not None and self.takes_validation_data():
+            summary['labels'] = self.per_label_metrics()
+        self.epoch_log.write(json.dumps(summary) + '\n')
+        self.epoch_log.flush()
+        self.step_log.flush()
+        with self.writer.as_default(step=epoch):
+            for key, value in summary.items():
+                if isinstance(value, float) and key != 'epoch':
+                    tf.summary.scalar(f'epoch/{key}', value)
+            for name, metrics in summary.get('labels', {}).items():
+                for key, value in metrics.items():
+                    tf.summary.scalar(f'labels/{name}/{key}', value)
+        self.writer.flush()
+        line = f"Epoch {epoch + 1}: {summary['mean_step_s'] * 1000:.0f} ms/step, peak RSS {summary['peak_rss_mb']:.0f} MB"
+        if timed_steps:
+            line += f", {summary['images_per_sec']:.1f} img/s, {summary['input_wait_fraction']:.0%} of step time waiting for input"
+        print(line)
+
+    def takes_validation_data(self):
+        """False for the embedding-cache head (features in) and lower-resolution progressive stages."""
+        if self.validation_data is None:
+            return False
+        return tuple(self.model.input_shape[1:]) == tuple(self.validation_data.element_spec[0].shape[1:])
+
+    def per_label_metrics(self):
+        y_true, y_pred = [], []
+        for x, y in self.validation_data:
+            y_pred.append(np.asarray(self.model.predict_on_batch(x)))
+            y_true.append(np.asarray(y))
+        y_true = np.concatenate(y_true) > 0.5
+        y_pred = np.concatenate(y_pred) > 0.5
+        metrics = {}
+        for i, name in enumerate(self.label_names):
+            tp = np.sum(y_pred[:, i] & y_true[:, i])
+            metrics[name] = {
+                'accuracy': float(np.mean(y_pred[:, i] == y_true[:, i])),
+                'precision': float(tp / max(1, np.sum(y_pred[:, i]))),
+                'recall': float(tp / max(1, np.sum(y_true[:, i])))
+            }
+        return metrics
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            # Training ended (e.g. early stopping) before the last profiled step; keep the trace captured so far
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        self.step_log.close()
+        self.epoch_log.close()
+        self.writer.flush()
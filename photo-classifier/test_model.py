@@ -2,57 +2,67 @@
 test_model.py
 
 Evaluates the trained model on the test set and reports accuracy, precision, recall, F1-score, and confusion matrix. Also plots a confusion matrix heatmap and ROC curve.
+The test images are cropped like the training images (data_pipeline.image_dataset, intelligent_center_crop) and the
+predictions are cached by evaluate.py, so running the script again needs no forward pass. The metrics and the
+confusion matrix use --threshold (0.5 by default, as before). Thresholds are never tuned on the test set: a threshold
+chosen on the scored images would make every reported metric optimistic. Tune one on a validation split instead.
 """
 
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from sklearn.metrics import classification_report, confusion_matrix, roc_curve, auc
+from sampler import list_class_files
 
 # Parameters
-IMG_SIZE = 224
-BATCH_SIZE = 32
 TESTSET_DIR = 'testset'
 MODEL_PATH = 'final_model_40+20.keras'
+CLASSES = ['compliant', 'non-compliant']
 
-# Data generator for test set (no augmentation, just rescale)
-test_datagen = ImageDataGenerator(rescale=1./255)
-test_generator = test_datagen.flow_from_directory(
-    TESTSET_DIR,
-    target_size=(IMG_SIZE, IMG_SIZE),
-    batch_size=BATCH_SIZE,
-    class_mode='binary',
-    shuffle=False
-)
+parser = argparse.ArgumentParser(description="Evaluate the binary model on the test set.")
+parser.add_argument('--model', default=MODEL_PATH, help='Keras model to evaluate')
+parser.add_argument('--threshold', type=float, default=0.5, help='Decision threshold, e.g. one tuned on a validation split')
+args = parser.parse_args()
+# Plotting and scoring are only imported once the arguments are parsed, so --help returns at once
+import matplotlib.pyplot as plt
+import seaborn as sns
+from sklearn.metrics import classification_report, confusion_matrix
+from evaluate import cached_predictions, evaluate, print_report
 
-# Load model
-model = load_model(MODEL_PATH)
+# Same class order as flow_from_directory: the sigmoid scores non-compliant (1)
+paths, labels = [], []
+for label, cls in enumerate(CLASSES):
+    files = list_class_files(TESTSET_DIR, cls)
+    paths += files
+    labels += [float(label)] * len(files)
+y_pred_probs, y_true = cached_predictions(args.model, paths, np.array(labels, dtype=np.float32), name='testset')
+y_true = y_true.reshape(-1, 1)
 
-# Predict
-y_true = test_generator.classes
-y_pred_probs = model.predict(test_generator, verbose=1)
-y_pred = (y_pred_probs > 0.5).astype(int).flatten()
+thresholds = np.array([args.threshold])
+# One process: this script has no __main__ guard, so spawned bootstrap workers would re-run it
+report, curves = evaluate(y_true, y_pred_probs, [CLASSES[1]], thresholds=thresholds, workers=1)
+print_report(report)
+threshold = report[CLASSES[1]]['threshold']
+y_true = y_true.astype(int).flatten()
+y_pred = (y_pred_probs >= threshold).astype(int).flatten()
 
 # Classification report
-print(classification_report(y_true, y_pred, target_names=list(test_generator.class_indices.keys())))
+print(f"\nThreshold {threshold:.3f}")
+print(classification_report(y_true, y_pred, target_names=CLASSES))
 
 # Confusion matrix
 cm = confusion_matrix(y_true, y_pred)
 plt.figure(figsize=(6, 5))
-sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=test_generator.class_indices.keys(), yticklabels=test_generator.class_indices.keys())
+sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=CLASSES, yticklabels=CLASSES)
 plt.xlabel('Predicted')
 plt.ylabel('True')
-plt.title('Confusion Matrix')
+plt.title(f'Confusion Matrix (threshold {threshold:.2f})')
 plt.tight_layout()
 plt.show()
 
 # ROC curve
-fpr, tpr, thresholds = roc_curve(y_true, y_pred_probs)
-roc_auc = auc(fpr, tpr)
+curve = curves[0]
+roc_auc = report[CLASSES[1]]['roc_auc']
 plt.figure(figsize=(6, 5))
-plt.plot(fpr, tpr, label=f'ROC curve (area = {roc_auc:.2f})')
+plt.plot(np.r_[0.0, curve['fpr']], np.r_[0.0, curve['tpr']], label=f'ROC curve (area = {roc_auc:.2f})')
 plt.plot([0, 1], [0, 1], 'k--')
 plt.xlabel('False Positive Rate')
 plt.ylabel('True Positive Rate')
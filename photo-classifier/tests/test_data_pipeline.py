@@ -0,0 +1,44 @@
+"""Training crops of data_pipeline.py against the crops infer*.py and scoring_server.py score."""
+import numpy as np
+import pytest
+from PIL import Image
+from preprocess import intelligent_center_crop
+
+tf = pytest.importorskip('tensorflow')
+import data_pipeline
+
+IMG_SIZE = 64
+# Portrait, landscape, square and upscaled, as JPEG (lossy decode) and PNG
+SHAPES = [(300, 240), (240, 300), (128, 128), (48, 60)]
+
+
+@pytest.fixture(params=['jpg', 'png'])
+def image_paths(request, tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i, (height, width) in enumerate(SHAPES):
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        path = tmp_path / f'{i}.{request.param}'
+        Image.fromarray(pixels).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def inference_crop(path):
+    # infer.py's load_image before rescaling
+    return intelligent_center_crop(Image.open(path), IMG_SIZE).astype(np.uint8)
+
+
+def test_training_crops_match_inference_crops(image_paths):
+    ds = data_pipeline.image_dataset(image_paths, img_size=IMG_SIZE)
+    for path, img in zip(image_paths, ds):
+        assert img.dtype == tf.uint8
+        np.testing.assert_array_equal(img.numpy(), inference_crop(path))
+
+
+def test_packed_bytes_are_cropped_like_files(image_paths):
+    contents = [open(path, 'rb').read() for path in image_paths]
+    ds = tf.data.Dataset.from_tensor_slices(contents).map(lambda c: data_pipeline.decode_and_crop(c, IMG_SIZE))
+    for path, img in zip(image_paths, ds):
+        assert img.shape == (IMG_SIZE, IMG_SIZE, 3)
+        np.testing.assert_array_equal(img.numpy(), inference_crop(path))
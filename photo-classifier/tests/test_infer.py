@@ -0,0 +1,59 @@
+"""Batched inference of infer.py against per-image scoring with predict_image."""
+import csv
+import numpy as np
+import pytest
+from PIL import Image
+
+tf = pytest.importorskip('tensorflow')
+import infer
+
+IMG_SIZE = 32
+BATCH_SIZE = 4
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    for cls in ['compliant', 'non-compliant']:
+        (tmp_path / cls).mkdir()
+        for i, (height, width) in enumerate([(48, 40), (40, 48), (32, 32), (60, 45), (45, 60)]):
+            pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(tmp_path / cls / f'{i}.png')
+    return tmp_path
+
+
+@pytest.fixture
+def model(monkeypatch):
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((IMG_SIZE, IMG_SIZE, 3)),
+        tf.keras.layers.Conv2D(4, 3, activation='relu'),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(1, activation='sigmoid')
+    ])
+    monkeypatch.setattr(infer, 'get_model', lambda: model)
+    return model
+
+
+def read_results(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_batched_scores_match_per_image_scores(images, model, tmp_path):
+    output = tmp_path / 'batched.csv'
+    # 10 images in batches of 4 include a partial last batch
+    infer.batch_infer([str(images)], str(output), batch_size=BATCH_SIZE, workers=3)
+    rows = read_results(output)
+    assert [r['file'] for r in rows] == infer.find_images([str(images)])
+    for row in rows:
+        label, score = infer.predict_image(row['file'], batch_size=BATCH_SIZE)
+        assert row['label'] == label
+        assert row['score'] == str(score)
+
+
+def test_results_do_not_depend_on_the_number_of_workers(images, model, tmp_path):
+    single, threaded = tmp_path / 'single.csv', tmp_path / 'threaded.csv'
+    infer.batch_infer([str(images)], str(single), batch_size=BATCH_SIZE, workers=1)
+    infer.batch_infer([str(images)], str(threaded), batch_size=BATCH_SIZE, workers=3)
+    assert read_results(threaded) == read_results(single)
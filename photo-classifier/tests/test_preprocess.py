@@ -0,0 +1,53 @@
+"""Parity of the vectorized batch_center_crop with the per-image intelligent_center_crop."""
+import numpy as np
+import pytest
+from preprocess import IMG_SIZE, batch_center_crop, intelligent_center_crop
+
+# Portrait, landscape, square, upscaled and strongly downscaled
+SHAPES = [(300, 240), (240, 300), (224, 224), (180, 200), (1000, 750)]
+N_IMAGES = 4
+
+
+def synthetic_batch(kind, height, width, channels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (N_IMAGES, height, width, channels)
+    if kind == 'float01':
+        return rng.random(shape, dtype=np.float32)
+    if kind == 'float255':
+        return rng.integers(0, 256, shape).astype(np.float32)
+    return rng.integers(0, 256, shape, dtype=np.uint8)
+
+
+def expected_crops(batch, target_size=IMG_SIZE):
+    return np.stack([intelligent_center_crop(img, target_size) for img in batch])
+
+
+@pytest.mark.parametrize('height,width', SHAPES)
+@pytest.mark.parametrize('kind', ['float01', 'float255', 'uint8'])
+def test_batch_center_crop_matches_intelligent_center_crop(kind, height, width):
+    batch = synthetic_batch(kind, height, width)
+    expected = expected_crops(batch)
+    actual = batch_center_crop(batch, IMG_SIZE)
+    assert actual.dtype == expected.dtype
+    assert actual.shape == (N_IMAGES, IMG_SIZE, IMG_SIZE, 3)
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('height,width', SHAPES)
+def test_uint8_output_stays_exact(height, width):
+    batch = synthetic_batch('uint8', height, width)
+    actual = batch_center_crop(batch, IMG_SIZE, dtype=np.uint8)
+    assert actual.dtype == np.uint8
+    np.testing.assert_array_equal(actual, expected_crops(batch).astype(np.uint8))
+
+
+def test_grayscale_and_rgba_are_converted_like_pil():
+    gray = synthetic_batch('uint8', 240, 300, channels=1)[..., 0]
+    np.testing.assert_array_equal(batch_center_crop(gray, IMG_SIZE), expected_crops(gray))
+    rgba = synthetic_batch('uint8', 300, 240, channels=4)
+    np.testing.assert_array_equal(batch_center_crop(rgba, IMG_SIZE), expected_crops(rgba))
+
+
+def test_mixed_value_ranges_are_detected_per_image():
+    batch = np.concatenate([synthetic_batch('float01', 300, 240)[:2], synthetic_batch('float255', 300, 240)[:2]])
+    np.testing.assert_array_equal(batch_center_crop(batch, IMG_SIZE), expected_crops(batch))
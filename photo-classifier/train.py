@@ -1,93 +1,180 @@
 """
 train.py
 
-This script sets up and trains a ResNet50-based classifier using the preprocessed data generators from preprocess.py.
+This script sets up and trains a classifier (ResNet50 by default, see model_factory.py) using the tf.data input
+pipeline from data_pipeline.py.
+--xla compiles the training steps with XLA and --precision mixed_bfloat16 trains in bfloat16 on CPUs that support
+it (see precision.py); final_model.keras is always saved with float32 layers.
+--telemetry DIR replaces the live plot with headless JSONL/TensorBoard logs of step timing, input wait and memory
+(see telemetry.py); --label-metrics adds per-label validation metrics at the cost of an extra validation pass per epoch.
+--progressive 128:10 160:10 runs the first head-training epochs on smaller crops (10 at 128 px, then 10 at 160 px)
+before continuing at full resolution; fine-tuning always runs at full resolution.
+--distributed trains data-parallel as one of several workers (MultiWorkerMirroredStrategy), each reading its own
+shard of the images; `python distributed.py --workers 4 train.py` starts them as local processes.
 """
 
 import os
-import matplotlib.pyplot as plt
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout
-from tensorflow.keras.models import Model
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
-from tensorflow.keras.models import load_model
-from preprocess import get_data_generators
-from live_plot_callback import LivePlotCallback
+from preprocess import DATASET_DIR, BATCH_SIZE, IMG_SIZE
+from model_factory import BACKBONES, DEFAULT_BACKBONE, build_model, unfreeze_top, resolution_stage, train_progressive
+from precision import PRECISIONS, DEFAULT_PRECISION, set_precision, with_policy
+from distributed import setup as setup_distributed, replica_batch_size, agree_steps, distribute, worker_path, cleanup
 import argparse
 
-# Model setup
-base_model = ResNet50(weights='imagenet', include_top=False, input_shape=(224, 224, 3))
-base_model.trainable = False  # Freeze base for transfer learning
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or resume the compliance classifier.")
+    parser.add_argument('--resume', action='store_true', help='Resume training from best_model.keras if available')
+    parser.add_argument('--crop-cache', metavar='DIR', help='Cache decoded and cropped images in DIR (tf.data cache files)')
+    parser.add_argument('--embedding-cache', metavar='DIR', help='Train the head on backbone features cached in DIR instead of running the frozen backbone every epoch')
+    parser.add_argument('--embedding-passes', type=int, default=1, help='Number of augmented epochs to precompute features for with --embedding-cache')
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default=DEFAULT_BACKBONE, help='Backbone for a new model')
+    parser.add_argument('--img-size', type=int, default=IMG_SIZE, help='Input resolution for a new model')
+    parser.add_argument('--xla', action='store_true', help='Compile the training steps with XLA')
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION, help='Dtype policy for training')
+    parser.add_argument('--progressive', nargs='+', type=resolution_stage, default=[], metavar='SIZE:EPOCHS',
+                        help='Train the head for EPOCHS epochs at each lower SIZE first, e.g. 128:10 160:10')
+    parser.add_argument('--telemetry', metavar='DIR', help='Write headless step/epoch telemetry to DIR instead of showing a live plot')
+    parser.add_argument('--label-metrics', action='store_true', help='Also log per-label validation metrics (with --telemetry; one extra prediction pass over the validation set per epoch)')
+    parser.add_argument('--profile-steps', nargs=2, type=int, metavar=('START', 'STOP'), help='Capture a TF profiler trace of these steps (with --telemetry)')
+    parser.add_argument('--distributed', action='store_true', help='Train as one worker of a MultiWorkerMirroredStrategy cluster given by TF_CONFIG (see distributed.py)')
+    args = parser.parse_args()
+    if args.progressive and args.embedding_cache:
+        parser.error('--progressive cannot be combined with --embedding-cache')
+    if args.distributed and (args.embedding_cache or args.progressive):
+        parser.error('--distributed cannot be combined with --embedding-cache or --progressive')
+    # TensorFlow is only imported once the arguments are valid, so --help and usage errors return at once
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.callbacks import Callback, EarlyStopping, ModelCheckpoint
+    from tensorflow.keras.models import load_model
+    from data_pipeline import get_datasets
+    from embedding_cache import feature_model, fingerprint, weights_hash, load_or_compute, fit_head
+    from telemetry import TelemetryCallback
+    # MultiWorkerMirroredStrategy has to be created before any other TensorFlow call
+    strategy, worker, n_workers = setup_distributed(args.distributed)
+    chief = worker == 0
 
-x = base_model.output
-x = GlobalAveragePooling2D()(x)
-x = Dropout(0.3)(x)
-x = Dense(128, activation='relu')(x)
-x = Dropout(0.2)(x)
-output = Dense(1, activation='sigmoid')(x)
+    # Callbacks; every worker has to save, only the chief's checkpoint is kept for --resume
+    callbacks = [
+        EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True),
+        ModelCheckpoint(worker_path('best_model.keras', worker), save_best_only=True)
+    ]
 
-model = Model(inputs=base_model.input, outputs=output)
+    precision = set_precision(args.precision)
+    # Variables created in the strategy scope are mirrored across workers; without --distributed the scope does nothing
+    with strategy.scope():
+        if args.resume and os.path.exists('best_model.keras'):
+            print("Resuming from best_model.keras...")
+            model = with_policy(load_model('best_model.keras'), precision)
+        else:
+            print(f"Starting training from scratch with {args.backbone} at {args.img_size}x{args.img_size}...")
+            model = build_model(1, args.backbone, args.img_size)
 
-model.compile(optimizer=Adam(learning_rate=1e-4),
-              loss='binary_crossentropy',
-              metrics=['accuracy'])
+    def compile_head(m):
+        with strategy.scope():
+            m.compile(optimizer=Adam(learning_rate=1e-4),
+                      loss='binary_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=args.xla)
+    compile_head(model)
+    img_size = model.input_shape[1]
+    # With --distributed every worker reads its own shard with its part of the global batch
+    batch_size = replica_batch_size(strategy, BATCH_SIZE)
+    shard = (worker, n_workers) if args.distributed else None
 
-# Callbacks
-callbacks = [
-    EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True),
-    ModelCheckpoint('best_model.keras', save_best_only=True)
-]
+    train_generator, val_generator, steps_per_epoch = get_datasets(cache_dir=args.crop_cache, img_size=img_size,
+                                                                   batch_size=batch_size, shard=shard)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Train or resume the ResNet50 classifier.")
-    parser.add_argument('--resume', action='store_true', help='Resume training from best_model.keras if available')
-    args = parser.parse_args()
+    telemetry = None
+    if args.telemetry:
+        # Workers log separately, and per-label metrics would run a prediction outside the synchronized steps
+        log_dir = os.path.join(args.telemetry, f'worker{worker}') if args.distributed else args.telemetry
+        telemetry = TelemetryCallback(log_dir, val_generator if args.label_metrics and not args.distributed else None,
+                                      ['non-compliant'], args.profile_steps)
 
-    if args.resume and os.path.exists('best_model.keras'):
-        print("Resuming from best_model.keras...")
-        model = load_model('best_model.keras')
-        # Re-compile in case optimizer/loss/metrics need to be reset
-        model.compile(optimizer=Adam(learning_rate=1e-4),
-                      loss='binary_crossentropy',
-                      metrics=['accuracy'])
-    else:
-        print("Starting training from scratch...")
+    def monitor():
+        """Headless telemetry with --telemetry, a live matplotlib plot otherwise."""
+        if telemetry:
+            return telemetry
+        if not chief:
+            return Callback()
+        from live_plot_callback import LivePlotCallback  # matplotlib is only needed for the live plot
+        return LivePlotCallback()
+
+    def timed(ds):
+        return telemetry.timed(ds) if telemetry else ds
 
-    train_generator, val_generator, steps_per_epoch = get_data_generators()
+    def fit_inputs(train_ds, val_ds, steps):
+        """(train input, val input, steps_per_epoch, validation_steps) for model.fit."""
+        if not args.distributed:
+            return timed(train_ds), val_ds, steps, None
+        # All workers have to run the same number of steps
+        return (distribute(strategy, timed(train_ds)), distribute(strategy, val_ds), agree_steps(strategy, steps),
+                agree_steps(strategy, len(val_ds)))
 
-    live_plot = LivePlotCallback()
+    live_plot = monitor()
     # Training
     EPOCHS = 150
-    history = model.fit(
-        train_generator,
-        validation_data=val_generator,
-        steps_per_epoch=steps_per_epoch * 2,
-        epochs=EPOCHS,
-        callbacks=callbacks + [live_plot]
-    )
+    if args.embedding_cache:
+        # The base is frozen, so its pooled features are computed once (for a fixed set of augmented batches)
+        extractor = feature_model(model)
+        # A resumed model may have a fine-tuned backbone, so the key covers the extractor's weights
+        weights = weights_hash(extractor)
+        image_files = [os.path.join(d, f) for d, _, files in os.walk(DATASET_DIR) for f in files]
+        train_steps = steps_per_epoch * 2 * args.embedding_passes
+        train_features = load_or_compute('train', fingerprint(image_files, 'train', train_steps, model.name, weights), extractor,
+                                         train_generator, train_steps, args.embedding_cache)
+        val_features = load_or_compute('val', fingerprint(image_files, 'val', model.name, weights), extractor,
+                                       val_generator, len(val_generator), args.embedding_cache)
+        history = fit_head(model, train_features, val_features, Adam(learning_rate=1e-4), EPOCHS, BATCH_SIZE,
+                           callbacks=[EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True), live_plot],
+                           jit_compile=args.xla)
+        model.save('best_model.keras')
+    else:
+        def stage_datasets(size):
+            train_ds, val_ds, steps = get_datasets(cache_dir=args.crop_cache, img_size=size)
+            return timed(train_ds), val_ds, steps * 2
+        epochs_done = train_progressive(model, args.progressive, compile_head, stage_datasets, callbacks=[live_plot])
+        train_input, val_input, steps, validation_steps = fit_inputs(train_generator, val_generator, steps_per_epoch * 2)
+        history = model.fit(
+            train_input,
+            validation_data=val_input,
+            steps_per_epoch=steps,
+            validation_steps=validation_steps,
+            initial_epoch=epochs_done,
+            epochs=EPOCHS,
+            callbacks=callbacks + [live_plot]
+        )
 
     # Optionally, unfreeze some top layers for fine-tuning
-    import tensorflow as tf
-    tf.keras.backend.clear_session()
-    base_model.trainable = True
-    for layer in base_model.layers[:-30]:  # Freeze all but last 30 layers
-        layer.trainable = False
+    if not args.distributed:
+        # Would also reset the collective ops the workers synchronize with
+        import tensorflow as tf
+        tf.keras.backend.clear_session()
+        set_precision(precision)  # clear_session resets the global dtype policy
+    unfreeze_top(model)  # Freeze all but last 30 layers
 
-    model.compile(optimizer=Adam(learning_rate=1e-5),
-                  loss='binary_crossentropy',
-                  metrics=['accuracy'])
+    with strategy.scope():
+        model.compile(optimizer=Adam(learning_rate=1e-5),
+                      loss='binary_crossentropy',
+                      metrics=['accuracy'],
+                      jit_compile=args.xla)
 
     # Re-instantiate generators and callbacks for fine-tuning
-    train_generator, val_generator, steps_per_epoch = get_data_generators()
-    live_plot_finetune = LivePlotCallback()
+    train_generator, val_generator, steps_per_epoch = get_datasets(cache_dir=args.crop_cache, img_size=img_size,
+                                                                   batch_size=batch_size, shard=shard)
+    if telemetry and telemetry.validation_data is not None:
+        telemetry.validation_data = val_generator
+    live_plot_finetune = monitor()
+    train_input, val_input, steps, validation_steps = fit_inputs(train_generator, val_generator, steps_per_epoch * 2)
     history_finetune = model.fit(
-        train_generator,
-        validation_data=val_generator,
-        steps_per_epoch=steps_per_epoch * 2,
+        train_input,
+        validation_data=val_input,
+        steps_per_epoch=steps,
+        validation_steps=validation_steps,
         epochs=100,
         callbacks=callbacks + [live_plot_finetune]
     )
 
-    model.save('final_model.keras', include_optimizer=False)
-    print("Training complete. Model saved as final_model.keras")
+    with_policy(model, 'float32').save(worker_path('final_model.keras', worker), include_optimizer=False)
+    cleanup(worker)
+    if chief:
+        print("Training complete. Model saved as final_model.keras")
@@ -2,148 +2,261 @@
 train_multilabel.py
 
 Train a multi-label image classifier using the labels_template.csv and images in datasets/multi-label/photos/.
+--xla compiles the training steps with XLA and --precision mixed_bfloat16 trains in bfloat16 on CPUs that support
+it (see precision.py); final_model_multilabel.keras is always saved with float32 layers.
+--progressive 128:10 160:10 runs the first head-training epochs on smaller crops (10 at 128 px, then 10 at 160 px)
+before continuing at full resolution; fine-tuning always runs at full resolution.
+--telemetry DIR replaces the live plot with headless JSONL/TensorBoard logs of step timing, input wait and memory
+(see telemetry.py); --label-metrics adds per-label validation metrics at the cost of an extra validation pass per epoch.
+--augment trains on the original photos and augments every batch in-graph (data_pipeline.augment_batch, seeded) with
+per-class policies, instead of reading the offline export in datasets/multi-label/augmented.
+--packed DIR reads images and labels from the TFRecord shards written by packed_dataset.py instead of IMG_DIR.
+--groups duplicate_groups.csv keeps near-duplicate photos (see dedup.py) on the same side of the train/val split.
+--hparams best_hparams.json trains with the best config found by tune_multilabel.py (and its backbone, input size and
+seed). Only the config is reused: the trials trained the head on cached features, this script trains as configured by
+its other options, so the run does not reproduce the trial and its validation loss is not comparable to the trial's.
+--distributed trains data-parallel as one of several workers (MultiWorkerMirroredStrategy), each reading its own
+shard of the images; `python distributed.py --workers 4 train_multilabel.py` starts them as local processes.
 """
 import os
+import json
 import pandas as pd
 import numpy as np
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout
-from tensorflow.keras.models import Model
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from sklearn.model_selection import train_test_split
-from preprocess import intelligent_center_crop
-from live_plot_callback import LivePlotCallback
-from sklearn.metrics import classification_report
-from tensorflow.keras.models import load_model
+from preprocess import COMPLIANT_AUGMENTATION, NONCOMPLIANT_AUGMENTATION
+from embedding_cache import feature_model, fingerprint, weights_hash, compute_embeddings, load_or_compute, fit_head
+from evaluate import prediction_key, evaluate, print_report
+from dedup import split_dataframe
+from model_factory import BACKBONES, DEFAULT_BACKBONE, FINE_TUNE_LAYERS, build_model, unfreeze_top, resolution_stage, train_progressive
+from precision import PRECISIONS, DEFAULT_PRECISION, set_precision, with_policy
+from distributed import setup as setup_distributed, replica_batch_size, agree_steps, distribute, worker_path, cleanup
 import argparse
 
 IMG_DIR = 'datasets/multi-label/augmented'
 CSV_PATH = 'datasets/multi-label/labels_augmented.csv'
+# Un-augmented photos, augmented in-graph with --augment
+PHOTOS_DIR = 'datasets/multi-label/photos'
+PHOTOS_CSV_PATH = 'datasets/multi-label/labels_template.csv'
+# Per-class policies for photos with every label present (compliant) and all others. Both keep the mild brightness
+# range: stronger brightness changes could contradict labels such as brightBackground
+AUGMENTATION = [COMPLIANT_AUGMENTATION,
+                dict(NONCOMPLIANT_AUGMENTATION, brightness_range=COMPLIANT_AUGMENTATION['brightness_range'])]
 IMG_SIZE = 224
 BATCH_SIZE = 256
 EPOCHS = 60
+# Hand-tuned defaults; --hparams replaces them with a config from tune_multilabel.py
+HPARAMS = {'learning_rate': 1e-4, 'dropout': 0.3, 'dense_units': 128, 'dense_dropout': 0.2, 'batch_size': BATCH_SIZE,
+           'epochs': EPOCHS, 'fine_tune_layers': FINE_TUNE_LAYERS, 'fine_tune_learning_rate': 1e-5}
 
-# Load CSV
-labels_df = pd.read_csv(CSV_PATH)
-labels = labels_df.columns[1:]
-
-# Check for NaNs or invalid values in labels
-nan_rows = labels_df[list(labels)].isnull().any(axis=1)
-if nan_rows.any():
-    print("Rows with NaN values in label columns:")
-    print(labels_df[nan_rows])
-    raise ValueError("NaN values found in label columns!")
-non_binary_mask = ~((labels_df[list(labels)] == 0) | (labels_df[list(labels)] == 1)).all(axis=1)
-if non_binary_mask.any():
-    print("Rows with non-binary values in label columns:")
-    print(labels_df[non_binary_mask])
-    raise ValueError("Non-binary values found in label columns!")
-
-# Split train/val
-train_df, val_df = train_test_split(labels_df, test_size=0.2, random_state=42)
-
-# Data generators
-idg = ImageDataGenerator(
-    rescale=1./255
-)
-train_gen = idg.flow_from_dataframe(
-    train_df,
-    directory=IMG_DIR,  # FIX: Use the actual image directory
-    x_col='filename',
-    y_col=list(labels),
-    target_size=(IMG_SIZE, IMG_SIZE),
-    batch_size=BATCH_SIZE,
-    class_mode='raw',
-    shuffle=True
-)
-
-x_batch, y_batch = next(iter(train_gen))
-print("Batch X min/max:", np.min(x_batch), np.max(x_batch))
-print("Batch Y unique:", np.unique(y_batch))
-
-val_gen = idg.flow_from_dataframe(
-    val_df,
-    directory=IMG_DIR,  # FIX: Use the actual image directory
-    x_col='filename',
-    y_col=list(labels),
-    target_size=(IMG_SIZE, IMG_SIZE),
-    batch_size=BATCH_SIZE,
-    class_mode='raw',
-    shuffle=False
-)
-
-parser = argparse.ArgumentParser(description="Train or resume the multi-label classifier.")
-parser.add_argument('--resume', action='store_true', help='Resume training from best_model_multilabel.keras if available')
-args = parser.parse_args()
-
-checkpoint_path = 'best_model_multilabel.keras'
-if args.resume and os.path.exists(checkpoint_path):
-    print(f"Resuming from checkpoint: {checkpoint_path}")
-    model = load_model(checkpoint_path)
-    # Retrieve base_model from loaded model
-    base_model = model.get_layer('resnet50')
-else:
-    input_tensor = Input(shape=(IMG_SIZE, IMG_SIZE, 3), name='input_layer')
-    base_model = ResNet50(weights='imagenet', include_top=False, input_shape=(224, 224, 3), input_tensor=input_tensor, name='resnet50')
-    base_model.trainable = False
-    x = base_model.output
-    x = GlobalAveragePooling2D()(x)
-    x = Dropout(0.3)(x)
-    x = Dense(128, activation='relu')(x)
-    x = Dropout(0.2)(x)
-    output = Dense(len(labels), activation='sigmoid', dtype='float32')(x)
-    model = Model(inputs=base_model.input, outputs=output)
-
-model.compile(optimizer=Adam(learning_rate=1e-4, clipnorm=1.0),
-              loss='binary_crossentropy',
-              metrics=['accuracy'])
-
-callbacks = [
-    EarlyStopping(monitor='val_loss', patience=10, restore_best_weights=True),
-    ModelCheckpoint('best_model_multilabel.keras', save_best_only=True)
-]
-
-history = model.fit(
-    train_gen,
-    validation_data=val_gen,
-    epochs=EPOCHS,
-    callbacks=callbacks + [LivePlotCallback()]
-)
-
-# Optionally, unfreeze some top layers for fine-tuning
-base_model.trainable = True
-for layer in base_model.layers[:-30]:
-    layer.trainable = False
-model.compile(optimizer=Adam(learning_rate=1e-5), loss='binary_crossentropy', metrics=['accuracy'])
-
-history_finetune = model.fit(
-    train_gen,
-    validation_data=val_gen,
-    epochs=int(EPOCHS / 3),
-    callbacks=callbacks + [LivePlotCallback()]
-)
-
-# After training, evaluate per-label performance on validation set
-def evaluate_per_label(model, val_gen, labels):
-    # Get all validation data
-    val_gen.reset()
-    y_true = []
-    y_pred = []
-    for i in range(len(val_gen)):
-        x_batch, y_batch = val_gen[i]
-        preds = model.predict(x_batch, verbose=0)
-        y_true.append(y_batch)
-        y_pred.append(preds)
-    y_true = np.vstack(y_true)
-    y_pred = np.vstack(y_pred)
-    # Binarize predictions at 0.5
-    y_pred_bin = (y_pred > 0.5).astype(int)
-    print("\nPer-label classification report (validation set):")
-    print(classification_report(y_true, y_pred_bin, target_names=list(labels)))
-
-model.save('final_model_multilabel.keras', include_optimizer=False)
-print('Training complete. Model saved as final_model_multilabel.keras')
-
-evaluate_per_label(model, val_gen, labels)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or resume the multi-label classifier.")
+    parser.add_argument('--resume', action='store_true', help='Resume training from best_model_multilabel.keras if available')
+    parser.add_argument('--embedding-cache', metavar='DIR', help='Train the head on backbone features cached in DIR instead of running the frozen backbone every epoch')
+    parser.add_argument('--crop-cache', metavar='DIR', help='Cache decoded and cropped images in DIR (tf.data cache files)')
+    parser.add_argument('--rebalance', action='store_true', help='Draw training batches with per-label rebalancing weights')
+    parser.add_argument('--augment', action='store_true', help=f'Train on the original photos in {PHOTOS_DIR} with seeded in-graph augmentation instead of {IMG_DIR}')
+    parser.add_argument('--groups', metavar='CSV', help='Split by the near-duplicate groups written by dedup.py instead of by row')
+    parser.add_argument('--packed', metavar='DIR', help='Read images and labels from the shards packed_dataset.py wrote to DIR')
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default=DEFAULT_BACKBONE, help='Backbone for a new model')
+    parser.add_argument('--img-size', type=int, default=IMG_SIZE, help='Input resolution for a new model')
+    parser.add_argument('--xla', action='store_true', help='Compile the training steps with XLA')
+    parser.add_argument('--precision', choices=PRECISIONS, default=DEFAULT_PRECISION, help='Dtype policy for training')
+    parser.add_argument('--progressive', nargs='+', type=resolution_stage, default=[], metavar='SIZE:EPOCHS',
+                        help='Train the head for EPOCHS epochs at each lower SIZE first, e.g. 128:10 160:10')
+    parser.add_argument('--telemetry', metavar='DIR', help='Write headless step/epoch telemetry to DIR instead of showing a live plot')
+    parser.add_argument('--label-metrics', action='store_true', help='Also log per-label validation metrics (with --telemetry; one extra prediction pass over the validation set per epoch)')
+    parser.add_argument('--profile-steps', nargs=2, type=int, metavar=('START', 'STOP'), help='Capture a TF profiler trace of these steps (with --telemetry)')
+    parser.add_argument('--distributed', action='store_true', help='Train as one worker of a MultiWorkerMirroredStrategy cluster given by TF_CONFIG (see distributed.py)')
+    parser.add_argument('--hparams', metavar='JSON', help='Hyperparameters (and seed, backbone, input size) written by tune_multilabel.py')
+    args = parser.parse_args()
+    if args.progressive and args.embedding_cache:
+        parser.error('--progressive cannot be combined with --embedding-cache')
+    if args.rebalance and args.packed:
+        parser.error('--rebalance cannot be combined with --packed')
+    if args.distributed and (args.embedding_cache or args.progressive):
+        parser.error('--distributed cannot be combined with --embedding-cache or --progressive')
+    # TensorFlow is only imported once the arguments are valid, so --help and usage errors return at once
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.callbacks import Callback, EarlyStopping, ModelCheckpoint
+    from tensorflow.keras.utils import set_random_seed
+    from tensorflow.keras.models import load_model
+    from data_pipeline import get_multilabel_datasets
+    from telemetry import TelemetryCallback
+    from packed_dataset import MANIFEST_FILE
+    # MultiWorkerMirroredStrategy has to be created before any other TensorFlow call
+    strategy, worker, n_workers = setup_distributed(args.distributed)
+    chief = worker == 0
+    if args.augment:
+        IMG_DIR, CSV_PATH = PHOTOS_DIR, PHOTOS_CSV_PATH
+
+    # Load CSV
+    labels_df = pd.read_csv(CSV_PATH)
+    labels = labels_df.columns[1:]
+
+    # Check for NaNs or invalid values in labels
+    nan_rows = labels_df[list(labels)].isnull().any(axis=1)
+    if nan_rows.any():
+        print("Rows with NaN values in label columns:")
+        print(labels_df[nan_rows])
+        raise ValueError("NaN values found in label columns!")
+    non_binary_mask = ~((labels_df[list(labels)] == 0) | (labels_df[list(labels)] == 1)).all(axis=1)
+    if non_binary_mask.any():
+        print("Rows with non-binary values in label columns:")
+        print(labels_df[non_binary_mask])
+        raise ValueError("Non-binary values found in label columns!")
+
+    # Split train/val
+    train_df, val_df = split_dataframe(labels_df, IMG_DIR, args.groups)
+
+    hparams = dict(HPARAMS)
+    if args.hparams:
+        with open(args.hparams) as f:
+            tuned = json.load(f)
+        hparams.update({k: tuned[k] for k in HPARAMS if k in tuned})
+        args.backbone = tuned.get('backbone', args.backbone)
+        args.img_size = tuned.get('img_size', args.img_size)
+        set_random_seed(tuned['seed'])
+        print(f"Using hyperparameters from {args.hparams} (config only, the trial is not reproduced): {hparams}")
+    BATCH_SIZE = hparams['batch_size']
+    EPOCHS = hparams['epochs']
+
+    precision = set_precision(args.precision)
+    checkpoint_path = 'best_model_multilabel.keras'
+    # Variables created in the strategy scope are mirrored across workers; without --distributed the scope does nothing
+    with strategy.scope():
+        if args.resume and os.path.exists(checkpoint_path):
+            print(f"Resuming from checkpoint: {checkpoint_path}")
+            model = with_policy(load_model(checkpoint_path), precision)
+        else:
+            model = build_model(len(labels), args.backbone, args.img_size, dropout=hparams['dropout'],
+                                dense_units=hparams['dense_units'], dense_dropout=hparams['dense_dropout'])
+    img_size = model.input_shape[1]
+
+    # Input pipelines; with --distributed every worker reads its own shard with its part of the global batch
+    train_gen, val_gen, steps_per_epoch = get_multilabel_datasets(train_df, val_df, IMG_DIR, labels,
+                                                                  replica_batch_size(strategy, BATCH_SIZE),
+                                                                  cache_dir=args.crop_cache, rebalance=args.rebalance,
+                                                                  img_size=img_size, packed_dir=args.packed,
+                                                                  augment=AUGMENTATION if args.augment else None,
+                                                                  shard=(worker, n_workers) if args.distributed else None)
+
+    x_batch, y_batch = next(iter(train_gen))
+    print("Batch X min/max:", np.min(x_batch), np.max(x_batch))
+    print("Batch Y unique:", np.unique(y_batch))
+
+    telemetry = None
+    if args.telemetry:
+        # Workers log separately, and per-label metrics would run a prediction outside the synchronized steps
+        log_dir = os.path.join(args.telemetry, f'worker{worker}') if args.distributed else args.telemetry
+        telemetry = TelemetryCallback(log_dir, val_gen if args.label_metrics and not args.distributed else None, list(labels),
+                                      args.profile_steps)
+
+
+    def monitor():
+        """Headless telemetry with --telemetry, a live matplotlib plot otherwise."""
+        if telemetry:
+            return telemetry
+        if not chief:
+            return Callback()
+        from live_plot_callback import LivePlotCallback  # matplotlib is only needed for the live plot
+        return LivePlotCallback()
+
+
+    def timed(ds):
+        return telemetry.timed(ds) if telemetry else ds
+
+
+    def compile_head(m):
+        m.compile(optimizer=Adam(learning_rate=hparams['learning_rate'], clipnorm=1.0),
+                  loss='binary_crossentropy',
+                  metrics=['accuracy'],
+                  jit_compile=args.xla)
+
+    with strategy.scope():
+        compile_head(model)
+
+    callbacks = [
+        EarlyStopping(monitor='val_loss', patience=10, restore_best_weights=True),
+        # Every worker has to save; only the chief's checkpoint is kept for --resume
+        ModelCheckpoint(worker_path(checkpoint_path, worker), save_best_only=True)
+    ]
+
+    if args.distributed:
+        # All workers have to run the same number of steps; the training shards repeat so none runs out early
+        steps_per_epoch = agree_steps(strategy, steps_per_epoch or len(train_gen))
+        validation_steps = agree_steps(strategy, len(val_gen))
+        train_input, val_input = distribute(strategy, timed(train_gen).repeat()), distribute(strategy, val_gen)
+    else:
+        validation_steps = None
+        train_input, val_input = timed(train_gen), val_gen
+
+    if args.embedding_cache:
+        # The base is frozen, so its pooled features only need to be computed once
+        extractor = feature_model(model)
+        # A resumed model may have a fine-tuned backbone, so the key covers the extractor's weights
+        weights = weights_hash(extractor)
+        def source_key(df):
+            if args.packed:
+                return fingerprint([CSV_PATH, os.path.join(args.packed, MANIFEST_FILE)], list(df['filename']), model.name, weights)
+            return fingerprint([CSV_PATH] + [os.path.join(IMG_DIR, f) for f in df['filename']], model.name, weights)
+        train_features = load_or_compute('multilabel_train', source_key(train_df), extractor, train_gen,
+                                         steps_per_epoch or len(train_gen), args.embedding_cache)
+        val_features = load_or_compute('multilabel_val', source_key(val_df), extractor, val_gen, len(val_gen), args.embedding_cache)
+        history = fit_head(model, train_features, val_features, Adam(learning_rate=hparams['learning_rate'], clipnorm=1.0), EPOCHS, BATCH_SIZE,
+                           callbacks=[EarlyStopping(monitor='val_loss', patience=10, restore_best_weights=True), monitor()],
+                           jit_compile=args.xla)
+        model.save(checkpoint_path)
+    else:
+        def stage_datasets(size):
+            train_ds, val_ds, steps = get_multilabel_datasets(train_df, val_df, IMG_DIR, labels, BATCH_SIZE,
+                                                              cache_dir=args.crop_cache, rebalance=args.rebalance, img_size=size,
+                                                              packed_dir=args.packed, augment=AUGMENTATION if args.augment else None)
+            return timed(train_ds), val_ds, steps
+        epochs_done = train_progressive(model, args.progressive, compile_head, stage_datasets, callbacks=[monitor()])
+        history = model.fit(
+            train_input,
+            validation_data=val_input,
+            steps_per_epoch=steps_per_epoch,
+            validation_steps=validation_steps,
+            initial_epoch=epochs_done,
+            epochs=EPOCHS,
+            callbacks=callbacks + [monitor()]
+        )
+
+    # Optionally, unfreeze some top layers for fine-tuning
+    unfreeze_top(model, hparams['fine_tune_layers'])
+    with strategy.scope():
+        model.compile(optimizer=Adam(learning_rate=hparams['fine_tune_learning_rate']), loss='binary_crossentropy', metrics=['accuracy'], jit_compile=args.xla)
+
+    history_finetune = model.fit(
+        train_input,
+        validation_data=val_input,
+        steps_per_epoch=steps_per_epoch,
+        validation_steps=validation_steps,
+        epochs=int(EPOCHS / 3),
+        callbacks=callbacks + [monitor()]
+    )
+
+    model = with_policy(model, 'float32')
+    model.save(worker_path('final_model_multilabel.keras', worker), include_optimizer=False)
+    if not chief:
+        cleanup(worker)
+        raise SystemExit(0)
+    print('Training complete. Model saved as final_model_multilabel.keras')
+    if args.distributed:
+        # Evaluate a plain copy on the chief alone, outside the synchronized strategy
+        model = load_model('final_model_multilabel.keras')
+        train_gen, val_gen, _ = get_multilabel_datasets(train_df, val_df, IMG_DIR, labels, BATCH_SIZE, img_size=img_size,
+                                                        cache_dir=args.crop_cache, packed_dir=args.packed)
+
+    # Predict the validation set once; evaluate.py reuses the cached predictions for other thresholds and reports
+    if args.packed:
+        scores, y_true = compute_embeddings(model, val_gen, len(val_gen))
+    else:
+        val_paths = [os.path.join(IMG_DIR, f) for f in val_df['filename']]
+        val_y = val_df[list(labels)].to_numpy(dtype=np.float32)
+        scores, y_true = load_or_compute('evaluation', prediction_key('final_model_multilabel.keras', val_paths, val_y),
+                                         model, val_gen, len(val_gen))
+    report, _ = evaluate(y_true, scores, list(labels), n_bootstrap=0)
+    print("\nPer-label validation metrics (run evaluate.py for confidence intervals and the validator thresholds):")
+    print_report(report)
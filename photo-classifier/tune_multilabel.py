@@ -0,0 +1,248 @@
+"""
+tune_multilabel.py
+
+Hyperparameter search for train_multilabel.py with Hyperband (successive halving over several brackets).
+Every trial samples learning rate, dropout, head size and batch size (with --fine-tune also the number of unfrozen
+backbone layers and the fine-tuning learning rate) and trains in a worker process of a process pool. Trials train the
+head on the cached backbone features from embedding_cache.py (shared with train_multilabel.py --embedding-cache), so
+the backbone runs once for the whole search; --fine-tune trials then fine-tune on the images as well.
+Each rung keeps the best 1/eta of the trials by validation loss and retrains them with eta times the epochs.
+All trials (config, seed, epochs and metrics) are stored in a SQLite results store. The best full-budget trial is
+written to best_hparams.json. train_multilabel.py --hparams trains with its config, but as a normal training run on
+the images, not the trial's head-on-features training, so its scores are not comparable with the trial's.
+LABEL_WEIGHTS and GAIN_K in copy_bad_images.py only shape the bucket score after inference; they have no training
+objective to optimize and are not searched.
+Usage:
+    python tune_multilabel.py --workers 8
+    python tune_multilabel.py --max-epochs 81 --min-epochs 3 --eta 3 --brackets 1  # plain successive halving
+    python train_multilabel.py --hparams best_hparams.json
+"""
+import os
+import math
+import json
+import time
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from embedding_cache import EMBEDDING_DIR
+from dedup import split_dataframe
+
+IMG_DIR = 'datasets/multi-label/augmented'
+CSV_PATH = 'datasets/multi-label/labels_augmented.csv'
+RESULTS_PATH = 'tuning.sqlite'
+BEST_PATH = 'best_hparams.json'
+MAX_EPOCHS = 81
+MIN_EPOCHS = 3
+ETA = 3
+EMBEDDING_BATCH_SIZE = 256
+WORKERS = max(1, (os.cpu_count() or 1) // 4)
+
+# name: (kind, arguments); 'log' and 'uniform' sample from [low, high], 'int' from [low, high], 'choice' from a list
+SEARCH_SPACE = {
+    'learning_rate': ('log', 1e-5, 1e-2),
+    'dropout': ('uniform', 0.0, 0.5),
+    'dense_units': ('choice', [64, 128, 256]),
+    'dense_dropout': ('uniform', 0.0, 0.5),
+    'batch_size': ('choice', [64, 128, 256]),
+}
+FINE_TUNE_SPACE = {
+    'fine_tune_layers': ('int', 0, 60),
+    'fine_tune_learning_rate': ('log', 1e-6, 1e-4),
+}
+# Keyword arguments of model_factory.build_model
+MODEL_PARAMS = ['dropout', 'dense_units', 'dense_dropout']
+
+
+def sample_config(space, rng):
+    config = {}
+    for name, (kind, *args) in space.items():
+        if kind == 'log':
+            config[name] = float(np.exp(rng.uniform(np.log(args[0]), np.log(args[1]))))
+        elif kind == 'uniform':
+            config[name] = float(rng.uniform(args[0], args[1]))
+        elif kind == 'int':
+            config[name] = int(rng.integers(args[0], args[1] + 1))
+        else:
+            config[name] = args[0][rng.integers(len(args[0]))]
+    return config
+
+
+def hyperband_brackets(max_epochs, min_epochs, eta, n_brackets=None):
+    """(bracket, number of trials, epochs per rung) for each bracket, the most aggressive one first."""
+    s_max = int(math.log(max_epochs / min_epochs, eta) + 1e-9)
+    brackets = []
+    for s in range(s_max, -1, -1):
+        n = math.ceil((s_max + 1) / (s + 1) * eta ** s)
+        brackets.append((s, n, [max(1, round(max_epochs * eta ** (i - s))) for i in range(s + 1)]))
+    return brackets[:n_brackets]
+
+
+def split_labels(csv_path, img_dir, groups_path=None):
+    """(labels, train_df, val_df) split exactly like train_multilabel.py (with the same --groups)."""
+    labels_df = pd.read_csv(csv_path)
+    train_df, val_df = split_dataframe(labels_df, img_dir, groups_path)
+    return labels_df.columns[1:], train_df, val_df
+
+
+class TrialStore:
+    """SQLite store of every trial's config, seed, budget and metrics."""
+
+    def __init__(self, db_path=RESULTS_PATH):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS trials (
+                run TEXT, config_id INTEGER, bracket INTEGER, rung INTEGER, epochs INTEGER, seed INTEGER,
+                config TEXT, val_loss REAL, val_accuracy REAL, seconds REAL,
+                PRIMARY KEY (run, config_id, rung));
+        """)
+
+    def store(self, run, trial, result):
+        self.db.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (run, trial['config_id'], trial['bracket'], trial['rung'], trial['epochs'], trial['seed'],
+                         json.dumps(trial['config']), result['val_loss'], result['val_accuracy'], result['seconds']))
+        self.db.commit()
+
+    def best(self, run):
+        """Best trial of run among those trained for the largest number of epochs."""
+        row = self.db.execute("""
+            SELECT config_id, epochs, seed, config, val_loss, val_accuracy FROM trials
+            WHERE run = ? AND epochs = (SELECT MAX(epochs) FROM trials WHERE run = ?)
+            ORDER BY val_loss LIMIT 1""", (run, run)).fetchone()
+        config_id, epochs, seed, config, val_loss, val_accuracy = row
+        return dict(json.loads(config), epochs=epochs, seed=seed, run=run, config_id=config_id, val_loss=val_loss,
+                    val_accuracy=val_accuracy)
+
+
+def init_worker(threads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+
+
+def run_trial(trial):
+    """Trains one config for trial['epochs'] epochs in a worker process and returns its validation metrics."""
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.utils import set_random_seed
+    from embedding_cache import fit_head
+    from model_factory import build_model, unfreeze_top
+    start = time.perf_counter()
+    config = trial['config']
+    set_random_seed(trial['seed'])
+    train, val = (np.load(path) for path in trial['features'])
+    model = build_model(train['labels'].shape[1], trial['backbone'], trial['img_size'],
+                        weights='imagenet' if trial['fine_tune'] else None,
+                        **{k: config[k] for k in MODEL_PARAMS})
+    history = fit_head(model, (train['features'], train['labels']), (val['features'], val['labels']),
+                       Adam(learning_rate=config['learning_rate'], clipnorm=1.0), trial['epochs'],
+                       config['batch_size'], verbose=0)
+    if trial['fine_tune']:
+        from data_pipeline import get_multilabel_datasets
+        labels, train_df, val_df = split_labels(trial['csv_path'], trial['img_dir'], trial['groups'])
+        train_ds, val_ds, _ = get_multilabel_datasets(train_df, val_df, trial['img_dir'], labels, config['batch_size'],
+                                                      cache_dir=trial['crop_cache'], img_size=trial['img_size'])
+        unfreeze_top(model, config['fine_tune_layers'])
+        model.compile(optimizer=Adam(learning_rate=config['fine_tune_learning_rate']), loss='binary_crossentropy',
+                      metrics=['accuracy'])
+        history = model.fit(train_ds, validation_data=val_ds, epochs=max(1, trial['epochs'] // 3), verbose=0)
+    best_epoch = int(np.argmin(history.history['val_loss']))
+    return {
+        'val_loss': float(history.history['val_loss'][best_epoch]),
+        'val_accuracy': float(history.history['val_accuracy'][best_epoch]),
+        'seconds': time.perf_counter() - start
+    }
+
+
+def cached_features(backbone, img_size, img_dir, csv_path, cache_dir, crop_cache, groups_path=None):
+    """Paths of the train/val feature files, computed once with the frozen backbone if not cached yet."""
+    from data_pipeline import get_multilabel_datasets
+    from embedding_cache import feature_model, fingerprint, weights_hash, load_or_compute
+    from model_factory import build_model
+    labels, train_df, val_df = split_labels(csv_path, img_dir, groups_path)
+    model = build_model(len(labels), backbone, img_size)
+    train_gen, val_gen, _ = get_multilabel_datasets(train_df, val_df, img_dir, labels, EMBEDDING_BATCH_SIZE,
+                                                    cache_dir=crop_cache, img_size=img_size)
+    extractor = feature_model(model)
+    weights = weights_hash(extractor)
+    for name, df, gen in [('multilabel_train', train_df, train_gen), ('multilabel_val', val_df, val_gen)]:
+        key = fingerprint([csv_path] + [os.path.join(img_dir, f) for f in df['filename']], model.name, weights)
+        load_or_compute(name, key, extractor, gen, len(gen), cache_dir)
+    return [os.path.join(cache_dir, 'multilabel_train.npz'), os.path.join(cache_dir, 'multilabel_val.npz')]
+
+
+def fill_crop_cache(img_dir, csv_path, crop_cache, img_size, groups_path=None):
+    """
+    Reads the fine-tuning datasets once, so their tf.data cache files are complete before the trials start.
+    Trial processes building the same cache file at the same time would fail on its lockfile.
+    """
+    from data_pipeline import get_multilabel_datasets
+    labels, train_df, val_df = split_labels(csv_path, img_dir, groups_path)
+    train_ds, val_ds, _ = get_multilabel_datasets(train_df, val_df, img_dir, labels, EMBEDDING_BATCH_SIZE,
+                                                  cache_dir=crop_cache, img_size=img_size)
+    for ds in (train_ds, val_ds):
+        for _ in ds:
+            pass
+
+
+def main(args):
+    run = time.strftime('%Y%m%d-%H%M%S')
+    space = dict(SEARCH_SPACE, **(FINE_TUNE_SPACE if args.fine_tune else {}))
+    features = cached_features(args.backbone, args.img_size, args.img_dir, args.csv, args.embedding_cache, args.crop_cache,
+                               args.groups)
+    if args.fine_tune and args.crop_cache:
+        fill_crop_cache(args.img_dir, args.csv, args.crop_cache, args.img_size, args.groups)
+    store = TrialStore(args.results)
+    rng = np.random.default_rng(args.seed)
+    common = dict(features=features, backbone=args.backbone, img_size=args.img_size, fine_tune=args.fine_tune,
+                  img_dir=args.img_dir, csv_path=args.csv, crop_cache=args.crop_cache, groups=args.groups)
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    config_id = 0
+    # TensorFlow is not fork-safe, so workers are spawned
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(threads,)) as pool:
+        for bracket, n_trials, rung_epochs in hyperband_brackets(args.max_epochs, args.min_epochs, args.eta, args.brackets):
+            survivors = []
+            for _ in range(n_trials):
+                survivors.append(dict(common, config_id=config_id, bracket=bracket, seed=args.seed + config_id,
+                                      config=sample_config(space, rng)))
+                config_id += 1
+            for rung, epochs in enumerate(rung_epochs):
+                print(f"Run {run}, bracket {bracket}, rung {rung}: {len(survivors)} trials x {epochs} epochs")
+                trials = [dict(t, rung=rung, epochs=epochs) for t in survivors]
+                results = list(pool.map(run_trial, trials))
+                for trial, result in zip(trials, results):
+                    store.store(run, trial, result)
+                    print(f"  config {trial['config_id']}: val_loss {result['val_loss']:.4f}, "
+                          f"val_accuracy {result['val_accuracy']:.4f} ({result['seconds']:.0f} s)")
+                order = np.argsort([r['val_loss'] for r in results])
+                survivors = [survivors[i] for i in order[:max(1, len(survivors) // args.eta)]]
+
+    best = dict(store.best(run), backbone=args.backbone, img_size=args.img_size)
+    with open(args.output, 'w') as f:
+        json.dump(best, f, indent=2)
+    print(f"Best config {best['config_id']} (val_loss {best['val_loss']:.4f}) saved to {args.output}")
+    print(f"All trials of run {run} are in {args.results}")
+
+
+if __name__ == "__main__":
+    from model_factory import BACKBONES, DEFAULT_BACKBONE
+    parser = argparse.ArgumentParser(description="Hyperband search over the multi-label training hyperparameters.")
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Trials trained in parallel (processes)')
+    parser.add_argument('--max-epochs', type=int, default=MAX_EPOCHS, help='Epochs of a trial in the last rung')
+    parser.add_argument('--min-epochs', type=int, default=MIN_EPOCHS, help='Epochs of a trial in the first rung')
+    parser.add_argument('--eta', type=int, default=ETA, help='Keep 1/eta of the trials per rung')
+    parser.add_argument('--brackets', type=int, help='Run only the first (most aggressive) brackets; 1 = successive halving')
+    parser.add_argument('--fine-tune', action='store_true', help='Also search fine-tuning layers and learning rate (trains on images)')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for sampling configs; trial seeds follow from it')
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default=DEFAULT_BACKBONE, help='Backbone to tune for')
+    parser.add_argument('--img-size', type=int, default=224, help='Input resolution to tune for')
+    parser.add_argument('--img-dir', default=IMG_DIR, help='Directory of the training photos')
+    parser.add_argument('--csv', default=CSV_PATH, help='Labels CSV')
+    parser.add_argument('--groups', metavar='CSV', help='Split by the near-duplicate groups of dedup.py instead of by row')
+    parser.add_argument('--embedding-cache', default=EMBEDDING_DIR, metavar='DIR', help='Where backbone features are cached')
+    parser.add_argument('--crop-cache', metavar='DIR', help='Cache decoded and cropped images in DIR (tf.data cache files)')
+    parser.add_argument('--results', default=RESULTS_PATH, help='SQLite file storing all trials')
+    parser.add_argument('--output', default=BEST_PATH, help='JSON file for the best config')
+    main(parser.parse_args())